@@ -20,13 +20,13 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from core.agent import get_gemini_response
 from utils.storage import clear_user_history
-from utils.sheets_config import load_config, save_config
+from utils.sheets_config import load_config, load_config_with_revision, update_config
 from tools.google_ops import search_drive
 from flask_cors import CORS
 
 app = Flask(__name__)
 # Enable CORS for dashboard - allow all origins and handle preflight
-CORS(app, resources={r"/api/*": {"origins": "*", "methods": ["GET", "POST", "OPTIONS"], "allow_headers": ["Content-Type"]}})
+CORS(app, resources={r"/api/*": {"origins": "*", "methods": ["GET", "POST", "OPTIONS"], "allow_headers": ["Content-Type", "If-Match", "If-None-Match"], "expose_headers": ["ETag"]}})
 
 
 @app.route('/')
@@ -41,12 +41,39 @@ def vector_status():
     import json
     try:
         from utils.vector_store import get_collection_stats
+        from utils.memory_consolidation import get_last_report
         stats = get_collection_stats()
+        stats["last_consolidation"] = get_last_report()
         return json.dumps(stats, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
     except Exception as e:
         return json.dumps({"error": str(e)}), 500, {'Content-Type': 'application/json'}
 
 
+@app.route('/debug/notion-metrics')
+def notion_metrics():
+    """Debug endpoint for Notion request/throttling counters"""
+    from tools.notion_ops import get_notion_metrics
+    return json.dumps(get_notion_metrics()), 200, {'Content-Type': 'application/json'}
+
+
+@app.route('/debug/job-runs')
+def job_runs():
+    """Debug endpoint for recent reminder/profiler run summaries (latency, failures)"""
+    from utils.fanout import get_recent_runs
+    return json.dumps(get_recent_runs(), ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+
+@app.route('/debug/scheduler')
+def scheduler_status():
+    """Debug endpoint: is this process the scheduler leader, and which jobs it holds"""
+    from utils.leader import get_leader_status
+    status = get_leader_status()
+    status["jobs"] = [
+        {"id": job.id, "next_run": str(job.next_run_time)} for job in scheduler.get_jobs()
+    ] if status["is_leader"] else []
+    return json.dumps(status, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+
 # LINE credentials
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', '')
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
@@ -108,6 +135,11 @@ def push_message(user_id, texts):
             print(f"Push error: {e}", file=sys.stderr)
 
 
+# Background jobs (maker) report progress and results over LINE push
+from core.jobs import set_notifier
+set_notifier(push_message)
+
+
 def reply_message(reply_token, text):
     """Send message via LINE Reply API (for sync responses)"""
     url = 'https://api.line.me/v2/bot/message/reply'
@@ -336,72 +368,20 @@ from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
 
 def check_reminders():
-    """Scheduled job to check and send reminders"""
-    # Use existing cron logic but internalize the context
+    """Send reminders that are due and not yet sent (any worker); returns the number sent or None on error"""
     with app.app_context():
         try:
-            # Reusing the logic from the old route, but suited for internal execution
-            from utils.user_db import get_active_users
-            users = get_active_users()
-            print(f"Scheduler: Checking reminders for {len(users)} users...", file=sys.stderr)
-            
-            for user in users:
-                process_user_reminders(user)
-                
+            from core.reminders import send_due
+            return send_due(send_reminder)
         except Exception as e:
             print(f"Scheduler Error: {e}", file=sys.stderr)
+            return None
 
-def process_user_reminders(user):
-    """Process reminders for a single user"""
-    user_id = user['user_id']
-    location = user['location']
-    
-    auth_config = load_config() # Ideally load user-specific config
-    reminders = auth_config.get('reminders', [])
-    
-    # Fallback for old format
-    if not reminders and auth_config.get('reminder_time'):
-         reminders = [{
-            'name': '朝のリマインダー',
-            'time': auth_config.get('reminder_time', '07:00'),
-            'prompt': auth_config.get('reminder_prompt', '今日の天気と予定を教えて'),
-            'enabled': True
-        }]
-
-    from datetime import datetime, timezone, timedelta
-    jst = timezone(timedelta(hours=9))
-    now = datetime.now(jst)
-    current_hour = now.hour
-    current_minute = now.minute
-    
-    for reminder in reminders:
-        if not reminder.get('enabled', True): continue
-        
-        # Simple hour checks for now (can enhance to minute level)
-        r_time = reminder.get('time', '07:00')
-        try:
-            r_hour = int(r_time.split(':')[0])
-        except:
-            r_hour = 7
-            
-        if r_hour != current_hour: continue
-        
-        # Prevent double sending if checked multiple times in same hour?
-        # For now, scheduler runs hourly so it should be fine.
-        
-        send_reminder(user_id, location, reminder)
-
-def send_reminder(user_id, location, reminder):
-    prompt = (
-        f"今日の{location}の{reminder.get('prompt')}\n"
-        "【重要】以下の3つのセクションに分けて、それぞれの間に「@@@」という区切り文字を入れて出力してください。\n"
-        "1. 天気に関する情報\n"
-        "2. スケジュール・タスクに関する情報\n"
-        "3. 気の利いた一言メッセージ"
-    )
-    
+def send_reminder(user_id, location, reminder, auth_config=None):
     try:
-        response = get_gemini_response(user_id, prompt)
+        # Data was prefetched a few minutes ago; this is a single LLM call
+        from core.briefing import compose_briefing
+        response = compose_briefing(user_id, location, reminder, auth_config)
         messages = [msg.strip() for msg in response.split('@@@') if msg.strip()]
         
         # Add greeting
@@ -420,42 +400,110 @@ def send_reminder(user_id, location, reminder):
         print(f"Sent reminder to {user_id[:8]}", file=sys.stderr)
     except Exception as e:
         print(f"Failed to send reminder: {e}", file=sys.stderr)
+        raise  # counted as a failure in the run summary
 
 
 # Start Scheduler
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=check_reminders, trigger="cron", hour="*", minute=0) # Run every hour on the hour
+def _build_jobstores():
+    """Persistent job store when SCHEDULER_JOBSTORE_URL is set (e.g. sqlite:///data/jobs.sqlite)"""
+    url = os.environ.get('SCHEDULER_JOBSTORE_URL')
+    if not url:
+        return {}
+    try:
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        return {'default': SQLAlchemyJobStore(url=url)}
+    except ImportError:
+        print("SCHEDULER_JOBSTORE_URL is set but SQLAlchemy is not installed; using the memory job store", file=sys.stderr)
+        return {}
+
+scheduler = BackgroundScheduler(jobstores=_build_jobstores())
 
 # Profiler Job (Run daily at 3 AM JST = 18:00 UTC)
+PROFILER_MAX_WORKERS = int(os.environ.get('PROFILER_MAX_WORKERS', 3))
+PROFILER_USER_TIMEOUT = int(os.environ.get('PROFILER_USER_TIMEOUT', 300))
+
 def run_profiler():
     """Run profiler for all active users"""
     with app.app_context():
         try:
             from core.profiler import profiler
             from utils.user_db import get_active_users
+            from utils.fanout import fan_out
             
             users = get_active_users()
             print(f"Profiler: Starting daily analysis for {len(users)} users...", file=sys.stderr)
             
-            for user in users:
-                user_id = user['user_id']
-                # Run profile analysis
-                profiler.run_analysis(user_id)
+            # Analyse users in parallel (bounded; Gemini calls share the agent's concurrency limit)
+            fan_out("Profiler", users, lambda user: profiler.run_analysis(user['user_id']),
+                    key=lambda user: user['user_id'],
+                    max_workers=PROFILER_MAX_WORKERS, timeout=PROFILER_USER_TIMEOUT)
+
+            # Each user's watermark has moved past old messages; drop those beyond retention
+            from utils.journal import prune
+            pruned = prune()
+            if pruned:
+                print(f"Profiler: pruned {pruned} old journal messages", file=sys.stderr)
                 
         except Exception as e:
             print(f"Profiler Job Error: {e}", file=sys.stderr)
 
-scheduler.add_job(func=run_profiler, trigger="cron", hour=18) # 18:00 UTC = 03:00 JST
+scheduler.add_job(func=run_profiler, trigger="cron", hour=18, id="profiler", replace_existing=True) # 18:00 UTC = 03:00 JST
+
+def run_memory_consolidation():
+    """Merge near-duplicate and drop low-information conversation vectors for all active users"""
+    try:
+        from utils.memory_consolidation import consolidate_all
+        from utils.user_db import get_active_users
+        consolidate_all(get_active_users())
+    except Exception as e:
+        print(f"Memory Consolidation Job Error: {e}", file=sys.stderr)
+
+scheduler.add_job(func=run_memory_consolidation, trigger="cron", hour=19, id="memory-consolidation", replace_existing=True) # 19:00 UTC = 04:00 JST
+
+# Keep the local Notion mirror fresh so task lists are served without API calls
+def sync_notion_mirror():
+    """Delta-sync the configured Notion databases into the local mirror"""
+    try:
+        from utils.notion_mirror import sync_configured_databases
+        sync_configured_databases()
+    except Exception as e:
+        print(f"Notion Mirror Job Error: {e}", file=sys.stderr)
+
+scheduler.add_job(func=sync_notion_mirror, trigger="interval", minutes=5, id="notion-mirror", replace_existing=True)
+
+# Only one process (the lease holder) runs scheduled jobs; see utils/leader.py
+def _on_elected():
+    if scheduler.running:
+        scheduler.resume()
+    else:
+        scheduler.start()
+    # Reminders: each (user, reminder) at its exact time
+    from core.reminders import init as init_reminders
+    init_reminders(scheduler, send_reminder)
+
+def _on_revoked():
+    if scheduler.running:
+        scheduler.pause()
+
+from utils.leader import run_as_leader
+_elector = run_as_leader(_on_elected, _on_revoked)
 
-scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
+def _shutdown_scheduler():
+    if _elector:
+        _elector.stop()
+    if scheduler.running:
+        scheduler.shutdown()
+
+atexit.register(_shutdown_scheduler)
 
 
 @app.route('/cron', methods=['GET'])
 def cron_job():
-    """Manual trigger for reminders (Legacy/Debug)"""
-    check_reminders()
-    return 'Reminders checked manually', 200
+    """Manual trigger for reminders (Legacy/Debug). Must hit a worker sharing the leader's data/ directory"""
+    sent = check_reminders()
+    if sent is None:
+        return 'Reminder check failed', 500
+    return f'Reminders checked manually ({sent} sent)', 200
 
 @app.route('/debug/run-profiler', methods=['POST'])
 def debug_run_profiler():
@@ -464,25 +512,69 @@ def debug_run_profiler():
     return 'Profiler triggered', 200
 
 
+def _config_etag(revision):
+    return f'"{revision}"'
+
+def _parse_etag(value):
+    """'"12"' / 'W/"12"' / '12' -> 12 (None if absent or not a revision)"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith('W/'):
+        value = value[2:]
+    value = value.strip('"')
+    return int(value) if value.isdigit() else None
+
 @app.route('/api/config', methods=['GET', 'POST', 'OPTIONS'])
 def handle_config():
-    """Get or update configuration"""
+    """
+    Get or update configuration
+    GET returns an ETag (the config revision) and answers 304 to a matching If-None-Match.
+    POST sends the full config (keys missing from it are deleted); with ?partial=1 it may
+    send only the keys that changed. With If-Match it is rejected (412) if the config has
+    been modified since that revision.
+    """
     # Handle preflight request
     if request.method == 'OPTIONS':
         response = app.make_default_options_response()
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, If-Match, If-None-Match'
         return response
     
     if request.method == 'GET':
-        return json.dumps(load_config(), ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+        config, revision = load_config_with_revision()
+        headers = {'Content-Type': 'application/json'}
+        if revision is not None:
+            headers['ETag'] = _config_etag(revision)
+            if _parse_etag(request.headers.get('If-None-Match')) == revision:
+                return '', 304, headers
+        return json.dumps(config, ensure_ascii=False), 200, headers
     
     elif request.method == 'POST':
         try:
             new_config = request.json
-            if save_config(new_config):
-                return json.dumps({"success": True, "config": new_config}), 200, {'Content-Type': 'application/json'}
+            if_match = request.headers.get('If-Match')
+            expected = _parse_etag(if_match)
+            if if_match and if_match.strip() != '*' and expected is None:
+                return json.dumps({"error": "Invalid If-Match"}), 400, {'Content-Type': 'application/json'}
+            
+            partial = request.args.get('partial') in ('1', 'true')
+            result = update_config(new_config, expected_revision=expected, replace=not partial)
+            if result.get("conflict"):
+                config, revision = load_config_with_revision()
+                return json.dumps({"error": result["error"], "config": config}, ensure_ascii=False), 412, {
+                    'Content-Type': 'application/json', 'ETag': _config_etag(revision)
+                }
+            if result.get("success"):
+                if result["changed"]:
+                    from core.reminders import request_refresh
+                    request_refresh()
+                # The stored config merged with defaults (the body may have been partial)
+                config, revision = load_config_with_revision()
+                return json.dumps({"success": True, "config": config, "revision": revision, "changed": result["changed"]}, ensure_ascii=False), 200, {
+                    'Content-Type': 'application/json', 'ETag': _config_etag(revision)
+                }
             else:
                 return json.dumps({"error": "Failed to save config"}), 500, {'Content-Type': 'application/json'}
         except Exception as e:
@@ -514,6 +606,8 @@ def handle_profile():
     
     if request.method == 'GET':
         profile = get_user_profile(target_user_id)
+        if profile is None:
+            return json.dumps({"error": "Profile is temporarily unavailable"}), 503, {'Content-Type': 'application/json'}
         return json.dumps(profile, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
         
     elif request.method == 'POST':
@@ -526,6 +620,33 @@ def handle_profile():
         except Exception as e:
             return json.dumps({"error": str(e)}), 400, {'Content-Type': 'application/json'}
 
+@app.route('/api/jobs', methods=['GET', 'OPTIONS'])
+@app.route('/api/jobs/<job_id>', methods=['GET', 'OPTIONS'])
+def handle_jobs(job_id=None):
+    """List background jobs (filter by user_id / status) or get one job"""
+    # Handle preflight request
+    if request.method == 'OPTIONS':
+        response = app.make_default_options_response()
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    from core.jobs import get_job, list_jobs
+
+    if job_id:
+        job = get_job(job_id)
+        if not job:
+            return json.dumps({"error": "Job not found"}), 404, {'Content-Type': 'application/json'}
+        return json.dumps(job, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+    jobs = list_jobs(
+        user_id=request.args.get('user_id'),
+        status=request.args.get('status'),
+        limit=request.args.get('limit', 50, type=int)
+    )
+    return json.dumps({"jobs": jobs}, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
 @app.route('/api/folders', methods=['GET', 'OPTIONS'])
 def list_folders():
     """List Google Drive folders for selection (Navigation support)"""
@@ -0,0 +1,35 @@
+"""
+One-off migration: copy conversation history saved before the message journal existed
+(history.json, or its Drive backup) into data/journal.db, so the profiler and lexical
+retrieval see it too.
+
+Only messages older than each user's first journaled one (and inside JOURNAL_RETENTION_DAYS)
+are inserted, so it is safe to re-run. history.json keeps just the last MAX_HISTORY turns
+per user; older conversations exist only in Pinecone and are not recovered here.
+
+Usage: python backfill_journal.py [--dry-run]
+"""
+from dotenv import load_dotenv
+import os
+import sys
+
+load_dotenv()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils.storage import load_all_history
+from utils import journal
+
+dry_run = "--dry-run" in sys.argv
+
+history = load_all_history()
+print(f"Backfilling journal from {len(history)} users' history{' (dry run)' if dry_run else ''}...")
+total = 0
+for user_id, messages in history.items():
+    if dry_run:
+        print(f"  {user_id}: {len(messages)} messages in history")
+        continue
+    inserted = journal.backfill(user_id, messages)
+    total += inserted
+    print(f"  {user_id}: {inserted} inserted")
+
+print(f"Done: {total} messages backfilled.")
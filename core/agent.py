@@ -4,13 +4,75 @@ Gemini AI Agent - handles conversation with Gemini API and tool execution
 import os
 import sys
 import json
+import time
+import threading
 import urllib.request
+from contextlib import contextmanager
 
 from core.prompts import SYSTEM_PROMPT, TOOLS
 from utils.storage import get_user_history, add_message
 
 # Gemini API
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
+# Concurrent Gemini calls across interactive replies and scheduled jobs
+GEMINI_MAX_CONCURRENCY = int(os.environ.get('GEMINI_MAX_CONCURRENCY', 4))
+# Slots only interactive replies may use, so a reminder/profiler fan-out never starves a user waiting on LINE
+GEMINI_INTERACTIVE_RESERVE = int(os.environ.get('GEMINI_INTERACTIVE_RESERVE', 1))
+# Longest wait for a free slot before giving up (seconds); a user on LINE gets a "busy" reply instead of hanging
+GEMINI_SLOT_TIMEOUT = float(os.environ.get('GEMINI_SLOT_TIMEOUT', 30))
+# Background jobs can wait longer, but not forever if a slot leaks or the API stalls
+GEMINI_BACKGROUND_SLOT_TIMEOUT = float(os.environ.get('GEMINI_BACKGROUND_SLOT_TIMEOUT', 300))
+
+
+class GeminiBusyError(TimeoutError):
+    """No Gemini concurrency slot became free before the deadline"""
+
+
+class _GeminiLimiter:
+    """Counting limiter where background callers see a smaller limit than interactive ones"""
+    def __init__(self, limit, reserve):
+        self.limit = max(1, limit)
+        self.background_limit = max(1, limit - reserve)
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, background=False, timeout=None):
+        limit = self.background_limit if background else self.limit
+        if timeout is None:
+            timeout = GEMINI_BACKGROUND_SLOT_TIMEOUT if background else GEMINI_SLOT_TIMEOUT
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_use >= limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise GeminiBusyError(f"no Gemini slot free within {timeout:g}s ({self.in_use} in use)")
+                self._cond.wait(remaining)
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= 1
+                self._cond.notify_all()
+
+
+_gemini_limiter = _GeminiLimiter(GEMINI_MAX_CONCURRENCY, GEMINI_INTERACTIVE_RESERVE)
+
+
+def gemini_slot(background=False, timeout=None):
+    """
+    Hold one Gemini concurrency slot (also used by the profiler's SDK calls).
+    Raises GeminiBusyError if none frees up within timeout (default GEMINI_[BACKGROUND_]SLOT_TIMEOUT).
+    """
+    return _gemini_limiter.slot(background, timeout)
+
+
+def _post_gemini(req, background=False):
+    """Send one generateContent request within the shared concurrency limit"""
+    with gemini_slot(background):
+        with urllib.request.urlopen(req, timeout=60) as res:
+            return json.loads(res.read().decode('utf-8'))
 
 
 def execute_tool(tool_name, args, user_id=None):
@@ -55,7 +117,7 @@ def execute_tool(tool_name, args, user_id=None):
     elif tool_name == "create_google_sheet":
         return create_google_sheet(args.get("title", "新規スプレッドシート"))
     elif tool_name == "create_google_slide":
-        return create_google_slide(args.get("title", "新規スライド"))
+        return create_google_slide(args.get("title", "新規スライド"), args.get("content", ""))
     elif tool_name == "create_drive_folder":
         return create_drive_folder(args.get("folder_name", "新規フォルダ"))
     elif tool_name == "move_drive_file":
@@ -63,13 +125,21 @@ def execute_tool(tool_name, args, user_id=None):
     elif tool_name == "search_drive":
         return search_drive(args.get("query", ""))
     elif tool_name == "list_gmail":
-        return list_gmail(args.get("query", "is:unread"), args.get("max_results", 5))
+        return list_gmail(
+            args.get("query", "is:unread"),
+            args.get("max_results", 5),
+            args.get("incremental", False)
+        )
     elif tool_name == "get_gmail_body":
         return get_gmail_body(args.get("message_id", ""))
     elif tool_name == "set_reminder":
         if not user_id:
             return {"error": "ユーザーIDが取得できませんでした。"}
-        return register_user(user_id, args.get("location", ""))
+        result = register_user(user_id, args.get("location", ""))
+        if result.get("success"):
+            from core.reminders import request_refresh
+            request_refresh()
+        return result
     elif tool_name == "list_calendar_events":
         return list_calendar_events(
             args.get("query"),
@@ -87,7 +157,11 @@ def execute_tool(tool_name, args, user_id=None):
         return find_free_slots(
             args.get("start_date"),
             args.get("end_date"),
-            args.get("duration", 60)
+            args.get("duration", 60),
+            calendar_ids=args.get("calendar_ids"),
+            step_minutes=args.get("step_minutes"),
+            working_hours=args.get("working_hours"),
+            weekdays=args.get("weekdays")
         )
     elif tool_name == "list_tasks":
         return list_tasks(args.get("show_completed", False), args.get("due_date"))
@@ -119,151 +193,35 @@ def execute_tool(tool_name, args, user_id=None):
         from tools.notion_ops import update_notion_task
         return update_notion_task(args.get("page_id"), args.get("status"), args.get("title"))
     elif tool_name == "delegate_to_maker":
-        from core.maker import maker
-        response_text = maker.run(args.get("request", ""))
-        return {"report": response_text}
+        # Runs as a background job; progress and the finished document are pushed over LINE
+        from core.jobs import submit_maker_job
+        job = submit_maker_job(user_id, args.get("request", ""))
+        if job.get("error"):
+            return job
+        return {
+            **job,
+            "message": "フミさんがバックグラウンドで作成中です。完成したらLINEでURLをお知らせします（ジョブID: " + job["job_id"] + "）"
+        }
     else:
         return {"error": f"Unknown tool: {tool_name}"}
 
 
-def format_tool_result(tool_name, result):
-    """Format tool result for user-friendly response"""
-    if result.get("error"):
-        error_msg = result['error']
-        return f"ごめんなさい、エラーが出ちゃいました...😢\n{error_msg}\n\n(※もう一度試すか、言い方を変えてみてください)"
-    
-    # Check for execution warnings/notes (e.g. shared folder move failure)
-    note = result.get("note", "")
-    
-    if tool_name == "calculate":
-        return f"計算しました！✨\n\n{result['expression']} = **{result['result']}**"
-    
-    elif tool_name == "calculate_date":
-        if 'time' in result:
-            return f"今日は {result['date']}（{result['weekday']}）\n現在時刻: {result['time']}"
-        elif 'days' in result:
-            return f"{result['target']}まで **{result['days']}日** です！"
-        else:
-            return f"{result['date']}（{result['weekday']}）です！"
-    
-    elif tool_name == "search_and_read_pdf":
-        text = result.get('text', '')[:1000]
-        return f"PDF読み取りました！📄\n\nファイル: {result.get('filename', '')}\n\n---\n{text}"
-    
-    elif tool_name == "google_web_search":
-        urls = result.get('urls', [])
-        if not urls:
-            return f"「{result.get('query', '')}」で検索しましたが、結果が見つかりませんでした〜"
-        response = f"「{result.get('query', '')}」で検索しました！🔍\n\n"
-        for i, url in enumerate(urls[:5], 1):
-            response += f"{i}. {url}\n"
-        response += "\n詳しく見たいURLがあれば教えてくださいね！"
-        return response
-    
-    elif tool_name == "fetch_url":
-        content = result.get('content', '')[:500]
-        return f"Webページの内容を取得しました！🌐\n\n{content}..."
-    
-    elif tool_name in ["create_google_doc", "create_google_sheet", "create_google_slide"]:
-        return f"作成しました！✨\n\n📄 {result.get('title', '')}\n🔗 {result['url']}{note}"
-    
-    elif tool_name == "search_drive":
-        files = result.get("files", [])
-        if not files:
-            return "検索しましたが、該当するファイルは見つかりませんでした〜"
-        response = f"ドライブを検索しました！{len(files)}件見つかりましたよ✨\n\n"
-        for f in files[:5]:
-            response += f"📁 {f['name']}\n   {f.get('webViewLink', '')}\n\n"
-        return response.strip()
-    
-    elif tool_name == "list_gmail":
-        emails = result.get("emails", [])
-        if not emails:
-            return "メールは見つかりませんでした〜"
-        response = f"メールを確認しました！{len(emails)}件ありますよ📧\n\n"
-        for e in emails[:5]:
-            from_addr = e['from'][:30] + '...' if len(e['from']) > 30 else e['from']
-            snippet = e.get('snippet', '')[:50]
-            response += f"📩 {e['subject']}\n   From: {from_addr}\n   {snippet}...\n\n"
-        return response.strip()
-
-    elif tool_name == "get_gmail_body":
-        if result.get("error"):
-            return f"メール取得エラー: {result['error']}"
-        subject = result.get("subject", "(件名なし)")
-        body = result.get("body", "")[:500]
-        return f"📧 {subject}\n---\n{body}"
-    elif tool_name == "set_reminder":
-        return f"リマインダー設定しました！✨\n毎日朝7時頃に「{result.get('location', '')}」の天気と服装をお知らせしますね！☀️"
-    
-    elif tool_name == "list_calendar_events":
-        events = result.get("events", [])
-        if not events:
-            return "予定は見つかりませんでした〜"
-        
-        response = f"予定を確認しました！{len(events)}件あります📅\n\n"
-        for evt in events[:5]:
-            start = evt['start'].get('dateTime', evt['start'].get('date'))
-            summary = evt.get('summary', '(タイトルなし)')
-            response += f"🗓️ {start[:16].replace('T', ' ')}\n   {summary}\n\n"
-        return response.strip()
-
-    elif tool_name == "create_calendar_event":
-        link = result.get("link", "")
-        return f"予定を追加しました！✨\n\n📅 {result.get('event', {}).get('summary', '')}\n🔗 {link}"
-    
-    elif tool_name == "list_tasks":
-        tasks = result.get("tasks", [])
-        if not tasks:
-            return "ToDoリストはありませんでした〜"
-        response = f"ToDoを確認しました！{len(tasks)}件あります📝\n\n"
-        for t in tasks[:10]:
-            title = t['title']
-            due = f" (期限: {t['due'][:10]})" if 'due' in t else ""
-            response += f"☐ {title}{due}\n"
-        return response.strip()
-
-    elif tool_name == "add_task":
-        t = result.get("task", {})
-        return f"ToDoを追加しました！✨\n\n📝 {t.get('title', '')}"
-
-    elif tool_name == "delegate_to_maker":
-        return f"フミさんに頼んできますね！👩‍💻\n\n{result.get('report', '')}"
-    
-    return json.dumps(result, ensure_ascii=False)
-
-
-def get_gemini_response(user_id, user_message, image_data=None, mime_type=None):
-    """Get response from Gemini API with function calling and conversation history"""
-    if not GEMINI_API_KEY:
-        return "APIキーが設定されていません〜"
-    
-    # Add user message to history
-    # If image is present, we only log [Image] marker in text history for now
-    log_message = user_message
-    if image_data:
-        log_message += " [添付画像あり]"
-    add_message(user_id, "user", log_message)
-    
-    # Get conversation history
-    history = get_user_history(user_id)
-    
-    # Use gemini-2.0-flash-exp (or gemini-1.5-pro) for Multimodal
-    # gemini-3-flash-preview is also capable
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent?key={GEMINI_API_KEY}"
-    
-    headers = {'Content-Type': 'application/json'}
-    
-    # Build dynamic system prompt with config-based customizations
-    from utils.sheets_config import load_config
-    try:
-        config = load_config()
-    except:
-        config = {}
+def _build_system_prompt(user_id, config=None, knowledge=False):
+    """
+    System prompt shared by every Gemini reply: base prompt, current time, and the
+    persona / profile / user name / master prompt from the config sheet.
+    knowledge=True adds the knowledge-folder hints (only useful when search_drive is available).
+    """
+    if config is None:
+        from utils.sheets_config import load_config
+        try:
+            config = load_config()
+        except:
+            config = {}
     
     # Build knowledge context
     knowledge_context = ""
-    knowledge_sources = config.get('knowledge_sources', [])
+    knowledge_sources = config.get('knowledge_sources', []) if knowledge else []
     if knowledge_sources:
         knowledge_context = "\n\n【★ナレッジフォルダ★】\n以下のフォルダがナレッジベースとして設定されています。ユーザーの質問に関連するフォルダがあれば、search_driveでそのフォルダ内を検索してください。\n"
         for ks in knowledge_sources:
@@ -279,7 +237,7 @@ def get_gemini_response(user_id, user_message, image_data=None, mime_type=None):
     personality = config.get('personality', '')
     personality_section = ""
     if personality.strip():
-        personality_section = f"あなたの性格: {personality}\n"
+        personality_section = f"\n\n【★性格設定★】\n以下の性格・話し方でユーザーに接してください：\n{personality}\n"
         
     # [Diff] Fetch User Profile (Phase 5)
     from utils.vector_store import get_user_profile
@@ -297,7 +255,6 @@ def get_gemini_response(user_id, user_message, image_data=None, mime_type=None):
 
 あなたは、上記のプロファイルに基づき、ユーザー（{user_profile.get('name', 'ユーザー')}さん）を深く理解している秘書として振る舞ってください。
 """
-        personality_section = f"\n\n【★性格設定★】\n以下の性格・話し方でユーザーに接してください：\n{personality}\n"
     
     # Get user name for personalization
     user_name = config.get('user_name', '')
@@ -305,6 +262,35 @@ def get_gemini_response(user_id, user_message, image_data=None, mime_type=None):
     if user_name.strip():
         user_name_section = f"\n\n【★ユーザー名★】\nあなたが仕えている人の名前は「{user_name}」です。親しみを込めて接してください。\n"
     
+    # Current Date/Time context (CRITICAL for model awareness)
+    import datetime
+    now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S (%A)')
+    time_context = f"\n【★現在日時★】\n本日は {now_str} です。ユーザーから「今日」「明日」と言われたらこの日付を基準にしてください。\n"
+    
+    return SYSTEM_PROMPT + time_context + personality_section + profile_section + user_name_section + knowledge_context + master_prompt_section
+
+
+def get_gemini_response(user_id, user_message, image_data=None, mime_type=None):
+    """Get response from Gemini API with function calling and conversation history"""
+    if not GEMINI_API_KEY:
+        return "APIキーが設定されていません〜"
+    
+    # Add user message to history
+    # If image is present, we only log [Image] marker in text history for now
+    log_message = user_message
+    if image_data:
+        log_message += " [添付画像あり]"
+    add_message(user_id, "user", log_message)
+    
+    # Get conversation history
+    history = get_user_history(user_id)
+    
+    # Use gemini-2.0-flash-exp (or gemini-1.5-pro) for Multimodal
+    # gemini-3-flash-preview is also capable
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent?key={GEMINI_API_KEY}"
+    
+    headers = {'Content-Type': 'application/json'}
+    
     # RAG: Retrieve relevant past conversations
     rag_context = ""
     try:
@@ -315,13 +301,8 @@ def get_gemini_response(user_id, user_message, image_data=None, mime_type=None):
     except Exception as e:
         print(f"RAG context error: {e}", file=sys.stderr)
     
-    # Current Date/Time context (CRITICAL for model awareness)
-    import datetime
-    now_str = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S (%A)')
-    time_context = f"\n【★現在日時★】\n本日は {now_str} です。ユーザーから「今日」「明日」と言われたらこの日付を基準にしてください。\n"
-
     # Combine prompts with RAG and Profile context
-    full_system_prompt = SYSTEM_PROMPT + time_context + personality_section + profile_section + user_name_section + knowledge_context + master_prompt_section + rag_context
+    full_system_prompt = _build_system_prompt(user_id, knowledge=True) + rag_context
     
     # Build conversation contents
     contents = [] # Initialize properly
@@ -371,83 +352,123 @@ def get_gemini_response(user_id, user_message, image_data=None, mime_type=None):
             # Agent Loop: Handle multiple tool calls
             max_turns = 5
             for turn in range(max_turns):
-                with urllib.request.urlopen(req, timeout=60) as res:
-                    result = json.loads(res.read().decode('utf-8'))
-                    candidates = result.get('candidates', [])
+                result = _post_gemini(req)
+                candidates = result.get('candidates', [])
+                
+                if not candidates:
+                    return 'ちょっと調子悪いみたいです...もう一度試してもらえますか？'
+                
+                content = candidates[0].get('content', {})
+                parts = content.get('parts', [])
+                print(f"[DEBUG] Model Response Parts: {parts}", file=sys.stderr)
+                
+                # 1. Check for functionCall (Prioritize over text for loop)
+                function_call_part = next((p for p in parts if 'functionCall' in p), None)
+                
+                # --- GUARDRAIL: Force Fumi Delegation if model forgets ---
+                text_part = next((p.get('text', '') for p in parts if 'text' in p), "")
+                if not function_call_part and ("ふみさんへのお願い" in text_part or "**依頼:**" in text_part):
+                     print("[DEBUG] Guardrail triggered: Forcing delegate_to_maker", file=sys.stderr)
+                     # Clean up text to extract the request
+                     request_text = text_part
+                     function_call_part = {
+                         'functionCall': {
+                             'name': 'delegate_to_maker',
+                             'args': {'request': request_text}
+                         }
+                     }
+                # ---------------------------------------------------------
+
+                if function_call_part:
+                    func_call = function_call_part['functionCall']
+                    tool_name = func_call.get('name')
+                    tool_args = func_call.get('args', {})
                     
-                    if not candidates:
-                        return 'ちょっと調子悪いみたいです...もう一度試してもらえますか？'
+                    print(f"[DEBUG] Executing tool: {tool_name}", file=sys.stderr)
+                    tool_result = execute_tool(tool_name, tool_args, user_id=user_id)
                     
-                    content = candidates[0].get('content', {})
-                    parts = content.get('parts', [])
-                    print(f"[DEBUG] Model Response Parts: {parts}", file=sys.stderr)
+                    # Add function call and response to history (contents) for next request
+                    contents.append({
+                        "role": "model",
+                        "parts": [function_call_part]
+                    })
                     
-                    # 1. Check for functionCall (Prioritize over text for loop)
-                    function_call_part = next((p for p in parts if 'functionCall' in p), None)
+                    contents.append({
+                        "role": "function",
+                        "parts": [{
+                            "functionResponse": {
+                                "name": tool_name,
+                                "response": {"result": tool_result}
+                            }
+                        }]
+                    })
                     
-                    # --- GUARDRAIL: Force Fumi Delegation if model forgets ---
-                    text_part = next((p.get('text', '') for p in parts if 'text' in p), "")
-                    if not function_call_part and ("ふみさんへのお願い" in text_part or "**依頼:**" in text_part):
-                         print("[DEBUG] Guardrail triggered: Forcing delegate_to_maker", file=sys.stderr)
-                         # Clean up text to extract the request
-                         request_text = text_part
-                         function_call_part = {
-                             'functionCall': {
-                                 'name': 'delegate_to_maker',
-                                 'args': {'request': request_text}
-                             }
-                         }
-                    # ---------------------------------------------------------
-
-                    if function_call_part:
-                        func_call = function_call_part['functionCall']
-                        tool_name = func_call.get('name')
-                        tool_args = func_call.get('args', {})
-                        
-                        print(f"[DEBUG] Executing tool: {tool_name}", file=sys.stderr)
-                        tool_result = execute_tool(tool_name, tool_args, user_id=user_id)
-                        
-                        # Add function call and response to history (contents) for next request
-                        contents.append({
-                            "role": "model",
-                            "parts": [function_call_part]
-                        })
-                        
-                        contents.append({
-                            "role": "function",
-                            "parts": [{
-                                "functionResponse": {
-                                    "name": tool_name,
-                                    "response": {"result": tool_result}
-                                }
-                            }]
-                        })
-                        
-                        # Update request data with new history
-                        data["contents"] = contents
-                        req = urllib.request.Request(
-                            url,
-                            data=json.dumps(data).encode('utf-8'),
-                            headers=headers,
-                            method='POST'
-                        )
-                        continue # Loop to call API again with tool result
+                    # Update request data with new history
+                    data["contents"] = contents
+                    req = urllib.request.Request(
+                        url,
+                        data=json.dumps(data).encode('utf-8'),
+                        headers=headers,
+                        method='POST'
+                    )
+                    continue # Loop to call API again with tool result
 
-                    # 2. If no functionCall, return text (End of turn)
-                    for part in parts:
-                        if 'text' in part:
-                            response_text = part['text']
-                            add_message(user_id, "model", response_text)
-                            # Save model response to vector store for RAG
-                            try:
-                                from utils.vector_store import save_conversation
-                                save_conversation(user_id, "model", response_text)
-                            except:
-                                pass
-                            return response_text
+                # 2. If no functionCall, return text (End of turn)
+                for part in parts:
+                    if 'text' in part:
+                        response_text = part['text']
+                        add_message(user_id, "model", response_text)
+                        # Save model response to vector store for RAG
+                        try:
+                            from utils.vector_store import save_conversation
+                            save_conversation(user_id, "model", response_text)
+                        except:
+                            pass
+                        return response_text
             
             return '考えがまとまりませんでした...もう一度聞いてください。'
     
+    except GeminiBusyError as e:
+        print(f"Gemini busy: {e}", file=sys.stderr)
+        return "いま混み合っています...少し時間をおいてもう一度話しかけてください🙏"
     except Exception as e:
         print(f"Gemini error: {e}", file=sys.stderr)
         return "ちょっとエラーが出ちゃいました...😢"
+
+
+def get_gemini_text_response(user_id, prompt, config=None):
+    """
+    Single Gemini call without tools, for prompts whose data is already assembled
+    (e.g. precomputed reminder briefings). The reply is added to the user's history.
+    """
+    if not GEMINI_API_KEY:
+        return "APIキーが設定されていません〜"
+    
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent?key={GEMINI_API_KEY}"
+    
+    data = {
+        "contents": [
+            {"role": "user", "parts": [{"text": _build_system_prompt(user_id, config)}]},
+            {"role": "model", "parts": [{"text": "Understood."}]},
+            {"role": "user", "parts": [{"text": prompt}]}
+        ],
+        "generationConfig": {"temperature": 0.8, "maxOutputTokens": 1024}
+    }
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(data).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    
+    try:
+        result = _post_gemini(req, background=True)
+        parts = result.get('candidates', [{}])[0].get('content', {}).get('parts', [])
+        response_text = "".join(p.get('text', '') for p in parts).strip()
+        if not response_text:
+            return 'ちょっと調子悪いみたいです...もう一度試してもらえますか？'
+        add_message(user_id, "model", response_text)
+        return response_text
+    except Exception as e:
+        print(f"Gemini text error: {e}", file=sys.stderr)
+        return "ちょっとエラーが出ちゃいました...😢"
@@ -0,0 +1,165 @@
+"""
+Reminder Briefings
+Weather, calendar, Google Tasks and Notion data are fetched ahead of the reminder time
+(in parallel, shared sources once for all users) and handed to the model as one
+pre-assembled context, so each reminder is a single LLM call with no tool round trips.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+# Prefetch this many minutes before the reminder is due
+BRIEFING_LEAD_MINUTES = int(os.environ.get('BRIEFING_LEAD_MINUTES', 5))
+# A prefetched context older than this is gathered again at send time (seconds)
+BRIEFING_CONTEXT_TTL = int(os.environ.get('BRIEFING_CONTEXT_TTL', 900))
+BRIEFING_MAX_WORKERS = int(os.environ.get('BRIEFING_MAX_WORKERS', 8))
+
+JST = timezone(timedelta(hours=9))
+
+# location -> {"fetched_at": epoch, "weather": ..., "events": ..., "tasks": ..., "notion": ...}
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def _fetch_events():
+    """Today's calendar events, trimmed to what the briefing needs"""
+    from tools.google_ops import list_calendar_events
+    now = datetime.now(JST)
+    day_end = now.replace(hour=23, minute=59, second=59, microsecond=0)
+    result = list_calendar_events(time_min=now.isoformat(), time_max=day_end.isoformat())
+    if "error" in result:
+        return result
+    return [
+        {
+            "summary": e.get("summary", "(無題)"),
+            "start": e.get("start", {}).get("dateTime") or e.get("start", {}).get("date"),
+            "end": e.get("end", {}).get("dateTime") or e.get("end", {}).get("date"),
+            "location": e.get("location", "")
+        }
+        for e in result.get("events", [])
+    ]
+
+
+def _fetch_tasks():
+    """Open Google Tasks"""
+    from tools.google_ops import list_tasks
+    result = list_tasks()
+    if "error" in result:
+        return result
+    return [
+        {"title": t.get("title", ""), "due": t.get("due", "")}
+        for t in result.get("tasks", []) if t.get("title")
+    ]
+
+
+def _fetch_notion(databases):
+    """Today's tasks from each configured Notion database"""
+    from tools.notion_ops import list_notion_tasks
+    notion = {}
+    for db in databases:
+        if not db.get("id"):
+            continue
+        result = list_notion_tasks(db["id"], filter_today=True)
+        name = db.get("name") or db["id"]
+        if "error" in result:
+            notion[name] = {"error": result["error"]}
+        else:
+            notion[name] = [
+                {"title": t["title"], "status": t["status"], "due_date": t["due_date"]}
+                for t in result.get("tasks", [])
+            ]
+    return notion
+
+
+def _fetch_weather(location):
+    from tools.weather import get_current_weather
+    return get_current_weather(location)
+
+
+def _call(fn, *args):
+    """Run one source fetch; failures become an error entry instead of aborting the briefing"""
+    try:
+        return fn(*args)
+    except Exception as e:
+        print(f"Briefing fetch error ({fn.__name__}): {e}", file=sys.stderr)
+        return {"error": str(e)}
+
+
+def gather_context(locations, config=None):
+    """
+    Fetch every source in parallel.
+    Calendar, Tasks and Notion are shared, so they are fetched once; weather once per location.
+    Returns {location: context}.
+    """
+    if config is None:
+        from utils.sheets_config import load_config
+        config = load_config()
+
+    locations = sorted(set(locations))
+    with ThreadPoolExecutor(max_workers=BRIEFING_MAX_WORKERS) as executor:
+        events = executor.submit(_call, _fetch_events)
+        tasks = executor.submit(_call, _fetch_tasks)
+        notion = executor.submit(_call, _fetch_notion, config.get("notion_databases", []))
+        weather = {loc: executor.submit(_call, _fetch_weather, loc) for loc in locations}
+
+        fetched_at = time.time()
+        shared = {"events": events.result(), "tasks": tasks.result(), "notion": notion.result()}
+        return {
+            loc: {"fetched_at": fetched_at, "weather": future.result(), **shared}
+            for loc, future in weather.items()
+        }
+
+
+def prefetch_briefings(users, config=None):
+    """Gather and keep the context for the given users' locations (scheduler job)"""
+    if not users:
+        return
+    started = time.time()
+    contexts = gather_context([u.get("location") or "Tokyo" for u in users], config)
+    with _contexts_lock:
+        _contexts.update(contexts)
+    print(f"Briefing: prefetched {len(contexts)} location(s) in {time.time() - started:.1f}s", file=sys.stderr)
+
+
+def get_context(location, config=None):
+    """The prefetched context for a location, gathered now if it is missing or stale"""
+    location = location or "Tokyo"
+    with _contexts_lock:
+        context = _contexts.get(location)
+    if context and time.time() - context["fetched_at"] <= BRIEFING_CONTEXT_TTL:
+        return context
+
+    context = gather_context([location], config)[location]
+    with _contexts_lock:
+        _contexts[location] = context
+    return context
+
+
+def build_prompt(location, reminder, context):
+    """The reminder prompt with all data embedded (same 3-section "@@@" format)"""
+    data = {k: v for k, v in context.items() if k != "fetched_at"}
+    return (
+        f"今日の{location}の{reminder.get('prompt')}\n"
+        "以下は取得済みの最新データです。ツールは使わず、このデータだけを元に答えてください。\n"
+        f"```json\n{json.dumps(data, ensure_ascii=False, indent=1)}\n```\n"
+        "（events=今日のカレンダー予定、tasks=Google ToDo、notion=Notionの今日のタスク。"
+        "errorがある項目は取得できなかったことを一言添えてください）\n"
+        "【重要】以下の3つのセクションに分けて、それぞれの間に「@@@」という区切り文字を入れて出力してください。\n"
+        "1. 天気に関する情報\n"
+        "2. スケジュール・タスクに関する情報\n"
+        "3. 気の利いた一言メッセージ"
+    )
+
+
+def compose_briefing(user_id, location, reminder, config=None):
+    """Build the reminder text with one LLM call"""
+    from core.agent import get_gemini_text_response
+    if config is None:
+        from utils.sheets_config import load_config
+        config = load_config()
+    context = get_context(location, config)
+    return get_gemini_text_response(user_id, build_prompt(location, reminder, context), config)
@@ -0,0 +1,202 @@
+"""
+Background Jobs
+Long-running agent work (currently the maker) runs off the request thread as a tracked job.
+The user gets a job ID immediately; progress and the final result are pushed over LINE.
+Jobs are recorded in SQLite so the dashboard can list them and a restart can mark
+interrupted ones as failed.
+"""
+import os
+import sys
+import time
+import uuid
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.local_db import get_connection
+
+DB_NAME = "jobs.db"
+
+# Maker jobs running at once in this process; the rest wait in the queue
+MAKER_MAX_CONCURRENT_JOBS = int(os.environ.get('MAKER_MAX_CONCURRENT_JOBS', 2))
+# Queued + running jobs one user may have before new requests are refused
+MAKER_MAX_JOBS_PER_USER = int(os.environ.get('MAKER_MAX_JOBS_PER_USER', 3))
+
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            kind TEXT,
+            request TEXT,
+            status TEXT,
+            progress TEXT,
+            result TEXT,
+            error TEXT,
+            owner TEXT,
+            created_at REAL,
+            updated_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, created_at);
+"""
+
+ACTIVE_STATUSES = ("queued", "running")
+_ACTIVE_PLACEHOLDERS = ", ".join("?" for _ in ACTIVE_STATUSES)
+
+_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+_executor = ThreadPoolExecutor(max_workers=max(1, MAKER_MAX_CONCURRENT_JOBS), thread_name_prefix="maker-job")
+_notify = None
+_recovered = False
+_recover_lock = threading.Lock()
+
+
+def _get_db():
+    conn = get_connection(DB_NAME, SCHEMA)
+    _recover_interrupted(conn)
+    return conn
+
+
+def _owner_alive(owner):
+    """Whether the process that took a job still exists (only checkable on this host)"""
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _recover_interrupted(conn):
+    """Once per process: jobs left active by a process that has since died are marked failed"""
+    global _recovered
+    if _recovered:
+        return
+    with _recover_lock:
+        if _recovered:
+            return
+        _recovered = True
+        stale = [
+            row["id"] for row in conn.execute(
+                f"SELECT id, owner FROM jobs WHERE status IN ({_ACTIVE_PLACEHOLDERS})", ACTIVE_STATUSES
+            )
+            if row["owner"] != _OWNER and not _owner_alive(row["owner"])
+        ]
+        with conn:
+            for job_id in stale:
+                conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                    ("interrupted by restart", time.time(), job_id)
+                )
+        if stale:
+            print(f"Jobs: marked {len(stale)} interrupted job(s) as failed", file=sys.stderr)
+
+
+def _update(job_id, **fields):
+    fields["updated_at"] = time.time()
+    conn = _get_db()
+    with conn:
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+            (*fields.values(), job_id)
+        )
+
+
+def _push(user_id, text):
+    if _notify is None or not user_id:
+        print(f"Jobs: no notifier or user, dropping message for {(user_id or '')[:8]}", file=sys.stderr)
+        return
+    try:
+        _notify(user_id, text)
+    except Exception as e:
+        print(f"Jobs: push failed: {e}", file=sys.stderr)
+
+
+def set_notifier(fn):
+    """fn(user_id, text) delivers a message to the user (LINE push in app.py)"""
+    global _notify
+    _notify = fn
+
+
+def _run_maker(job_id, user_id, user_request):
+    from core.maker import maker
+
+    _update(job_id, status="running", progress="開始しました")
+    # Only the first milestone after planning is pushed; the rest just update the job row
+    pushed = []
+
+    def progress(stage, message):
+        _update(job_id, progress=message)
+        if stage == "summarizing" and not pushed:
+            pushed.append(stage)
+            _push(user_id, f"📝 {message}…（ジョブ {job_id}）")
+
+    try:
+        result = maker.build(user_request, progress=progress)
+    except Exception as e:
+        result = {"error": f"資料作成中にエラーが発生しました: {str(e)}"}
+
+    if result.get("error"):
+        print(f"Maker job {job_id} failed: {result['error']}", file=sys.stderr)
+        _update(job_id, status="failed", error=result["error"], progress=None)
+        _push(user_id, f"ごめんなさい、資料を作れませんでした…😢\n{result['error']}")
+        return
+
+    _update(job_id, status="done", result=result.get("url"), progress=None)
+    _push(user_id, f"フミさんから届きました！👩‍💻\n\n{result['report']}")
+
+
+def submit_maker_job(user_id, user_request):
+    """Queue a maker job; returns {"job_id", "status", "position"} or {"error"}"""
+    conn = _get_db()
+    active = conn.execute(
+        f"SELECT COUNT(*) AS n FROM jobs WHERE user_id = ? AND status IN ({_ACTIVE_PLACEHOLDERS})",
+        (user_id, *ACTIVE_STATUSES)
+    ).fetchone()["n"]
+    if active >= MAKER_MAX_JOBS_PER_USER:
+        return {"error": f"作成中の資料が{active}件あります。完成してからもう一度お願いします"}
+
+    job_id = uuid.uuid4().hex[:8]
+    now = time.time()
+    with conn:
+        conn.execute(
+            "INSERT INTO jobs (id, user_id, kind, request, status, owner, created_at, updated_at) "
+            "VALUES (?, ?, 'maker', ?, 'queued', ?, ?, ?)",
+            (job_id, user_id, user_request, _OWNER, now, now)
+        )
+    position = conn.execute(
+        f"SELECT COUNT(*) AS n FROM jobs WHERE owner = ? AND status IN ({_ACTIVE_PLACEHOLDERS})",
+        (_OWNER, *ACTIVE_STATUSES)
+    ).fetchone()["n"]
+
+    _executor.submit(_run_maker, job_id, user_id, user_request)
+    print(f"Jobs: queued maker job {job_id} for {(user_id or '')[:8]}", file=sys.stderr)
+    return {"job_id": job_id, "status": "queued", "position": position}
+
+
+def _row_to_dict(row):
+    job = dict(row)
+    job.pop("owner", None)
+    return job
+
+
+def get_job(job_id):
+    """One job as a dict, or None"""
+    row = _get_db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _row_to_dict(row) if row else None
+
+
+def list_jobs(user_id=None, status=None, limit=50):
+    """Most recent jobs first, optionally filtered by user and status"""
+    query, params = "SELECT * FROM jobs WHERE 1 = 1", []
+    if user_id:
+        query += " AND user_id = ?"
+        params.append(user_id)
+    if status:
+        query += " AND status = ?"
+        params.append(status)
+    query += " ORDER BY created_at DESC LIMIT ?"
+    params.append(int(limit))
+    return [_row_to_dict(row) for row in _get_db().execute(query, params)]
@@ -1,13 +1,137 @@
 """
 Maker Agent (The Writer)
 Specialized in creating documents (Docs, Slides, Spreadsheets) by researching Google Drive.
+It only creates files; organizing Drive (folders, moves) is done by the main agent's tools.
+
+Pipeline: plan (one LLM call: search queries / file IDs / output type) -> research
+(all searches, then all reads, concurrently; text goes into a bounded working set) ->
+map-reduce (long sources are chunked and summarized in parallel with a cheaper model until
+they fit the token budget) -> synthesis (one LLM call) -> create the file.
 """
 import os
 import sys
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import google.generativeai as genai
-from tools.google_ops import search_drive, read_drive_file, create_google_doc, create_google_sheet, create_google_slide, move_drive_file, create_drive_folder
+from tools.google_ops import search_drive, read_drive_file, create_google_doc, create_google_sheet, create_google_slide
 from utils.sheets_config import load_config
+from utils.text import estimate_tokens, truncate_to_tokens
+
+# Research limits
+MAKER_MAX_QUERIES = int(os.environ.get('MAKER_MAX_QUERIES', 4))
+MAKER_MAX_SOURCES = int(os.environ.get('MAKER_MAX_SOURCES', 6))
+MAKER_SOURCE_MAX_CHARS = int(os.environ.get('MAKER_SOURCE_MAX_CHARS', 50000))
+# Raw source text collected before summarization
+MAKER_WORKING_SET_CHARS = int(os.environ.get('MAKER_WORKING_SET_CHARS', 200000))
+MAKER_MAX_WORKERS = int(os.environ.get('MAKER_MAX_WORKERS', 6))
+
+# Source material handed to the synthesis call (estimated tokens); longer sources are map-reduced
+MAKER_CONTEXT_TOKENS = int(os.environ.get('MAKER_CONTEXT_TOKENS', 30000))
+MAKER_CHUNK_CHARS = int(os.environ.get('MAKER_CHUNK_CHARS', 8000))
+MAKER_SUMMARY_MODEL = os.environ.get('MAKER_SUMMARY_MODEL', 'gemini-1.5-flash-8b')
+
+# Files read_drive_file can extract text from
+READABLE_MIME_TYPES = {
+    'application/vnd.google-apps.document',
+    'application/pdf',
+    'text/plain',
+}
+
+DEFAULT_MAKER_PROMPT = """
+        あなたは「フミ (Fumi)」です。資料作成の専門家として振る舞ってください。
+        ユーザーの依頼に基づき、Google Drive内の情報を調査し、高品質なドキュメントを作成します。
+
+        【注意】
+        - 嘘の情報（ハルシネーション）を書かないでください。ドライブにない情報は「不明」としてください。
+        - ファイルを作成する際は、適切なタイトルを付けてください。
+        """
+
+PLAN_PROMPT = """
+{persona}
+
+以下の依頼に必要な調査計画をJSONで出力してください。
+- queries: Google Driveのファイル名検索に使う短いキーワード（最大{max_queries}個、不要なら空配列）
+- file_ids: 依頼文に含まれるファイルIDやURLから分かるID（なければ空配列）
+- output: 作成するファイルの種類 "doc"、"sheet" または "slides"
+- title: 作成するファイルのタイトル
+
+出力形式: {{"queries": [], "file_ids": [], "output": "doc", "title": ""}}
+
+【依頼】
+{request}
+"""
+
+SYNTHESIS_PROMPT = """
+{persona}
+
+【依頼】
+{request}
+
+【調査した資料】
+{sources}
+
+上記の資料だけを根拠に、依頼に沿った{output_label}を作成してください。
+JSONで出力してください: {output_format}
+"""
+
+SUMMARY_PROMPT = """
+以下は資料「{title}」の{part}です。
+次の依頼に関係する事実・数値・日付・固有名詞を漏らさず、{max_chars}文字以内で要約してください。
+依頼に関係しない部分は省いてください。要約のみを出力してください。
+
+【依頼】
+{request}
+
+【資料】
+{text}
+"""
+
+OUTPUT_FORMATS = {
+    "doc": ("ドキュメント", '{"title": "タイトル", "content": "本文（Markdown: # 見出し、- 箇条書き、1. 番号付き、| 表 |、**強調**）"}'),
+    "sheet": ("スプレッドシート", '{"title": "タイトル", "sheets": [{"name": "シート名", "rows": [["見出し1", "見出し2"], ["値", "値"]]}]}'),
+    "slides": ("スライド", '{"title": "タイトル", "content": "Markdown（「## 見出し」ごとに1枚、その下に- 箇条書き）"}'),
+}
+
+
+class _WorkingSet:
+    """Source texts in arrival order, capped at a total character budget"""
+    def __init__(self, budget):
+        self.remaining = budget
+        self.sources = []
+
+    @property
+    def full(self):
+        return self.remaining <= 0
+
+    def add(self, title, text, truncated=False):
+        if self.full or not text:
+            return
+        if len(text) > self.remaining:
+            text, truncated = text[:self.remaining], True
+        self.remaining -= len(text)
+        self.sources.append({"title": title, "text": text, "truncated": truncated, "summarized": False})
+
+    def render(self):
+        if not self.sources:
+            return "（関連資料は見つかりませんでした）"
+        return "\n\n".join(
+            f"### {s['title']}{'（要約）' if s['summarized'] else ''}{'（一部のみ）' if s['truncated'] else ''}\n{s['text']}"
+            for s in self.sources
+        )
+
+
+def _split_chunks(text, size):
+    """Split into chunks of about `size` chars, preferring line breaks"""
+    chunks = []
+    while len(text) > size:
+        cut = text.rfind('\n', size // 2, size)
+        cut = cut if cut > 0 else size
+        chunks.append(text[:cut])
+        text = text[cut:]
+    if text.strip():
+        chunks.append(text)
+    return chunks
+
 
 class MakerAgent:
     def __init__(self):
@@ -15,67 +139,197 @@ class MakerAgent:
         self.api_key = os.environ.get("GEMINI_API_KEY")
         if self.api_key:
             genai.configure(api_key=self.api_key)
-            
-        # Define the specific tools for this agent
-        self.tools = [search_drive, read_drive_file, create_google_doc, create_google_sheet, create_google_slide, move_drive_file, create_drive_folder]
-        
-        self.model = genai.GenerativeModel(
-            model_name=self.model_name,
-            tools=self.tools
-        )
-        
-    def run(self, user_request: str, chat_history: list = None) -> str:
+
+        # Plan and synthesis are plain JSON calls; tools run in code, not via function calling
+        self.model = genai.GenerativeModel(model_name=self.model_name)
+        # Cheaper model for the map-reduce summaries
+        self.summary_model = genai.GenerativeModel(model_name=MAKER_SUMMARY_MODEL)
+
+    def _generate_json(self, prompt: str) -> dict:
+        from core.agent import gemini_slot
+        with gemini_slot(background=True):
+            response = self.model.generate_content(
+                prompt,
+                generation_config={"response_mime_type": "application/json"}
+            )
+        return json.loads(response.text)
+
+    def _plan(self, persona: str, user_request: str) -> dict:
+        try:
+            plan = self._generate_json(PLAN_PROMPT.format(
+                persona=persona, request=user_request, max_queries=MAKER_MAX_QUERIES
+            ))
+        except Exception as e:
+            print(f"Maker plan error: {e}", file=sys.stderr)
+            plan = {}
+        return {
+            "queries": [q for q in plan.get("queries", []) if isinstance(q, str) and q.strip()][:MAKER_MAX_QUERIES],
+            "file_ids": [f for f in plan.get("file_ids", []) if isinstance(f, str) and f.strip()],
+            "output": plan.get("output") if plan.get("output") in OUTPUT_FORMATS else "doc",
+            "title": plan.get("title") or "資料",
+        }
+
+    def _research(self, plan: dict) -> _WorkingSet:
+        """Run all searches, then all reads, concurrently; stop reading once the budget is used"""
+        working_set = _WorkingSet(MAKER_WORKING_SET_CHARS)
+
+        with ThreadPoolExecutor(max_workers=MAKER_MAX_WORKERS) as executor:
+            # 1. Searches (results kept in query order so the first query ranks first)
+            searches = [executor.submit(search_drive, q) for q in plan["queries"]]
+            file_ids = list(plan["file_ids"])
+            for future in searches:
+                result = future.result()
+                if result.get("error"):
+                    print(f"Maker search error: {result['error']}", file=sys.stderr)
+                    continue
+                files = sorted(
+                    (f for f in result.get("files", []) if f.get("mimeType") in READABLE_MIME_TYPES),
+                    key=lambda f: f.get("modifiedTime", ""), reverse=True
+                )
+                file_ids.extend(f["id"] for f in files)
+            file_ids = list(dict.fromkeys(file_ids))[:MAKER_MAX_SOURCES]
+
+            # 2. Reads (each capped; the working set takes them as they finish)
+            per_source = min(MAKER_SOURCE_MAX_CHARS, MAKER_WORKING_SET_CHARS)
+            reads = {executor.submit(read_drive_file, fid, per_source): fid for fid in file_ids}
+            for future in as_completed(reads):
+                result = future.result()
+                if result.get("error"):
+                    print(f"Maker read error ({reads[future]}): {result['error']}", file=sys.stderr)
+                    continue
+                working_set.add(result.get("title", reads[future]), result.get("content", ""), result.get("truncated", False))
+                if working_set.full:
+                    for pending in reads:
+                        pending.cancel()
+                    break
+
+        print(f"Maker: {len(working_set.sources)} sources from {len(file_ids)} candidates", file=sys.stderr)
+        return working_set
+
+    def _summarize(self, title: str, part: str, text: str, user_request: str, limit: int) -> str:
+        """Summary of at most limit estimated tokens"""
+        from core.agent import gemini_slot
+        # The model counts characters; one Japanese character is one estimated token, so asking
+        # for `limit` characters is the safe side. The cut enforces the budget if it overshoots.
+        with gemini_slot(background=True):
+            response = self.summary_model.generate_content(SUMMARY_PROMPT.format(
+                title=title, part=part, text=text, request=user_request, max_chars=limit
+            ))
+        return truncate_to_tokens(response.text.strip(), limit)
+
+    def _reduce_sources(self, working_set: _WorkingSet, user_request: str):
+        """
+        Fit the working set into MAKER_CONTEXT_TOKENS.
+        Short sources are kept verbatim; long ones get an equal share of what is left.
+        Map: their chunks are summarized in parallel. Reduce: a source whose joined chunk
+        summaries still exceed its share is summarized once more.
+        """
+        sources = working_set.sources
+        tokens = {id(s): estimate_tokens(s["text"]) for s in sources}
+        if not sources or sum(tokens.values()) <= MAKER_CONTEXT_TOKENS:
+            return
+
+        fair_share = MAKER_CONTEXT_TOKENS // len(sources)
+        long_sources = [s for s in sources if tokens[id(s)] > fair_share]
+        kept = sum(tokens[id(s)] for s in sources if tokens[id(s)] <= fair_share)
+        share = max(200, (MAKER_CONTEXT_TOKENS - kept) // len(long_sources))
+
+        def summarize_or_trim(source, part, text, limit):
+            try:
+                return self._summarize(source["title"], part, text, user_request, limit)
+            except Exception as e:
+                print(f"Maker summary error ({source['title']}): {e}", file=sys.stderr)
+                return truncate_to_tokens(text, limit)
+
+        with ThreadPoolExecutor(max_workers=MAKER_MAX_WORKERS) as executor:
+            # Map
+            jobs = {}
+            for source in long_sources:
+                chunks = _split_chunks(source["text"], MAKER_CHUNK_CHARS)
+                limit = max(100, share // len(chunks))
+                jobs[id(source)] = [
+                    executor.submit(summarize_or_trim, source, f"一部（{i + 1}/{len(chunks)}）", chunk, limit)
+                    for i, chunk in enumerate(chunks)
+                ]
+            for source in long_sources:
+                source["text"] = "\n".join(f.result() for f in jobs[id(source)])
+                source["summarized"] = True
+
+            # Reduce
+            over = [s for s in long_sources if estimate_tokens(s["text"]) > share * 1.2]
+            reduced = {id(s): executor.submit(summarize_or_trim, s, "各部分の要約", s["text"], share) for s in over}
+            for source in over:
+                source["text"] = reduced[id(source)].result()
+
+        total = sum(estimate_tokens(s["text"]) for s in sources)
+        print(f"Maker: map-reduced {len(long_sources)} sources to ~{total} tokens (budget {MAKER_CONTEXT_TOKENS})", file=sys.stderr)
+
+    def _create(self, output: str, draft: dict, fallback_title: str) -> dict:
+        title = draft.get("title") or fallback_title
+        if output == "sheet":
+            def clean(rows):
+                return [[str(c) for c in row] for row in rows or [] if isinstance(row, list)]
+            sheets = [
+                {"name": str(sheet.get("name")), "rows": clean(sheet.get("rows"))}
+                for sheet in draft.get("sheets", []) if isinstance(sheet, dict) and sheet.get("name")
+            ]
+            return create_google_sheet(title, clean(draft.get("rows")) or None, sheets)
+        if output == "slides":
+            return create_google_slide(title, draft.get("content", ""))
+        return create_google_doc(title, draft.get("content", ""))
+
+    def build(self, user_request: str, progress=None) -> dict:
         """
-        Execute the maker task.
-        In a real agentic loop, this would run multiple turns (Search -> Read -> Write).
-        For now, we use Gemini's automatic function calling (if available in the library version) 
-        or a simple ReAct loop. 
-        Given the current simple implementation of `agent.py`, we'll try to use the model's auto-tool-use capability.
+        Execute the maker task: plan -> concurrent research -> map-reduce -> one synthesis call -> create.
+        progress(stage, message) is called as each stage starts.
+        Returns {"success", "title", "url", "sources", "report"} or {"error"}.
         """
         print(f"Maker: Starting with request: {user_request}", file=sys.stderr)
-        
+        progress = progress or (lambda stage, message: None)
+
         config = load_config()
         # Allow user to customize the persona via config
-        system_instruction = config.get('maker_prompt', """
-        あなたは「フミ (Fumi)」です。資料作成の専門家として振る舞ってください。
-        ユーザーの依頼に基づき、Google Drive内の情報を調査し、高品質なドキュメントを作成します。
-        
-        【利用可能なツール】
-        - search_drive(query): ファイルを検索します。
-        - read_drive_file(file_id): ファイルの中身（テキスト）を読み込みます。
-        - create_google_doc(title, content): Googleドキュメントを作成します。
-        
-        【プロセス】
-        1. 必要な情報が足りない場合は、まず `search_drive` で関連資料を探してください。
-        2. 見つかった資料の `file_id` を使って `read_drive_file` で内容を確認してください。
-        3. 集めた情報を整理・要約し、ユーザーの依頼に沿ったドキュメントを作成してください。
-        4. 作成が完了したら、その旨とドキュメントのURLを報告してください。
-        
-        【注意】
-        - 嘘の情報（ハルシネーション）を書かないでください。ドライブにない情報は「不明」としてください。
-        - ファイルを作成する際は、適切なタイトルを付けてください。
-        """)
-        
-        # Start a chat session with the system instruction
-        # Note: 'system_instruction' param is supported in newer SDKs. 
-        # If not, we prepend it to history.
-        
-        history = []
-        history.append({"role": "user", "parts": [system_instruction]})
-        history.append({"role": "model", "parts": ["了解しました。私はMakerとして、ドライブの情報を活用しドキュメント作成を行います。"]})
-        
-        if chat_history:
-            # Append recent context if needed (simplified)
-            pass
-            
-        chat = self.model.start_chat(history=history, enable_automatic_function_calling=True)
-        
+        persona = config.get('maker_prompt') or DEFAULT_MAKER_PROMPT
+
         try:
-            response = chat.send_message(user_request)
-            return response.text
+            progress("planning", "調査の計画を立てています")
+            plan = self._plan(persona, user_request)
+            progress("research", "ドライブの資料を集めています")
+            working_set = self._research(plan)
+            progress("summarizing", f"資料{len(working_set.sources)}件を読み込みました。内容を整理しています")
+            self._reduce_sources(working_set, user_request)
+
+            progress("writing", "資料を執筆しています")
+            output_label, output_format = OUTPUT_FORMATS[plan["output"]]
+            draft = self._generate_json(SYNTHESIS_PROMPT.format(
+                persona=persona,
+                request=user_request,
+                sources=working_set.render(),
+                output_label=output_label,
+                output_format=output_format
+            ))
+
+            result = self._create(plan["output"], draft, plan["title"])
+            if result.get("error"):
+                return {"error": f"ファイル作成中にエラーが発生しました: {result['error']}"}
+
+            sources = [s["title"] for s in working_set.sources]
+            report = f"「{result.get('title')}」を作成しました！\n{result.get('url', '')}"
+            if sources:
+                report += "\n\n参考にした資料:\n" + "\n".join(f"・{t}" for t in sources)
+            return {"success": True, "title": result.get("title"), "url": result.get("url"),
+                    "sources": sources, "report": report}
+
         except Exception as e:
             print(f"Maker Execution Error: {e}", file=sys.stderr)
-            return f"申し訳ありません、資料作成中にエラーが発生しました: {str(e)}"
+            return {"error": f"資料作成中にエラーが発生しました: {str(e)}"}
+
+    def run(self, user_request: str) -> str:
+        """Execute the maker task synchronously and return the report text"""
+        result = self.build(user_request)
+        if result.get("error"):
+            return f"申し訳ありません、{result['error']}"
+        return result["report"]
 
 # Singleton
 maker = MakerAgent()
@@ -5,6 +5,7 @@ Analyzes conversation history to build and update the user's psychological profi
 import os
 import json
 import sys
+import time
 from datetime import datetime
 from typing import Dict, List, Optional
 import google.generativeai as genai
@@ -18,7 +19,6 @@ import google.generativeai as genai
 # So let's double check if I need to change import. 
 # The log warning says "Please switch to `google.genai` package".
 # For now, I'll ignore the warning and rely on logic fix. 
-from utils.vector_store import _get_index, GeminiEmbedder
 
 # Configure Gemini
 api_key = os.environ.get("GEMINI_API_KEY")
@@ -27,74 +27,85 @@ if api_key:
 
 PROFILE_FILE = "user_profile_data.json"
 
+# Bounds on what one nightly run sends for analysis; anything beyond waits for the next run
+PROFILER_BATCH_MESSAGES = int(os.environ.get('PROFILER_BATCH_MESSAGES', 200))
+PROFILER_BATCH_CHARS = int(os.environ.get('PROFILER_BATCH_CHARS', 20000))
+PROFILER_MAX_BATCHES = int(os.environ.get('PROFILER_MAX_BATCHES', 3))
+
 class ProfilerAgent:
     def __init__(self):
         self.model = genai.GenerativeModel('gemini-2.0-flash-exp') # Use a smart model for analysis
         
     def run_analysis(self, user_id: str, days_back: int = 1) -> Dict:
-        """Analyze recent conversations and update profile"""
+        """
+        Analyze messages added since the last run and update the profile.
+        Reads the message journal from this user's watermark (the first run starts days_back
+        days ago), in batches of at most PROFILER_BATCH_MESSAGES / PROFILER_BATCH_CHARS and
+        PROFILER_MAX_BATCHES per run; the rest is picked up next time.
+        """
+        from utils.journal import get_watermark, set_watermark
         print(f"Profiler: Starting analysis for {user_id}...", file=sys.stderr)
-        
-        # 1. Fetch recent conversations from Pinecone
-        recent_logs = self._fetch_recent_logs(user_id, days_back)
-        if not recent_logs:
-            print("Profiler: No new logs to analyze.", file=sys.stderr)
-            return self._load_current_profile(user_id)
 
-        # 2. Load existing profile
+        watermark_key = f"profiler:{user_id}"
+        watermark = get_watermark(watermark_key)
+        since_ts = time.time() - days_back * 86400 if watermark is None else None
+        watermark = watermark or 0
+
         current_profile = self._load_current_profile(user_id)
-        
-        # 3. Generate analysis prompting
-        updated_profile = self._analyze_and_merge(current_profile, recent_logs)
-        
-        # 4. Save updated profile
-        self._save_profile(user_id, updated_profile)
-        
-        print("Profiler: Profile updated successfully.", file=sys.stderr)
+        if current_profile is None:
+            # Merging into {} and saving would overwrite the stored profile
+            raise RuntimeError("profile could not be loaded; user skipped until the next run")
+        updated_profile = current_profile
+        analyzed = 0
+        for _ in range(PROFILER_MAX_BATCHES):
+            # 1. Next batch of new messages from the journal
+            batch, last_id = self._fetch_recent_logs(user_id, watermark, since_ts)
+            if last_id is None:
+                break
+
+            # 2. Merge the batch into the profile; stop (and retry next run) if analysis fails
+            if batch:
+                merged = self._analyze_and_merge(updated_profile, batch)
+                if merged is None:
+                    break
+                updated_profile = merged
+                analyzed += len(batch)
+            watermark = last_id
+
+        if not analyzed:
+            print("Profiler: No new logs to analyze.", file=sys.stderr)
+        # 3. Save the profile first so a failed save re-analyzes the same messages next time
+        elif not self._save_profile(user_id, updated_profile):
+            print("Profiler: Profile save failed; watermark not advanced.", file=sys.stderr)
+            return current_profile
+
+        if watermark:
+            set_watermark(watermark_key, watermark)
+        if analyzed:
+            print(f"Profiler: Profile updated from {analyzed} messages.", file=sys.stderr)
         return updated_profile
 
-    def _fetch_recent_logs(self, user_id: str, days: int) -> List[str]:
-        """Fetch logs from vector store (mock implementation for creating the logic first)"""
-        # Note: Vector stores are optimized for semantic search, not time-based range queries usually.
-        # Ideally, we should fetch by metadata filter. 
-        # For Pinecone, we can filter by timestamp if stored as metadata number (not string).
-        # Since we stored timestamp as string ISO, range query is hard.
-        # Strategy: Fetch last N items or use a separate "recent_logs" buffer in Redis/File.
-        
-        # FOR NOW: Let's assume we fetch relevant memory summaries via vector search 
-        # on generic "personality" keywords to see what's new.
-        # OR better: The "Profiler" should ideally have access to raw logs.
-        # Since we are using Pinecone only, let's query for "私のこと" (About me) related topics.
-        
-        index = _get_index()
-        if not index: return []
-        
-        embedder = GeminiEmbedder()
-        # Use a safe query text. If empty, Pinecone errors.
-        query_text = "私について 好き 嫌い 考え 価値観"
-        vector = embedder.embed_text(query_text)
-        
-        # Check if vector is valid (non-zero) - though embed_text usually handles this.
-        # But if embedder fails, it might return None or list of zeros?
-        if not vector or all(v == 0 for v in vector):
-            print("Profiler Warning: Generated zero vector for query.", file=sys.stderr)
-            return []
-        
-        results = index.query(
-            vector=vector,
-            top_k=50, # Get plenty
-            filter={"user_id": user_id},
-            include_metadata=True
-        )
-        
-        logs = []
-        for match in results.matches:
-             if match.metadata and match.metadata.get('role') == 'user':
-                 text = match.metadata.get('text', '')
-                 # TODO: Filter strictly by date here if possible in python
-                 logs.append(text)
-                 
-        return logs
+    def _fetch_recent_logs(self, user_id: str, after_id: int, since_ts: Optional[float] = None):
+        """
+        Next batch of the user's messages after after_id, bounded by count and characters.
+        Returns (user message texts, last journal ID covered) - (.., None) when nothing is new.
+        """
+        from utils.journal import read_after
+        rows = read_after(user_id, after_id, since_ts=since_ts, limit=PROFILER_BATCH_MESSAGES)
+        if not rows:
+            return [], None
+
+        logs, chars, last_id = [], 0, None
+        for row in rows:
+            text = row["text"] or ""
+            if logs and chars + len(text) > PROFILER_BATCH_CHARS:
+                break
+            # Only the user's own words describe the user; model replies are skipped but covered
+            if row["role"] == "user" and text.strip():
+                logs.append(text[:PROFILER_BATCH_CHARS])
+                chars += len(text)
+            last_id = row["id"]
+        return logs, last_id
 
     def _analyze_and_merge(self, current_profile: Dict, logs: List[str]) -> Dict:
         """Ask Gemini to update the profile based on new logs"""
@@ -137,7 +148,9 @@ class ProfilerAgent:
         """
         
         try:
-            response = self.model.generate_content(prompt)
+            from core.agent import gemini_slot
+            with gemini_slot(background=True):
+                response = self.model.generate_content(prompt)
             text = response.text.strip()
             # Clean up markdown code blocks if present
             if "```json" in text:
@@ -151,17 +164,17 @@ class ProfilerAgent:
             return json.loads(text)
         except Exception as e:
             print(f"Profiler Logic Error: {e}", file=sys.stderr)
-            # Return current profile instead of crashing, so we don't wipe data
-            return current_profile
+            # None keeps the current profile (so we don't wipe data) and the watermark in place
+            return None
 
-    def _load_current_profile(self, user_id: str) -> Dict:
-        """Load from persistent vector store"""
+    def _load_current_profile(self, user_id: str) -> Optional[Dict]:
+        """Load from persistent vector store (None if it could not be read)"""
         from utils.vector_store import get_user_profile
         return get_user_profile(user_id)
 
-    def _save_profile(self, user_id: str, profile: Dict):
+    def _save_profile(self, user_id: str, profile: Dict) -> bool:
         """Save to persistent vector store"""
         from utils.vector_store import save_user_profile
-        save_user_profile(user_id, profile)
+        return save_user_profile(user_id, profile)
 
 profiler = ProfilerAgent()
@@ -26,9 +26,10 @@ SYSTEM_PROMPT = """あなたは「コト」という名前の秘書です。
 - 「ないと思います」「見つかりません」と言う前に、もう一度ツールで確認する（ハルシネーション禁止）
 - ファイル数や中身について聞かれたら、推測せずに必ず `search_drive` を実行する
 - 「フミさん」「資料作成」を頼まれたら、会話で「伝えておきます」と終わらせず、必ず `delegate_to_maker` ツールを実行する
+- `delegate_to_maker` はバックグラウンドで動く。ジョブIDを伝え、完成したらLINEで届くと案内する（同じ依頼を重ねて実行しない）
 
 【できること】
-- Googleドライブの検索 (作成や整理は `delegate_to_maker` を使う)
+- Googleドライブの検索・整理（整理は search_drive で探し、create_drive_folder / move_drive_file で自分で行う。資料作成は `delegate_to_maker`）
 - Gmailの確認・要約
 - Gmailの確認・要約
 - PDF読み取り・テキスト抽出
@@ -58,6 +59,7 @@ SYSTEM_PROMPT = """あなたは「コト」という名前の秘書です。
 - 「Notion完了」「ステータス更新」→ 必ず update_notion_task を呼び出す
 - 「Notionにタスク追加」「Notionに登録」→ 必ず create_notion_task を呼び出す
 - 「資料まとめて」「議事録要約」「リサーチして」→ delegate_to_maker を呼び出す
+- 「フォルダ整理」「ファイル移動」「重複整理して」→ search_drive で探してから create_drive_folder / move_drive_file を呼び出す（delegate_to_maker は資料を作るだけで整理はできない）
 
 ツールを呼び出さずに「検索結果」や「計算結果」を想像で答えることは絶対に禁止です。
 ツールの実行に失敗した場合は、正直に「エラーで実行できませんでした」と伝えてください。嘘の成功報告は禁止です。
@@ -79,8 +81,11 @@ SYSTEM_PROMPT = """あなたは「コト」という名前の秘書です。
 ❌ ユーザー:「資料探して」→ あなた:「見つかりました（嘘の報告）」
 ⭕ ユーザー:「資料探して」→ あなた: (即座に `search_drive` を実行) → 結果を見てから回答
 
-❌ ユーザー:「ふみさんに資料作成を頼んで」「重複整理して」→ あなた:「了解！伝えておきますね（終了）」
-⭕ ユーザー:「ふみさんに資料作成を頼んで」「重複整理して」→ あなた: (即座に `delegate_to_maker` を実行) → 結果を見てから回答
+❌ ユーザー:「ふみさんに資料作成を頼んで」→ あなた:「了解！伝えておきますね（終了）」
+⭕ ユーザー:「ふみさんに資料作成を頼んで」→ あなた: (即座に `delegate_to_maker` を実行) → 結果を見てから回答
+
+❌ ユーザー:「重複整理して」→ あなた: (`delegate_to_maker` を実行) → 整理ではなく資料ができてしまう
+⭕ ユーザー:「重複整理して」→ あなた: (即座に `search_drive` で探し、`move_drive_file` で移動) → 結果を見てから回答
 
 ユーザーからの依頼に対して、感想を言わずに**ツールで**対応してください。"""
 
@@ -164,7 +169,7 @@ TOOLS = [
             "type": "object",
             "properties": {
                 "title": {"type": "string", "description": "ドキュメントのタイトル"},
-                "content": {"type": "string", "description": "ドキュメントの内容"}
+                "content": {"type": "string", "description": "ドキュメントの内容（Markdown可: # 見出し、- 箇条書き、| 表 |）"}
             },
             "required": ["title"]
         }
@@ -186,7 +191,8 @@ TOOLS = [
         "parameters": {
             "type": "object",
             "properties": {
-                "title": {"type": "string", "description": "スライドのタイトル"}
+                "title": {"type": "string", "description": "スライドのタイトル"},
+                "content": {"type": "string", "description": "スライドの内容（Markdown: 「## 見出し」ごとに1枚、その下の箇条書きが本文）"}
             },
             "required": ["title"]
         }
@@ -198,6 +204,7 @@ TOOLS = [
             "type": "object",
             "properties": {
                 "folder_name": {"type": "string", "description": "作成するフォルダの名前"}
+            },
             "required": ["folder_name"]
         }
     },
@@ -232,7 +239,8 @@ TOOLS = [
                 "type": "object",
                 "properties": {
                     "query": {"type": "string", "description": "検索クエリ（例: is:unread, from:xxx）"},
-                    "max_results": {"type": "integer", "description": "取得件数"}
+                    "max_results": {"type": "integer", "description": "取得件数"},
+                    "incremental": {"type": "boolean", "description": "trueなら前回確認以降に届いた新着メールだけを返す（「新しいメール来てる？」など）"}
                 },
                 "required": []
             }
@@ -294,7 +302,11 @@ TOOLS = [
             "properties": {
                 "start_date": {"type": "string", "description": "検索開始日 (YYYY-MM-DD)"},
                 "end_date": {"type": "string", "description": "検索終了日 (YYYY-MM-DD)"},
-                "duration": {"type": "integer", "description": "確保したい時間（分）デフォルト60"}
+                "duration": {"type": "integer", "description": "確保したい時間（分）デフォルト60"},
+                "step_minutes": {"type": "integer", "description": "候補枠の刻み（分）。省略時は空いている時間帯をそのまま返す"},
+                "calendar_ids": {"type": "array", "items": {"type": "string"}, "description": "空き状況を確認するカレンダーID（メールアドレス）。複数指定でチーム全員の共通の空きを探す"},
+                "working_hours": {"type": "string", "description": "勤務時間テンプレート: standard(平日9-12,13-18) / office(平日9-18) / morning / afternoon / evening"},
+                "weekdays": {"type": "array", "items": {"type": "string"}, "description": "対象の曜日（例: [\"月\", \"水\"]）"}
             },
             "required": []
         }
@@ -364,11 +376,11 @@ TOOLS = [
     },
     {
         "name": "delegate_to_maker",
-        "description": "★必須ツール★ 「資料作成」「フォルダ整理」「リサーチ」の依頼が来たら、**絶対に**このツールを呼び出してください。会話だけで対応することは禁止です。このツールを実行することで、専門のエージェント（フミ）が作業を行います。",
+        "description": "★必須ツール★ 「資料作成」「リサーチしてまとめて」の依頼が来たら、**絶対に**このツールを呼び出してください。会話だけで対応することは禁止です。このツールを実行することで、専門のエージェント（フミ）がドライブを調べてドキュメント・スプレッドシート・スライドを作ります（ファイルの移動や整理はできません）。",
         "parameters": {
             "type": "object",
             "properties": {
-                "request": {"type": "string", "description": "依頼内容（例: 'kotoフォルダ内の重複ファイルを整理して'）"}
+                "request": {"type": "string", "description": "依頼内容（例: 'kotoフォルダの議事録から今月の決定事項をまとめて'）"}
             },
             "required": ["request"]
         }
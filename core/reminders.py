@@ -0,0 +1,332 @@
+"""
+Reminder Scheduler
+Each (user, reminder) is scheduled at its exact HH:MM (JST). Entries sharing a time are fired
+by one APScheduler job that fans out across users, plus one briefing prefetch job per time.
+Entries are diffed against config / user DB on refresh, and last-sent / next-run state is kept
+in SQLite so a restart neither misses nor repeats a reminder.
+"""
+import os
+import sys
+import time
+import threading
+from datetime import datetime, timezone, timedelta
+
+from utils.local_db import get_connection, get_state, set_state
+
+DB_NAME = "reminders.db"
+
+# A reminder missed by less than this (downtime, busy worker) is still sent (seconds)
+REMINDER_MISFIRE_GRACE = int(os.environ.get('REMINDER_MISFIRE_GRACE', 900))
+# How often jobs are re-synced with config and the user DB (minutes)
+REMINDER_REFRESH_MINUTES = int(os.environ.get('REMINDER_REFRESH_MINUTES', 10))
+# How often the leader checks for refresh requests from other workers (seconds)
+REMINDER_REFRESH_POLL_SECONDS = int(os.environ.get('REMINDER_REFRESH_POLL_SECONDS', 15))
+# Users delivered in parallel per slot, and how long one delivery may take (seconds)
+REMINDER_MAX_WORKERS = int(os.environ.get('REMINDER_MAX_WORKERS', 4))
+REMINDER_SEND_TIMEOUT = int(os.environ.get('REMINDER_SEND_TIMEOUT', 120))
+
+JST = timezone(timedelta(hours=9))
+
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS reminder_state (
+            job_id TEXT PRIMARY KEY,
+            next_run_ts REAL,
+            last_sent_ts REAL
+        );
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+_scheduler = None
+_send = None
+# entry_id -> {"user_id", "location", "reminder", "time", "signature"}
+_entries = {}
+_lock = threading.Lock()
+# When the last refresh started (compared against refresh requests from other workers)
+_refreshed_at = 0
+
+
+def _get_db():
+    return get_connection(DB_NAME, SCHEMA)
+
+
+def load_reminders(config):
+    """Reminder definitions from config (including the old single-reminder format)"""
+    reminders = config.get('reminders', [])
+
+    # Fallback for old format
+    if not reminders and config.get('reminder_time'):
+        reminders = [{
+            'name': '朝のリマインダー',
+            'time': config.get('reminder_time', '07:00'),
+            'prompt': config.get('reminder_prompt', '今日の天気と予定を教えて'),
+            'enabled': True
+        }]
+    return reminders
+
+
+def _parse_time(value):
+    """'HH:MM' -> (hour, minute); defaults to 07:00 like the old hourly check"""
+    try:
+        hour, _, minute = (value or '07:00').partition(':')
+        hour, minute = int(hour), int(minute or 0)
+        if 0 <= hour < 24 and 0 <= minute < 60:
+            return hour, minute
+    except ValueError:
+        pass
+    return 7, 0
+
+
+def _desired_entries(users, config):
+    entries = {}
+    reminders = load_reminders(config)
+    for user in users:
+        for i, reminder in enumerate(reminders):
+            if not reminder.get('enabled', True):
+                continue
+            # Keyed by name so editing the time keeps the entry (and its sent state)
+            key = reminder.get('name') or f"#{i}"
+            hour, minute = _parse_time(reminder.get('time'))
+            time_str = f"{hour:02d}:{minute:02d}"
+            entry_id = f"reminder:{user['user_id']}:{key}"
+            entries[entry_id] = {
+                "user_id": user['user_id'],
+                "location": user.get('location'),
+                "reminder": reminder,
+                "time": time_str,
+                "signature": (time_str, reminder.get('prompt'), user.get('location'))
+            }
+    return entries
+
+
+def _slot_ts(time_str, now=None):
+    """Epoch of the most recent scheduled occurrence of HH:MM (JST)"""
+    now = now or datetime.now(JST)
+    hour, minute = _parse_time(time_str)
+    slot = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if slot > now:
+        slot -= timedelta(days=1)
+    return slot.timestamp()
+
+
+def _store_next_run(conn, entry_id, time_str):
+    job = _scheduler.get_job(f"reminders:{time_str}")
+    next_run = getattr(job, 'next_run_time', None) if job else None
+    conn.execute(
+        "UPDATE reminder_state SET next_run_ts = ? WHERE job_id = ?",
+        (next_run.timestamp() if next_run else None, entry_id)
+    )
+
+
+def _claim(entry_id, slot_ts):
+    """Mark the slot as sent; False if it already was (another run got there first)"""
+    conn = _get_db()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO reminder_state (job_id) VALUES (?)", (entry_id,))
+        cur = conn.execute(
+            "UPDATE reminder_state SET last_sent_ts = ? WHERE job_id = ? AND COALESCE(last_sent_ts, 0) < ?",
+            (slot_ts, entry_id, slot_ts)
+        )
+        return cur.rowcount == 1
+
+
+def _run_slot(time_str, entry_ids=None, slot_ts=None):
+    """Scheduler entry point: deliver every reminder due at time_str, in parallel"""
+    from utils.fanout import fan_out
+
+    slot_ts = slot_ts or _slot_ts(time_str)
+    if entry_ids is None:
+        entry_ids = [entry_id for entry_id, e in _entries.items() if e["time"] == time_str]
+
+    due = []
+    for entry_id in entry_ids:
+        if entry_id not in _entries:
+            continue
+        if _claim(entry_id, slot_ts):
+            due.append(entry_id)
+        else:
+            print(f"Reminder {entry_id[:24]} already sent for this slot, skipping", file=sys.stderr)
+
+    if due:
+        def deliver(entry_id):
+            entry = _entries[entry_id]
+            _send(entry["user_id"], entry["location"], entry["reminder"])
+
+        fan_out(f"Reminders {time_str}", due, deliver,
+                max_workers=REMINDER_MAX_WORKERS, timeout=REMINDER_SEND_TIMEOUT)
+
+    conn = _get_db()
+    with conn:
+        for entry_id in due:
+            _store_next_run(conn, entry_id, time_str)
+
+
+def _run_prefetch(time_str):
+    """Prefetch briefing data for everyone with a reminder at time_str"""
+    try:
+        from core.briefing import prefetch_briefings
+        from utils.sheets_config import load_config
+        users = {e["user_id"]: e for e in _entries.values() if e["time"] == time_str}
+        prefetch_briefings([{"user_id": u, "location": e["location"]} for u, e in users.items()], load_config())
+    except Exception as e:
+        print(f"Briefing Prefetch Error: {e}", file=sys.stderr)
+
+
+def _scheduled_slot_times():
+    """Slot times with a delivery job (a persistent job store may hold some from a previous leader)"""
+    return {
+        job.id.split(':', 1)[1] for job in _scheduler.get_jobs()
+        if job.id.startswith('reminders:') and job.id.count(':') == 2
+    }
+
+
+def _sync_slot_jobs(times):
+    """One delivery job and one prefetch job per distinct reminder time"""
+    from apscheduler.triggers.cron import CronTrigger
+    from core.briefing import BRIEFING_LEAD_MINUTES
+
+    scheduled = _scheduled_slot_times()
+    for time_str in scheduled - times:
+        _scheduler.remove_job(f"reminders:{time_str}")
+        if _scheduler.get_job(f"briefing:{time_str}"):
+            _scheduler.remove_job(f"briefing:{time_str}")
+    for time_str in times - scheduled:
+        hour, minute = _parse_time(time_str)
+        _scheduler.add_job(
+            _run_slot, CronTrigger(hour=hour, minute=minute, timezone=JST),
+            args=[time_str], id=f"reminders:{time_str}", replace_existing=True,
+            misfire_grace_time=REMINDER_MISFIRE_GRACE, coalesce=True
+        )
+        at = datetime(2000, 1, 1, hour, minute) - timedelta(minutes=BRIEFING_LEAD_MINUTES)
+        _scheduler.add_job(
+            _run_prefetch, CronTrigger(hour=at.hour, minute=at.minute, timezone=JST),
+            args=[time_str], id=f"briefing:{time_str}", replace_existing=True
+        )
+
+
+def refresh(catch_up=False):
+    """
+    Diff reminder entries against config and the user DB: add new, reschedule changed, drop removed.
+    With catch_up, reminders whose persisted next run passed while we were down are sent now.
+    """
+    global _entries, _refreshed_at
+    if _scheduler is None:
+        return
+
+    from utils.sheets_config import load_config
+    from utils.user_db import get_active_users
+
+    with _lock:
+        _refreshed_at = time.time()
+        users = get_active_users()
+        if not users and _entries:
+            # get_active_users returns [] on sheet errors too; keep the current entries
+            print("Reminders: no active users returned, keeping existing reminders", file=sys.stderr)
+            return
+        desired = _desired_entries(users, load_config())
+
+        conn = _get_db()
+        with conn:
+            for entry_id in set(_entries) - set(desired):
+                conn.execute("DELETE FROM reminder_state WHERE job_id = ?", (entry_id,))
+
+            changed = [
+                entry_id for entry_id, entry in desired.items()
+                if entry_id not in _entries or _entries[entry_id]["signature"] != entry["signature"]
+            ]
+            previous = {
+                row["job_id"]: row for row in conn.execute("SELECT * FROM reminder_state")
+            }
+            _entries = desired
+            _sync_slot_jobs({entry["time"] for entry in desired.values()})
+
+            now = time.time()
+            missed = {}
+            for entry_id in changed:
+                time_str = desired[entry_id]["time"]
+                conn.execute("INSERT OR IGNORE INTO reminder_state (job_id) VALUES (?)", (entry_id,))
+
+                state = previous.get(entry_id)
+                missed_ts = state["next_run_ts"] if state else None
+                if catch_up and missed_ts and missed_ts <= now <= missed_ts + REMINDER_MISFIRE_GRACE \
+                        and (state["last_sent_ts"] or 0) < missed_ts:
+                    missed.setdefault((time_str, missed_ts), []).append(entry_id)
+                _store_next_run(conn, entry_id, time_str)
+
+        for (time_str, missed_ts), entry_ids in missed.items():
+            print(f"Reminders: catching up {len(entry_ids)} missed reminder(s) at {time_str}", file=sys.stderr)
+            _scheduler.add_job(
+                _run_slot, 'date', args=[time_str, entry_ids, missed_ts],
+                id=f"reminders:{time_str}:catchup", replace_existing=True
+            )
+
+        if changed or len(desired) != len(previous):
+            print(f"Reminders: {len(desired)} reminder(s), {len(changed)} (re)scheduled", file=sys.stderr)
+
+
+def request_refresh():
+    """
+    Ask for a refresh after a config save or user registration.
+    The request usually lands on a non-leader worker, where refresh() does nothing, so it is
+    also recorded in reminders.db; the leader polls that every REMINDER_REFRESH_POLL_SECONDS.
+    (Only processes sharing the data volume see it; others catch up on the interval refresh.)
+    """
+    conn = _get_db()
+    with conn:
+        set_state(conn, 'refresh_requested_at', str(time.time()))
+    if _scheduler is not None:
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+def _poll_refresh_requests():
+    """Leader job: refresh if another worker asked for it since the last refresh"""
+    from utils.sheets_config import CONFIG_CHECK_INTERVAL
+
+    requested_at = float(get_state(_get_db(), 'refresh_requested_at', 0) or 0)
+    # The leader's config cache may lag the saving worker by up to CONFIG_CHECK_INTERVAL,
+    # so keep refreshing until the request is older than that
+    if requested_at and requested_at > _refreshed_at - CONFIG_CHECK_INTERVAL:
+        refresh()
+
+
+def send_due(send_fn):
+    """
+    Send every reminder whose latest slot passed less than REMINDER_MISFIRE_GRACE ago and has
+    not been sent yet (manual /cron trigger). Safe from any worker sharing the leader's data/
+    directory: each slot is claimed in reminders.db first, so this and the leader's scheduled run
+    never both deliver it. Claims are local SQLite, so workers on other disks are unsupported
+    (as for leader election; see utils/leader.py).
+    Returns the number of reminders sent.
+    """
+    from utils.fanout import fan_out
+    from utils.sheets_config import load_config
+    from utils.user_db import get_active_users
+
+    entries = _desired_entries(get_active_users(), load_config())
+    now = time.time()
+    due = []
+    for entry_id, entry in entries.items():
+        slot_ts = _slot_ts(entry["time"])
+        if now - slot_ts <= REMINDER_MISFIRE_GRACE and _claim(entry_id, slot_ts):
+            due.append(entry_id)
+    if not due:
+        return 0
+
+    def deliver(entry_id):
+        entry = entries[entry_id]
+        send_fn(entry["user_id"], entry["location"], entry["reminder"])
+
+    summary = fan_out("Reminders (manual)", due, deliver,
+                      max_workers=REMINDER_MAX_WORKERS, timeout=REMINDER_SEND_TIMEOUT)
+    return summary["ok"]
+
+
+def init(scheduler, send_fn):
+    """Register reminder jobs on a started scheduler; send_fn(user_id, location, reminder) delivers one"""
+    global _scheduler, _send
+    _scheduler = scheduler
+    _send = send_fn
+    scheduler.add_job(refresh, trigger="interval", minutes=REMINDER_REFRESH_MINUTES,
+                      id="reminders:refresh", replace_existing=True)
+    scheduler.add_job(_poll_refresh_requests, trigger="interval", seconds=REMINDER_REFRESH_POLL_SECONDS,
+                      id="reminders:poll", replace_existing=True)
+    threading.Thread(target=refresh, kwargs={"catch_up": True}, daemon=True).start()
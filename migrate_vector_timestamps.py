@@ -0,0 +1,55 @@
+"""
+One-off migration: give existing conversation vectors numeric 'ts' metadata and
+msg:{user_id}:{epoch ms}:{role} IDs, so they are reachable by time-range queries.
+
+Old records ({user_id}_{iso timestamp}_{role}, ISO 'timestamp' only) are re-upserted under
+the new ID with 'ts' set, then deleted. Safe to re-run: migrated IDs are skipped.
+
+Usage: python migrate_vector_timestamps.py [--dry-run]
+"""
+from dotenv import load_dotenv
+import os
+import sys
+
+load_dotenv()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from utils.vector_store import _get_index, _to_epoch, message_id
+
+BATCH_SIZE = 100
+dry_run = "--dry-run" in sys.argv
+
+index = _get_index()
+if index is None:
+    print("Pinecone index not available (check PINECONE_API_KEY).")
+    sys.exit(1)
+
+print(f"Migrating vector timestamps{' (dry run)' if dry_run else ''}...")
+migrated = skipped = 0
+for ids in index.list():
+    legacy = [i for i in ids if not i.startswith(("msg:", "profile:"))]
+    skipped += len(ids) - len(legacy)
+    for start in range(0, len(legacy), BATCH_SIZE):
+        batch = legacy[start:start + BATCH_SIZE]
+        fetched = index.fetch(ids=batch).vectors
+
+        upserts, deletes = [], []
+        for old_id, record in fetched.items():
+            metadata = dict(record.metadata or {})
+            ts = _to_epoch(metadata.get("ts")) or _to_epoch(metadata.get("timestamp"))
+            if ts is None or not metadata.get("user_id"):
+                print(f"  skip {old_id}: no user_id / timestamp")
+                skipped += 1
+                continue
+            metadata["ts"] = ts
+            new_id = message_id(metadata["user_id"], ts, metadata.get("role", "unknown"))
+            upserts.append((new_id, record.values, metadata))
+            deletes.append(old_id)
+
+        if upserts and not dry_run:
+            index.upsert(vectors=upserts)
+            index.delete(ids=deletes)
+        migrated += len(upserts)
+        print(f"  {migrated} migrated so far")
+
+print(f"Done: {migrated} migrated, {skipped} skipped.")
@@ -5,7 +5,6 @@ import re
 import math
 import os
 import sys
-import tempfile
 from datetime import datetime, timedelta
 from googleapiclient.discovery import build
 from utils.auth import get_google_credentials
@@ -110,41 +109,26 @@ def calculate_date(operation, days=0, date_str=None):
         return {"error": f"日付計算エラー: {str(e)}"}
 
 
+# Characters of PDF text handed back to the model
+PDF_PREVIEW_CHARS = 10000
+
+
 def read_pdf_from_drive(file_id):
-    """Download and read PDF from Google Drive"""
+    """Download and read PDF from Google Drive (only the pages needed for the preview)"""
     try:
         if not PDF_AVAILABLE:
             return {"error": "PDF読み取り機能が利用できません"}
         
-        creds = get_google_credentials()
-        if not creds:
-            return {"error": "Google認証エラー"}
-        
-        drive_service = build('drive', 'v3', credentials=creds)
-        
-        # Download file
-        request = drive_service.files().get_media(fileId=file_id)
-        
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-            tmp.write(request.execute())
-            tmp_path = tmp.name
-        
-        # Read PDF
-        doc = fitz.open(tmp_path)
-        text = ""
-        page_count = len(doc)
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        
-        # Cleanup
-        os.unlink(tmp_path)
+        from tools.google_ops import read_drive_file
+        result = read_drive_file(file_id, max_chars=PDF_PREVIEW_CHARS)
+        if not result.get("success"):
+            return {"error": f"PDF読み取りエラー: {result.get('error', '')}"}
         
-        # Truncate if too long
-        if len(text) > 10000:
-            text = text[:10000] + "\n...(以下省略)"
+        text = result.get("content", "")
+        if result.get("truncated"):
+            text = text + "\n...(以下省略)"
         
-        return {"success": True, "text": text, "pages": page_count}
+        return {"success": True, "text": text, "pages": result.get("pages", 0)}
     except Exception as e:
         print(f"PDF error: {e}", file=sys.stderr)
         return {"error": f"PDF読み取りエラー: {str(e)}"}
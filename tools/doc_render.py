@@ -0,0 +1,268 @@
+"""
+Document rendering - Markdown-like text to Google Docs / Slides batchUpdate requests
+The whole body of a generated document is sent as one documents.batchUpdate (or one
+presentations.batchUpdate), so a rich document costs a constant number of API calls.
+For Docs it can also be rendered to HTML and uploaded with Drive conversion, so creating
+the file and its content is a single files.create.
+
+Supported Markdown: # headings (1-6), paragraphs, **bold**, - / * / 1. lists (nested by
+indent), and | pipe | tables |.
+"""
+import re
+import html
+
+_HEADING = re.compile(r'^(#{1,6})\s+(.*)$')
+_BULLET = re.compile(r'^(\s*)([-*+]|\d+[.)])\s+(.*)$')
+_TABLE_SEPARATOR = re.compile(r'^\|?\s*:?-{2,}:?\s*(\|\s*:?-{2,}:?\s*)*\|?$')
+_BOLD = re.compile(r'\*\*(.+?)\*\*')
+
+
+def _u16(text):
+    """Docs indices count UTF-16 code units (emoji take two)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _strip_bold(text):
+    """Remove ** markers; returns (plain text, [(start, end)] in UTF-16 units)"""
+    spans, plain, pos = [], [], 0
+    for match in _BOLD.finditer(text):
+        plain.append(text[pos:match.start()])
+        start = _u16(''.join(plain))
+        plain.append(match.group(1))
+        spans.append((start, _u16(''.join(plain))))
+        pos = match.end()
+    plain.append(text[pos:])
+    return ''.join(plain), spans
+
+
+def _split_row(line):
+    return [cell.strip() for cell in line.strip().strip('|').split('|')]
+
+
+def parse_markdown(text):
+    """
+    Split Markdown-like text into blocks:
+    {"type": "heading", "level", "text"} / {"type": "paragraph", "text"} /
+    {"type": "list", "ordered", "items": [(level, text)]} / {"type": "table", "rows"}
+    """
+    blocks = []
+    for raw in (text or '').replace('\r\n', '\n').split('\n'):
+        line = raw.rstrip()
+        last = blocks[-1] if blocks else None
+        if not line.strip():
+            blocks.append(None)  # blank line ends lists and tables
+            continue
+
+        heading = _HEADING.match(line.strip())
+        bullet = _BULLET.match(line)
+        if heading:
+            blocks.append({"type": "heading", "level": len(heading.group(1)), "text": heading.group(2).strip()})
+        elif line.strip().startswith('|'):
+            if _TABLE_SEPARATOR.match(line.strip()):
+                continue
+            if last and last["type"] == "table":
+                last["rows"].append(_split_row(line))
+            else:
+                blocks.append({"type": "table", "rows": [_split_row(line)]})
+        elif bullet:
+            indent = bullet.group(1).replace('\t', '  ')
+            ordered = bullet.group(2)[0].isdigit()
+            item = (min(len(indent) // 2, 8), bullet.group(3).strip())
+            if last and last["type"] == "list" and last["ordered"] == ordered:
+                last["items"].append(item)
+            else:
+                blocks.append({"type": "list", "ordered": ordered, "items": [item]})
+        else:
+            blocks.append({"type": "paragraph", "text": line.strip()})
+    return [b for b in blocks if b]
+
+
+def _text_block_requests(lines, style, bullets=None):
+    """
+    Requests that insert `lines` as paragraphs at index 1 and style them.
+    Blocks are inserted last-to-first at index 1, so each block sets its own paragraph
+    style and bullets explicitly instead of inheriting them from the paragraph after it.
+    """
+    plain_lines, bold = [], []
+    offset = 0
+    for line in lines:
+        plain, spans = _strip_bold(line)
+        bold.extend((offset + s, offset + e) for s, e in spans)
+        plain_lines.append(plain)
+        offset += _u16(plain) + 1
+    text = '\n'.join(plain_lines) + '\n'
+    end = 1 + _u16(text)
+
+    requests = [
+        {'insertText': {'location': {'index': 1}, 'text': text}},
+        {'updateTextStyle': {'range': {'startIndex': 1, 'endIndex': end},
+                             'textStyle': {'bold': False}, 'fields': 'bold'}},
+    ]
+    requests += [
+        {'updateTextStyle': {'range': {'startIndex': 1 + s, 'endIndex': 1 + e},
+                             'textStyle': {'bold': True}, 'fields': 'bold'}}
+        for s, e in bold if e > s
+    ]
+    requests.append({'updateParagraphStyle': {
+        'range': {'startIndex': 1, 'endIndex': end},
+        'paragraphStyle': {'namedStyleType': style}, 'fields': 'namedStyleType'
+    }})
+    if bullets:
+        # Leading tabs set the nesting level and are removed by the API
+        requests.append({'createParagraphBullets': {
+            'range': {'startIndex': 1, 'endIndex': end}, 'bulletPreset': bullets
+        }})
+    else:
+        requests.append({'deleteParagraphBullets': {'range': {'startIndex': 1, 'endIndex': end}}})
+    return requests
+
+
+def _table_requests(rows):
+    """
+    Requests that insert a filled table at index 1.
+    insertTable puts a newline before the table, so it starts at index 2; each row adds one
+    index and each cell two (cell start + its empty paragraph). Cells are filled last-to-first
+    so the computed indices stay valid.
+    """
+    cols = max(len(r) for r in rows)
+    rows = [r + [''] * (cols - len(r)) for r in rows]
+    table_start = 2
+
+    requests = [{'insertTable': {'rows': len(rows), 'columns': cols, 'location': {'index': 1}}}]
+    for r in reversed(range(len(rows))):
+        for c in reversed(range(cols)):
+            text, spans = _strip_bold(rows[r][c])
+            if not text:
+                continue
+            index = table_start + 3 + r * (1 + 2 * cols) + 2 * c
+            requests.append({'insertText': {'location': {'index': index}, 'text': text}})
+            # Header row in bold, plus any **bold** inside cells
+            for s, e in ([(0, _u16(text))] if r == 0 else spans):
+                requests.append({'updateTextStyle': {
+                    'range': {'startIndex': index + s, 'endIndex': index + e},
+                    'textStyle': {'bold': True}, 'fields': 'bold'
+                }})
+    return requests
+
+
+def docs_requests(markdown):
+    """Build the documents.batchUpdate requests that render `markdown` into an empty document"""
+    requests = []
+    for block in reversed(parse_markdown(markdown)):
+        if block["type"] == "heading":
+            requests += _text_block_requests([block["text"]], f"HEADING_{block['level']}")
+        elif block["type"] == "paragraph":
+            requests += _text_block_requests([block["text"]], 'NORMAL_TEXT')
+        elif block["type"] == "list":
+            lines = ['\t' * level + text for level, text in block["items"]]
+            preset = 'NUMBERED_DECIMAL_ALPHA_ROMAN' if block["ordered"] else 'BULLET_DISC_CIRCLE_SQUARE'
+            requests += _text_block_requests(lines, 'NORMAL_TEXT', bullets=preset)
+        elif block["type"] == "table":
+            requests += _table_requests(block["rows"])
+    return requests
+
+
+def _inline_html(text):
+    return _BOLD.sub(r'<b>\1</b>', html.escape(text, quote=False))
+
+
+def _list_html(items, tag):
+    """Nested <ul>/<ol> from (level, text) items"""
+    out, depth = [], -1
+    for level, text in items:
+        level = min(level, depth + 1)
+        while depth < level:
+            out.append(f'<{tag}>')
+            depth += 1
+        while depth > level:
+            out.append(f'</li></{tag}>')
+            depth -= 1
+        if out[-1] != f'<{tag}>':
+            out.append('</li>')
+        out.append(f'<li>{_inline_html(text)}')
+    while depth >= 0:
+        out.append(f'</li></{tag}>')
+        depth -= 1
+    return ''.join(out)
+
+
+def markdown_to_html(markdown, title=""):
+    """Render Markdown-like text as an HTML document for Drive's HTML -> Google Docs import"""
+    body = []
+    for block in parse_markdown(markdown):
+        if block["type"] == "heading":
+            body.append(f'<h{block["level"]}>{_inline_html(block["text"])}</h{block["level"]}>')
+        elif block["type"] == "paragraph":
+            body.append(f'<p>{_inline_html(block["text"])}</p>')
+        elif block["type"] == "list":
+            body.append(_list_html(block["items"], 'ol' if block["ordered"] else 'ul'))
+        elif block["type"] == "table":
+            rows = []
+            for r, row in enumerate(block["rows"]):
+                cell = 'th' if r == 0 else 'td'
+                rows.append('<tr>' + ''.join(f'<{cell}>{_inline_html(c)}</{cell}>' for c in row) + '</tr>')
+            body.append('<table border="1" style="border-collapse: collapse">' + ''.join(rows) + '</table>')
+    return (
+        '<html><head><meta charset="utf-8">'
+        f'<title>{html.escape(title)}</title></head><body>'
+        + '\n'.join(body) + '</body></html>'
+    )
+
+
+def parse_slides(markdown, title=""):
+    """
+    Split Markdown into slides: each # / ## heading starts a slide, the lines under it are
+    its body. Text before the first heading becomes a title slide (deck title + subtitle).
+    Returns [{"title", "lines", "bullets", "cover"}].
+    """
+    slides = []
+    current = {"title": title, "lines": [], "bullets": False, "cover": True}
+    for block in parse_markdown(markdown):
+        if block["type"] == "heading" and block["level"] <= 2:
+            if current["lines"] or not current["cover"]:
+                slides.append(current)
+            current = {"title": _strip_bold(block["text"])[0], "lines": [], "bullets": False, "cover": False}
+        elif block["type"] == "list":
+            current["lines"] += ['\t' * level + _strip_bold(text)[0] for level, text in block["items"]]
+            current["bullets"] = True
+        elif block["type"] == "table":
+            current["lines"] += [' / '.join(_strip_bold(cell)[0] for cell in row) for row in block["rows"]]
+        else:
+            current["lines"].append(_strip_bold(block["text"])[0])
+    if current["lines"] or not current["cover"]:
+        slides.append(current)
+    return slides
+
+
+def slides_requests(markdown, title="", remove_slide_ids=()):
+    """
+    Build the presentations.batchUpdate requests for a deck rendered from `markdown`,
+    deleting `remove_slide_ids` (the blank slide a new presentation starts with).
+    """
+    requests = []
+    for i, slide in enumerate(parse_slides(markdown, title)):
+        slide_id, title_id, body_id = f"koto_slide_{i}", f"koto_slide_{i}_title", f"koto_slide_{i}_body"
+        if slide["cover"]:
+            layout, title_type, body_type = 'TITLE', 'CENTERED_TITLE', 'SUBTITLE'
+        else:
+            layout, title_type, body_type = 'TITLE_AND_BODY', 'TITLE', 'BODY'
+        requests.append({'createSlide': {
+            'objectId': slide_id,
+            'insertionIndex': i,
+            'slideLayoutReference': {'predefinedLayout': layout},
+            'placeholderIdMappings': [
+                {'layoutPlaceholder': {'type': title_type, 'index': 0}, 'objectId': title_id},
+                {'layoutPlaceholder': {'type': body_type, 'index': 0}, 'objectId': body_id},
+            ]
+        }})
+        if slide["title"]:
+            requests.append({'insertText': {'objectId': title_id, 'text': slide["title"]}})
+        if slide["lines"]:
+            requests.append({'insertText': {'objectId': body_id, 'text': '\n'.join(slide["lines"])}})
+            if slide["bullets"]:
+                requests.append({'createParagraphBullets': {
+                    'objectId': body_id, 'textRange': {'type': 'ALL'},
+                    'bulletPreset': 'BULLET_DISC_CIRCLE_SQUARE'
+                }})
+    requests += [{'deleteObject': {'objectId': slide_id}} for slide_id in remove_slide_ids]
+    return requests
@@ -1,9 +1,11 @@
 """
 Google Workspace operations - Docs, Sheets, Slides, Drive, Gmail
 """
+import io
+import os
 import sys
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 from utils.auth import get_google_credentials, get_shared_folder_id
 
 
@@ -48,39 +50,69 @@ def move_to_shared_folder(file_id):
         return {"success": False, "error": str(e)}
 
 
+# How create_google_doc fills in content:
+#   html     - render to HTML and let Drive convert it on upload (one files.create)
+#   markdown - upload the Markdown as-is for Drive's Markdown import (one files.create)
+#   batch    - create an empty Doc, then one Docs batchUpdate (two calls)
+DOCS_CONTENT_UPLOAD = os.environ.get('DOCS_CONTENT_UPLOAD', 'html')
+
+GOOGLE_DOC_MIME = 'application/vnd.google-apps.document'
+GOOGLE_SHEET_MIME = 'application/vnd.google-apps.spreadsheet'
+GOOGLE_SLIDES_MIME = 'application/vnd.google-apps.presentation'
+
+
+def _create_in_shared_folder(drive_service, title, mime_type, media=None):
+    """
+    Create a file in the shared folder with one files.create: parents and the Google mimeType
+    are set at creation (no move afterwards), and an uploaded body is converted to that type.
+    Returns the new file ID.
+    """
+    file_metadata = {'name': title, 'mimeType': mime_type}
+    folder_id = get_shared_folder_id()
+    if folder_id:
+        file_metadata['parents'] = [folder_id]
+
+    file = drive_service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id',
+        supportsAllDrives=True
+    ).execute()
+    return file.get('id')
+
+
+def _text_upload(text, mime_type):
+    return MediaIoBaseUpload(io.BytesIO(text.encode('utf-8')), mimetype=mime_type)
+
+
 def create_google_doc(title, content=""):
-    """Create a Google Doc directly in the shared folder"""
+    """
+    Create a Google Doc directly in the shared folder.
+    content is Markdown-like text (headings, lists, tables); see DOCS_CONTENT_UPLOAD.
+    """
     try:
         creds = get_google_credentials()
         if not creds:
             return {"error": "Google認証に失敗しました。環境変数を確認してください。"}
-        
+
         drive_service = build('drive', 'v3', credentials=creds)
-        docs_service = build('docs', 'v1', credentials=creds)
-        
-        folder_id = get_shared_folder_id()
-        file_metadata = {
-            'name': title,
-            'mimeType': 'application/vnd.google-apps.document'
-        }
-        
-        # If shared folder is set, create directly inside it
-        if folder_id:
-            file_metadata['parents'] = [folder_id]
-        
-        # 1. Create file using Drive API
-        file = drive_service.files().create(
-            body=file_metadata,
-            fields='id',
-            supportsAllDrives=True
-        ).execute()
-        doc_id = file.get('id')
-        
-        # 2. Insert content using Docs API
-        if content:
-            requests = [{'insertText': {'location': {'index': 1}, 'text': content}}]
-            docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
-        
+
+        if content and DOCS_CONTENT_UPLOAD == 'html':
+            from tools.doc_render import markdown_to_html
+            media = _text_upload(markdown_to_html(content, title), 'text/html')
+            doc_id = _create_in_shared_folder(drive_service, title, GOOGLE_DOC_MIME, media)
+        elif content and DOCS_CONTENT_UPLOAD == 'markdown':
+            doc_id = _create_in_shared_folder(drive_service, title, GOOGLE_DOC_MIME, _text_upload(content, 'text/markdown'))
+        else:
+            doc_id = _create_in_shared_folder(drive_service, title, GOOGLE_DOC_MIME)
+            # Insert the rendered content using one Docs API batchUpdate
+            if content:
+                from tools.doc_render import docs_requests
+                requests = docs_requests(content)
+                if requests:
+                    docs_service = build('docs', 'v1', credentials=creds)
+                    docs_service.documents().batchUpdate(documentId=doc_id, body={'requests': requests}).execute()
+
         url = f"https://docs.google.com/document/d/{doc_id}/edit"
         return {"success": True, "title": title, "url": url, "id": doc_id}
     except Exception as e:
@@ -88,73 +120,75 @@ def create_google_doc(title, content=""):
         return {"error": f"ドキュメント作成中にエラーが発生しました: {str(e)}"}
 
 
-def create_google_sheet(title, data=None):
-    """Create a Google Sheet directly in the shared folder"""
+def create_google_sheet(title, data=None, sheets=None):
+    """
+    Create a Google Sheet directly in the shared folder.
+    data: rows for the first sheet / sheets: [{"name", "rows"}] for several named sheets.
+    Named sheets are set up in one spreadsheets.batchUpdate; all values are written RAW in one
+    values.batchUpdate.
+    """
     try:
         creds = get_google_credentials()
         if not creds:
             return {"error": "Google認証に失敗しました。環境変数を確認してください。"}
-        
+
+        from utils.sheets_batch import create_spreadsheet, batch_update, batch_update_values
         drive_service = build('drive', 'v3', credentials=creds)
-        sheets_service = build('sheets', 'v4', credentials=creds)
-        
-        folder_id = get_shared_folder_id()
-        file_metadata = {
-            'name': title,
-            'mimeType': 'application/vnd.google-apps.spreadsheet'
-        }
-        
-        if folder_id:
-            file_metadata['parents'] = [folder_id]
-            
-        # 1. Create using Drive API
-        file = drive_service.files().create(
-            body=file_metadata,
-            fields='id',
-            supportsAllDrives=True
-        ).execute()
-        sheet_id = file.get('id')
-        
-        # 2. Update content using Sheets API
-        if data:
-            sheets_service.spreadsheets().values().update(
-                spreadsheetId=sheet_id,
-                range='A1',
-                valueInputOption='RAW',
-                body={'values': data}
-            ).execute()
-        
+        sheets = [s for s in (sheets or []) if s.get("name")]
+
+        if not sheets:
+            sheet_id = create_spreadsheet(title, get_shared_folder_id(), rows=data, drive_service=drive_service)
+        else:
+            sheet_id = _create_in_shared_folder(drive_service, title, GOOGLE_SHEET_MIME)
+            sheets_service = build('sheets', 'v4', credentials=creds)
+
+            # A new spreadsheet has one tab with sheetId 0; it becomes the first named sheet
+            tab_requests = [{'updateSheetProperties': {
+                'properties': {'sheetId': 0, 'title': sheets[0]["name"]}, 'fields': 'title'
+            }}]
+            tab_requests += [{'addSheet': {'properties': {'title': s["name"]}}} for s in sheets[1:]]
+            batch_update(sheet_id, tab_requests, service=sheets_service)
+
+            ranges = [('A1', data)] if data else []
+            ranges += [
+                ("'" + s["name"].replace("'", "''") + "'!A1", s["rows"])
+                for s in sheets if s.get("rows")
+            ]
+            if ranges:
+                batch_update_values(sheet_id, ranges, service=sheets_service)
+
         url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/edit"
         return {"success": True, "title": title, "url": url, "id": sheet_id}
     except Exception as e:
         return {"error": f"スプレッドシート作成中にエラーが発生しました: {str(e)}"}
 
 
-def create_google_slide(title):
-    """Create a Google Slides presentation directly in the shared folder"""
+def create_google_slide(title, content=""):
+    """
+    Create a Google Slides presentation directly in the shared folder.
+    content is Markdown-like text; each # / ## heading becomes a slide (one batchUpdate).
+    """
     try:
         creds = get_google_credentials()
         if not creds:
             return {"error": "Google認証に失敗しました。環境変数を確認してください。"}
-        
+
         drive_service = build('drive', 'v3', credentials=creds)
-        
-        folder_id = get_shared_folder_id()
-        file_metadata = {
-            'name': title,
-            'mimeType': 'application/vnd.google-apps.presentation'
-        }
-        
-        if folder_id:
-            file_metadata['parents'] = [folder_id]
-            
-        file = drive_service.files().create(
-            body=file_metadata,
-            fields='id',
-            supportsAllDrives=True
-        ).execute()
-        pres_id = file.get('id')
-        
+        pres_id = _create_in_shared_folder(drive_service, title, GOOGLE_SLIDES_MIME)
+
+        if content:
+            from tools.doc_render import slides_requests
+            slides_service = build('slides', 'v1', credentials=creds)
+            # The blank first slide is replaced by the rendered deck
+            blank = slides_service.presentations().get(
+                presentationId=pres_id, fields='slides.objectId'
+            ).execute().get('slides', [])
+            requests = slides_requests(content, title, [s['objectId'] for s in blank])
+            if len(requests) > len(blank):
+                slides_service.presentations().batchUpdate(
+                    presentationId=pres_id, body={'requests': requests}
+                ).execute()
+
         url = f"https://docs.google.com/presentation/d/{pres_id}/edit"
         return {"success": True, "title": title, "url": url, "id": pres_id}
     except Exception as e:
@@ -287,14 +321,202 @@ def search_drive(query):
         return {"error": f"検索中にエラーが発生しました: {str(e)}"}
 
 
-def list_gmail(query="is:unread", max_results=5):
-    """List Gmail messages matching query"""
+GMAIL_METADATA_HEADERS = ['Subject', 'From', 'Date']
+# Gmail recommends at most 50 calls per batch request
+GMAIL_BATCH_SIZE = 50
+
+# Last seen mailbox historyId per query (for incremental list_gmail)
+_gmail_history_ids = {}
+
+
+def _batch_get_gmail_metadata(gmail_service, message_ids):
+    """Fetch metadata for many messages with Gmail batch HTTP requests (one round trip per 50)"""
+    responses = {}
+    
+    def on_response(request_id, response, exception):
+        if exception:
+            print(f"Error getting message {request_id}: {exception}", file=sys.stderr)
+            return
+        responses[request_id] = response
+    
+    for i in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+        batch = gmail_service.new_batch_http_request(callback=on_response)
+        for msg_id in message_ids[i:i + GMAIL_BATCH_SIZE]:
+            batch.add(
+                gmail_service.users().messages().get(
+                    userId='me',
+                    id=msg_id,
+                    format='metadata',
+                    metadataHeaders=GMAIL_METADATA_HEADERS
+                ),
+                request_id=msg_id
+            )
+        batch.execute()
+    
+    # Keep the order returned by messages.list
+    return [responses[msg_id] for msg_id in message_ids if msg_id in responses]
+
+
+def _format_gmail_metadata(msg_data):
+    """Convert a messages.get(format='metadata') response to the list_gmail email dict"""
+    headers = {h['name']: h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
+    return {
+        'id': msg_data.get('id'),
+        'subject': headers.get('Subject', '(件名なし)'),
+        'from': headers.get('From', ''),
+        'date': headers.get('Date', ''),
+        'snippet': msg_data.get('snippet', '')
+    }
+
+
+# Gmail system label IDs (user labels have IDs like Label_123 and need the API)
+_GMAIL_SYSTEM_LABELS = {
+    'INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'SENT', 'DRAFT', 'SPAM', 'TRASH',
+    'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL', 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS',
+}
+
+
+def _gmail_query_matcher(query, exact=False):
+    """
+    Build a local predicate for simple Gmail queries (is:, in:, system label:, from:, subject:, words).
+    Takes a dict with 'label_ids', 'subject', 'from' and 'snippet'.
+    Like Gmail, SPAM and TRASH are excluded unless the query names them.
+    With exact=True, only operators the cached fields answer exactly (is:, in:, system label:, from:)
+    are accepted: subject: and free-text terms, which Gmail matches by word and against the body,
+    make it return None.
+    Returns None if the query uses operators that only the Gmail API can evaluate.
+    The predicate's required_labels attribute lists the labels a match must carry.
+    """
+    label_aliases = {
+        'is:unread': ('UNREAD', True), 'is:read': ('UNREAD', False),
+        'is:starred': ('STARRED', True), 'is:important': ('IMPORTANT', True),
+        'in:inbox': ('INBOX', True), 'in:sent': ('SENT', True),
+        'in:spam': ('SPAM', True), 'in:trash': ('TRASH', True),
+    }
+    label_checks = []
+    field_checks = []
+    words = []
+    
+    for token in (query or '').split():
+        lowered = token.lower()
+        if lowered in label_aliases:
+            label_checks.append(label_aliases[lowered])
+        elif lowered.startswith('label:'):
+            # User labels have opaque IDs (Label_123); only system labels can be checked locally
+            label = lowered[6:].upper()
+            if label not in _GMAIL_SYSTEM_LABELS:
+                return None
+            label_checks.append((label, True))
+        elif lowered.startswith('from:'):
+            field_checks.append(('from', lowered[5:]))
+        elif lowered.startswith('subject:') and not exact:
+            field_checks.append(('subject', lowered[8:]))
+        elif exact or ':' in token or token.startswith(('-', '{', '(')) or token in ('OR', 'AND'):
+            return None
+        else:
+            words.append(lowered)
+
+    named = {label for label, _ in label_checks}
+    hidden = {'SPAM', 'TRASH'} - named
+    
+    def matches(msg):
+        labels = set(msg.get('label_ids') or [])
+        if labels & hidden:
+            return False
+        for label, wanted in label_checks:
+            if (label in labels) != wanted:
+                return False
+        for field, value in field_checks:
+            if value not in (msg.get(field) or '').lower():
+                return False
+        haystack = ' '.join((msg.get(f) or '') for f in ('subject', 'from', 'snippet')).lower()
+        return all(w in haystack for w in words)
+
+    matches.required_labels = {label for label, wanted in label_checks if wanted}
+    return matches
+
+
+def _gmail_added_since(gmail_service, start_history_id):
+    """
+    List message IDs added to the mailbox since start_history_id via history.list.
+    Returns (message_ids, latest_history_id), or (None, None) if the historyId has expired.
+    """
+    from googleapiclient.errors import HttpError
+    
+    message_ids = []
+    latest_history_id = start_history_id
+    page_token = None
+    try:
+        while True:
+            res = gmail_service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                pageToken=page_token
+            ).execute()
+            for record in res.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg_id = added.get('message', {}).get('id')
+                    if msg_id and msg_id not in message_ids:
+                        message_ids.append(msg_id)
+            latest_history_id = res.get('historyId', latest_history_id)
+            page_token = res.get('nextPageToken')
+            if not page_token:
+                return message_ids, latest_history_id
+    except HttpError as e:
+        # 404 means the historyId is too old; caller falls back to a full listing
+        if getattr(e, 'resp', None) is not None and e.resp.status == 404:
+            return None, None
+        raise
+
+
+def list_gmail(query="is:unread", max_results=5, incremental=False):
+    """
+    List Gmail messages matching query.
+    With incremental=True, repeated calls for the same query only return messages
+    that arrived since the previous call (via history.list).
+    """
     try:
         creds = get_google_credentials()
         if not creds:
             return {"error": "Google認証に失敗しました。"}
 
         gmail_service = build('gmail', 'v1', credentials=creds)
+        
+        matcher = _gmail_query_matcher(query) if incremental else None
+        last_history_id = _gmail_history_ids.get(query)
+        
+        # Incremental: only fetch messages added since the last check
+        if matcher and last_history_id:
+            added_ids, latest_history_id = _gmail_added_since(gmail_service, last_history_id)
+            if added_ids is not None:
+                email_list = []
+                for msg_data in _batch_get_gmail_metadata(gmail_service, added_ids):
+                    email = _format_gmail_metadata(msg_data)
+                    if matcher({**email, 'label_ids': msg_data.get('labelIds', [])}):
+                        email_list.append(email)
+                _gmail_history_ids[query] = latest_history_id
+                # history.list is oldest-first; match messages.list (newest-first)
+                email_list = email_list[::-1][:max_results]
+                return {"success": True, "emails": email_list, "count": len(email_list), "incremental": True}
+
+        if matcher:
+            # Remember where the mailbox is now so the next call can be incremental
+            profile = gmail_service.users().getProfile(userId='me').execute()
+            _gmail_history_ids[query] = profile.get('historyId')
+
+        # Serve simple queries from the local mailbox cache. It holds recent mail
+        # (MAIL_CACHE_RETENTION_DAYS / MAIL_CACHE_MAX_MESSAGES) plus unread mail, and returns
+        # None for free-text queries or whenever uncached mail could match; those go to the API.
+        if not incremental:
+            from utils import mail_cache
+            try:
+                cached = mail_cache.search(gmail_service, query, max_results)
+            except Exception as e:
+                print(f"Mail cache error (falling back to API): {e}", file=sys.stderr)
+                cached = None
+            if cached is not None:
+                return {"success": True, "emails": cached, "count": len(cached)}
 
         results = gmail_service.users().messages().list(
             userId='me',
@@ -307,27 +529,8 @@ def list_gmail(query="is:unread", max_results=5):
         if not messages:
             return {"success": True, "emails": [], "count": 0}
 
-        email_list = []
-        for msg in messages[:max_results]:
-            try:
-                msg_data = gmail_service.users().messages().get(
-                    userId='me',
-                    id=msg['id'],
-                    format='metadata',
-                    metadataHeaders=['Subject', 'From', 'Date']
-                ).execute()
-
-                headers = {h['name']: h['value'] for h in msg_data.get('payload', {}).get('headers', [])}
-                email_list.append({
-                    'id': msg['id'],
-                    'subject': headers.get('Subject', '(件名なし)'),
-                    'from': headers.get('From', ''),
-                    'date': headers.get('Date', ''),
-                    'snippet': msg_data.get('snippet', '')
-                })
-            except Exception as e:
-                print(f"Error getting message: {e}", file=sys.stderr)
-                continue
+        message_ids = [msg['id'] for msg in messages[:max_results]]
+        email_list = [_format_gmail_metadata(m) for m in _batch_get_gmail_metadata(gmail_service, message_ids)]
 
         return {"success": True, "emails": email_list, "count": len(email_list)}
     except Exception as e:
@@ -404,6 +607,13 @@ def create_calendar_event(summary, start_time, end_time=None, location=None):
 
         event = service.events().insert(calendarId='primary', body=event).execute()
         print(f"Event created: {event.get('htmlLink')}", file=sys.stderr)
+        
+        # Write through so free-slot checks see the new event before the next sync
+        try:
+            from utils import calendar_cache
+            calendar_cache.store_event('primary', event)
+        except Exception as e:
+            print(f"Calendar cache update error: {e}", file=sys.stderr)
         return {"success": True, "event": event, "link": event.get('htmlLink')}
         
     except Exception as e:
@@ -411,13 +621,137 @@ def create_calendar_event(summary, start_time, end_time=None, location=None):
         return {"error": f"予定の作成中にエラーが発生しました: {str(e)}"}
 
 
-def find_free_slots(start_date=None, end_date=None, duration_minutes=60, work_start=10, work_end=18):
-    """Find free time slots in calendar"""
+def _merge_intervals(intervals):
+    """Merge overlapping/adjacent (start, end) intervals. O(n log n)"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _free_gaps(window_start, window_end, merged_busy):
+    """Gaps inside [window_start, window_end) not covered by sorted, merged busy intervals"""
+    import bisect
+    gaps = []
+    cursor = window_start
+    # Merged intervals have sorted ends: binary-search past those ending before the window
+    i = bisect.bisect_right(merged_busy, window_start, key=lambda interval: interval[1])
+    for busy_start, busy_end in merged_busy[i:]:
+        if busy_start >= window_end:
+            break
+        if busy_start > cursor:
+            gaps.append((cursor, busy_start))
+        cursor = max(cursor, busy_end)
+    if cursor < window_end:
+        gaps.append((cursor, window_end))
+    return gaps
+
+
+# Working-hour templates: weekday (0=Mon) -> list of ("HH:MM", "HH:MM") windows
+_WEEKDAYS = range(5)
+WORKING_HOUR_TEMPLATES = {
+    "standard": {d: [("09:00", "12:00"), ("13:00", "18:00")] for d in _WEEKDAYS},
+    "office": {d: [("09:00", "18:00")] for d in _WEEKDAYS},
+    "morning": {d: [("09:00", "12:00")] for d in _WEEKDAYS},
+    "afternoon": {d: [("13:00", "18:00")] for d in _WEEKDAYS},
+    "evening": {d: [("18:00", "21:00")] for d in range(7)},
+}
+
+_WEEKDAY_NAMES = {
+    'mon': 0, 'tue': 1, 'wed': 2, 'thu': 3, 'fri': 4, 'sat': 5, 'sun': 6,
+    '月': 0, '火': 1, '水': 2, '木': 3, '金': 4, '土': 5, '日': 6,
+}
+
+# freebusy.query accepts at most 50 calendars per request
+FREEBUSY_MAX_CALENDARS = 50
+
+
+def _normalize_weekdays(weekdays):
+    """Accept [0-6], ["mon", ...] or ["月", ...]; returns a set of ints or None for all days"""
+    if not weekdays:
+        return None
+    result = set()
+    for d in weekdays:
+        if isinstance(d, int) or str(d).isdigit():
+            result.add(int(d) % 7)
+        elif str(d)[:3].lower() in _WEEKDAY_NAMES:
+            result.add(_WEEKDAY_NAMES[str(d)[:3].lower()])
+        elif str(d)[:1] in _WEEKDAY_NAMES:
+            result.add(_WEEKDAY_NAMES[str(d)[:1]])
+    return result or None
+
+
+def _working_windows(day, template, work_start, work_end):
+    """Working-hour (start, end) datetimes for one day"""
+    from datetime import timedelta
+    if template is None:
+        return [(day.replace(hour=work_start), day.replace(hour=work_end))]
+    windows = []
+    for start, end in template.get(day.weekday()) or template.get(str(day.weekday()), []):
+        sh, sm = map(int, start.split(':'))
+        eh, em = map(int, end.split(':'))
+        windows.append((day + timedelta(hours=sh, minutes=sm), day + timedelta(hours=eh, minutes=em)))
+    return windows
+
+
+def _query_freebusy(service, calendar_ids, time_min, time_max):
+    """
+    Busy intervals for many calendars with freebusy.query (one request per 50 calendars).
+    Returns (busy_intervals, calendar_errors).
+    """
+    from utils.calendar_cache import parse_event_time
+    busy = []
+    errors = {}
+    for i in range(0, len(calendar_ids), FREEBUSY_MAX_CALENDARS):
+        res = service.freebusy().query(body={
+            'timeMin': time_min.isoformat(),
+            'timeMax': time_max.isoformat(),
+            'timeZone': 'Asia/Tokyo',
+            'items': [{'id': cid} for cid in calendar_ids[i:i + FREEBUSY_MAX_CALENDARS]]
+        }).execute()
+        for cid, cal in res.get('calendars', {}).items():
+            if cal.get('errors'):
+                errors[cid] = cal['errors'][0].get('reason', 'unknown')
+            for block in cal.get('busy', []):
+                busy.append((
+                    parse_event_time({'dateTime': block['start']}),
+                    parse_event_time({'dateTime': block['end']})
+                ))
+    return busy, errors
+
+
+def find_free_slots(start_date=None, end_date=None, duration_minutes=60, work_start=10, work_end=18,
+                    calendar_ids=None, step_minutes=None, max_results=10,
+                    mode=None, working_hours=None, weekdays=None):
+    """
+    Find free time slots in calendar(s).
+    Without step_minutes, returns each exact free gap that fits duration_minutes.
+    With step_minutes, returns candidate slots starting every step_minutes inside the gaps.
+    mode: "cache" (local sync-token cache) or "freebusy" (one freebusy.query for all calendars).
+          Defaults to "freebusy" when more than one calendar is given.
+    working_hours: template name in WORKING_HOUR_TEMPLATES (or a weekday -> windows dict).
+    weekdays: only consider these days, e.g. ["mon", "wed"] or ["月", "水"].
+    """
     try:
         from datetime import datetime, timedelta, timezone
+        from utils import calendar_cache
         
         # JST Timezone
         jst = timezone(timedelta(hours=9))
+        calendar_ids = calendar_ids or ['primary']
+        duration = timedelta(minutes=int(duration_minutes or 60))
+        mode = mode or ("freebusy" if len(calendar_ids) > 1 else "cache")
+        
+        template = working_hours
+        if isinstance(working_hours, str):
+            template = WORKING_HOUR_TEMPLATES.get(working_hours)
+            if template is None:
+                return {"error": f"不明な勤務時間テンプレートです: {working_hours}（{', '.join(WORKING_HOUR_TEMPLATES)}）"}
+        allowed_days = _normalize_weekdays(weekdays)
         
         # Default: Search from tomorrow to 7 days ahead
         if not start_date:
@@ -426,84 +760,63 @@ def find_free_slots(start_date=None, end_date=None, duration_minutes=60, work_st
             start_dt = datetime.strptime(start_date, '%Y-%m-%d')
             end_date = (start_dt + timedelta(days=7)).strftime('%Y-%m-%d')
             
-        # Parse Dates
+        # Parse Dates (end_date is inclusive)
         dt_start = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=jst)
-        dt_end = datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=jst)
-        
-        # Get existing events
-        # Note: We query all events in the range
-        existing_revents_res = list_calendar_events(
-            time_min=dt_start.isoformat(), 
-            time_max=dt_end.isoformat()
-        )
-        if "error" in existing_revents_res:
-             return existing_revents_res
-             
-        existing_events = existing_revents_res.get('events', [])
-        
-        # Convert existing events to datetime objects for collision check
-        busy_slots = []
-        for e in existing_events:
-            start = e.get('start', {}).get('dateTime') or e.get('start', {}).get('date')
-            end = e.get('end', {}).get('dateTime') or e.get('end', {}).get('date')
-            if start and end:
-                # Handle full day events (date only) by creating datetime
-                if 'T' not in start: 
-                    s_dt = datetime.strptime(start, '%Y-%m-%d').replace(tzinfo=jst)
-                    e_dt = datetime.strptime(end, '%Y-%m-%d').replace(tzinfo=jst)
-                else: 
-                     # Parse ISO format (likely contains offset)
-                     from dateutil import parser
-                     s_dt = parser.parse(start)
-                     e_dt = parser.parse(end)
-                busy_slots.append((s_dt, e_dt))
-
-        # Scan availability
+        dt_end = datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=jst) + timedelta(days=1)
+        
+        creds = get_google_credentials()
+        if not creds:
+            return {"error": "Google認証に失敗しました。"}
+        service = build('calendar', 'v3', credentials=creds)
+        
+        calendar_errors = {}
+        if mode == "freebusy":
+            busy, calendar_errors = _query_freebusy(service, calendar_ids, dt_start, dt_end)
+        else:
+            # Refresh the local event cache (sync tokens: only changes are fetched)
+            calendar_cache.sync(service, calendar_ids)
+            busy = calendar_cache.get_busy_intervals(calendar_ids, dt_start, dt_end)
+        # Normalize to JST so gap boundaries print in local time
+        busy = _merge_intervals([(b_start.astimezone(jst), b_end.astimezone(jst)) for b_start, b_end in busy])
+
+        # Scan availability day by day within working hours
         available_slots = []
         current_day = dt_start
         
-        while current_day <= dt_end:
-            # Skip Weekends? (Optional: Making it configurable or assumption-based)
-            # For now, include weekends but maybe warn? Let's treat all days equal for now.
-            
-            # Define working hours for this day
-            day_start = current_day.replace(hour=work_start, minute=0, second=0, microsecond=0)
-            day_end = current_day.replace(hour=work_end, minute=0, second=0, microsecond=0)
+        while current_day < dt_end and len(available_slots) < max_results:
+            if allowed_days is not None and current_day.weekday() not in allowed_days:
+                current_day += timedelta(days=1)
+                continue
             
-            curr = day_start
-            while curr + timedelta(minutes=duration_minutes) <= day_end:
-                slot_end = curr + timedelta(minutes=duration_minutes)
-                
-                # Check collision
-                is_busy = False
-                for b_start, b_end in busy_slots:
-                    # Logic: overlapping if (StartA < EndB) and (EndA > StartB)
-                    if curr < b_end and slot_end > b_start:
-                        is_busy = True
+            for day_start, day_end in _working_windows(current_day, template, work_start, work_end):
+                for gap_start, gap_end in _free_gaps(day_start, day_end, busy):
+                    if gap_end - gap_start < duration:
+                        continue
+                    if step_minutes:
+                        curr = gap_start
+                        while curr + duration <= gap_end and len(available_slots) < max_results:
+                            available_slots.append(
+                                f"{curr.strftime('%m/%d(%a) %H:%M')} - {(curr + duration).strftime('%H:%M')}"
+                            )
+                            curr += timedelta(minutes=int(step_minutes))
+                    else:
+                        minutes = int((gap_end - gap_start).total_seconds() // 60)
+                        available_slots.append(
+                            f"{gap_start.strftime('%m/%d(%a) %H:%M')} - {gap_end.strftime('%H:%M')} ({minutes}分)"
+                        )
+                    if len(available_slots) >= max_results: # Limit result size
                         break
-                
-                if not is_busy:
-                    # Format neatly
-                    available_slots.append(
-                        f"{curr.strftime('%m/%d(%a) %H:%M')} - {slot_end.strftime('%H:%M')}"
-                    )
-                    
-                # Move forward (Interval 30 mins to offer flexibility?)
-                # Let's move by 60 mins (duration) or shorter interval? 
-                # 30 mins step gives more options.
-                curr += timedelta(minutes=60) # Simple hourly slots for prompt simplicity
-                
-                if len(available_slots) >= 10: # Limit result size
+                if len(available_slots) >= max_results:
                     break
             
-            if len(available_slots) >= 10:
-                break
             current_day += timedelta(days=1)
+        
+        notes = [f"※カレンダー {cid} は参照できませんでした（{reason}）" for cid, reason in calendar_errors.items()]
             
         if not available_slots:
-            return "指定された期間に空き時間は見つかりませんでした。"
+            return "\n".join(["指定された期間に空き時間は見つかりませんでした。"] + notes)
             
-        return "\n".join(available_slots)
+        return "\n".join(available_slots + notes)
         
     except Exception as e:
         print(f"Free slots check error: {e}", file=sys.stderr)
@@ -554,9 +867,30 @@ def add_task(title, due=None):
         return {"error": f"ToDo追加中にエラーが発生しました: {str(e)}"}
 
 
+def _extract_plain_text(part):
+    """Extract the first text/plain body from a (possibly nested) message payload"""
+    if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
+        import base64
+        return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
+    for sub in part.get('parts', []):
+        txt = _extract_plain_text(sub)
+        if txt:
+            return txt
+    return ''
+
+
 def get_gmail_body(message_id: str):
     """Fetch full email body (plain text) for a given Gmail message ID."""
     try:
+        from utils import mail_cache
+        try:
+            cached = mail_cache.get_message(message_id)
+        except Exception as e:
+            print(f"Mail cache error (falling back to API): {e}", file=sys.stderr)
+            cached = None
+        if cached:
+            return {"success": True, **cached}
+        
         creds = get_google_credentials()
         if not creds:
             return {"error": "Google認証に失敗しました。"}
@@ -569,16 +903,11 @@ def get_gmail_body(message_id: str):
         # Extract headers
         headers = {h['name']: h['value'] for h in msg.get('payload', {}).get('headers', [])}
         # Extract plain text body (may be nested parts)
-        def get_plain_text(part):
-            if part.get('mimeType') == 'text/plain' and 'data' in part.get('body', {}):
-                import base64
-                return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-            for sub in part.get('parts', []):
-                txt = get_plain_text(sub)
-                if txt:
-                    return txt
-            return ''
-        body = get_plain_text(msg.get('payload', {}))
+        body = _extract_plain_text(msg.get('payload', {}))
+        try:
+            mail_cache.store_message(msg, body)
+        except Exception as e:
+            print(f"Mail cache store error: {e}", file=sys.stderr)
         return {
             "success": True,
             "id": message_id,
@@ -593,13 +922,90 @@ def get_gmail_body(message_id: str):
 
 
 
-# Need fast import for fitz, but it might be heavy, so import inside function or at top
-import io
+# Hard cap on bytes pulled from Drive for a single read (default 20MB)
+DRIVE_READ_MAX_BYTES = int(os.environ.get('DRIVE_READ_MAX_BYTES', 20 * 1024 * 1024))
+# First Range request size; later requests double up to DRIVE_READ_MAX_CHUNK
+DRIVE_READ_FIRST_CHUNK = 256 * 1024
+DRIVE_READ_MAX_CHUNK = 8 * 1024 * 1024
+
+
+def _fetch_byte_range(drive_service, file_id, start, end):
+    """Download bytes [start, end] of a Drive file with an HTTP Range request"""
+    request = drive_service.files().get_media(fileId=file_id, supportsAllDrives=True)
+    request.headers['Range'] = f'bytes={start}-{end}'
+    return request.execute()
+
+
+def _download_with_budget(drive_service, file_id, file_size, max_bytes, enough=None):
+    """
+    Download a Drive file in growing Range-request chunks.
+    Stops when the file is complete, max_bytes is reached, or enough(data) returns True.
+    Returns (data, complete).
+    """
+    if file_size == 0:
+        # A Range request on an empty file is answered with 416
+        return b'', True
+    limit = min(file_size, max_bytes) if file_size else max_bytes
+    buf = bytearray()
+    chunk = DRIVE_READ_FIRST_CHUNK
+    
+    while len(buf) < limit:
+        start = len(buf)
+        end = min(start + chunk, limit) - 1
+        data = _fetch_byte_range(drive_service, file_id, start, end)
+        if not data:
+            break
+        buf.extend(data)
+        # Server ignored Range and sent everything (or the file ended early)
+        if len(data) < end - start + 1 or len(buf) > limit:
+            break
+        if enough and enough(bytes(buf)):
+            break
+        chunk = min(chunk * 2, DRIVE_READ_MAX_CHUNK)
+    
+    data = bytes(buf[:max_bytes])
+    # Judged on what is returned: a server that ignored Range may have sent more than max_bytes.
+    # Without a known size, stopping short of the limit means the file ended.
+    complete = len(data) >= file_size if file_size else len(buf) < limit
+    return data, complete
+
+
+def _extract_pdf_text(pdf_data, max_chars=None):
+    """
+    Extract text from (possibly partial) PDF bytes.
+    Returns (text, pages_parsed) or (None, 0) if the data cannot be parsed yet.
+    """
+    import fitz
+    try:
+        doc = fitz.open(stream=pdf_data, filetype="pdf")
+    except Exception:
+        return None, 0
+    
+    text = ""
+    pages = 0
+    try:
+        for page in doc:
+            try:
+                text += page.get_text() + "\n"
+            except Exception:
+                # Page objects beyond the downloaded range are unreadable
+                break
+            pages += 1
+            if max_chars and len(text) >= max_chars:
+                break
+    finally:
+        doc.close()
+    
+    if pages == 0:
+        return None, 0
+    return text, pages
 
-def read_drive_file(file_id: str):
+
+def read_drive_file(file_id: str, max_chars: int = None):
     """
     Read content from a Google Drive file (Google Doc, PDF, or Text).
     Returns text content.
+    If max_chars is given, only as much of the file as needed is downloaded.
     """
     try:
         creds = get_google_credentials()
@@ -611,16 +1017,20 @@ def read_drive_file(file_id: str):
         # 1. Get file metadata
         file = drive_service.files().get(
             fileId=file_id, 
-            fields='name, mimeType',
+            fields='name, mimeType, size',
             supportsAllDrives=True
         ).execute()
         mime_type = file.get('mimeType')
         name = file.get('name')
+        # None when Drive reports no size; 0 is an empty file
+        file_size = int(file['size']) if file.get('size') is not None else None
         
         content = ""
+        complete = True
+        result = {"success": True, "title": name}
         
         if mime_type == 'application/vnd.google-apps.document':
-            # Export Google Doc to Text
+            # Export Google Doc to Text (exports do not support Range requests)
             request = drive_service.files().export_media(
                 fileId=file_id,
                 mimeType='text/plain'
@@ -633,35 +1043,51 @@ def read_drive_file(file_id: str):
             content = fh.getvalue().decode('utf-8')
             
         elif mime_type == 'application/pdf':
-            # Download PDF and extract text
-            request = drive_service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+            # Download PDF incrementally until enough pages are parsed
+            parsed = {"text": None, "pages": 0}
             
-            # Extract text using PyMuPDF
-            import fitz
-            pdf_data = fh.getvalue()
-            doc = fitz.open(stream=pdf_data, filetype="pdf")
-            for page in doc:
-                content += page.get_text() + "\n"
+            def enough(data):
+                if not max_chars:
+                    return False
+                text, pages = _extract_pdf_text(data, max_chars)
+                if text is not None:
+                    parsed["text"], parsed["pages"] = text, pages
+                return bool(text) and len(text) >= max_chars
+            
+            pdf_data, complete = _download_with_budget(
+                drive_service, file_id, file_size, DRIVE_READ_MAX_BYTES, enough
+            )
+            
+            if parsed["text"] is None or complete:
+                parsed["text"], parsed["pages"] = _extract_pdf_text(pdf_data, max_chars)
+            if parsed["text"] is None:
+                return {"error": f"PDFの解析に失敗しました（{len(pdf_data)}バイト読込）"}
+            
+            content = parsed["text"]
+            result["pages"] = parsed["pages"]
+            result["bytes_read"] = len(pdf_data)
                 
         elif mime_type == 'text/plain':
-            # Download Text file
-            request = drive_service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-            content = fh.getvalue().decode('utf-8')
+            # Download only the bytes needed (UTF-8 is at most 4 bytes per char)
+            max_bytes = DRIVE_READ_MAX_BYTES
+            if max_chars:
+                max_bytes = min(max_bytes, max_chars * 4)
+            text_data, complete = _download_with_budget(drive_service, file_id, file_size, max_bytes)
+            # A truncated tail may split a multi-byte character
+            content = text_data.decode('utf-8', errors='ignore' if not complete else 'strict')
+            result["bytes_read"] = len(text_data)
             
         else:
             return {"error": f"未対応のファイル形式です: {mime_type}"}
-            
-        return {"success": True, "title": name, "content": content}
+        
+        truncated = not complete
+        if max_chars and len(content) > max_chars:
+            content = content[:max_chars]
+            truncated = True
+        
+        result["content"] = content
+        result["truncated"] = truncated
+        return result
         
     except Exception as e:
         print(f"Read Drive file error: {e}", file=sys.stderr)
@@ -4,17 +4,154 @@ Provides tools to read and write to Notion databases
 """
 import os
 import json
-import urllib.request
 import sys
+import time
+import random
+import threading
+import requests
 
 NOTION_API_KEY = os.environ.get('NOTION_API_KEY', '')
 NOTION_API_VERSION = "2022-06-28"
 
+# Database schemas rarely change; re-fetch after this many seconds
+NOTION_SCHEMA_TTL = int(os.environ.get('NOTION_SCHEMA_TTL', 600))
+# Notion caps page_size at 100
+NOTION_MAX_PAGE_SIZE = 100
+
+# Notion allows ~3 requests/second per integration (short bursts are tolerated)
+NOTION_RATE_PER_SEC = float(os.environ.get('NOTION_RATE_PER_SEC', 3))
+NOTION_BURST = int(os.environ.get('NOTION_BURST', 3))
+NOTION_MAX_RETRIES = int(os.environ.get('NOTION_MAX_RETRIES', 3))
+NOTION_BACKOFF_BASE = 0.5
+
+# Shared keep-alive session (reuses TLS connections to api.notion.com)
+_session = requests.Session()
+
+# database_id -> (fetched_at, properties)
+_schema_cache = {}
+_schema_lock = threading.Lock()
+
+
+class _TokenBucket:
+    """Token bucket shared by all Notion calls; pause() blocks everyone (Retry-After)"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Take one token, sleeping as needed. Returns seconds spent waiting."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+    
+    def pause(self, seconds):
+        """Hold all callers for the given time (server asked us to back off)"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class _OrderedGate:
+    """FIFO gate: writes pass one at a time, in the order they arrived"""
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.next_ticket = 0
+        self.serving = 0
+    
+    def __enter__(self):
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            while ticket != self.serving:
+                self.cond.wait()
+    
+    def __exit__(self, *exc):
+        with self.cond:
+            self.serving += 1
+            self.cond.notify_all()
+
+
+_bucket = _TokenBucket(NOTION_RATE_PER_SEC, NOTION_BURST)
+_write_gate = _OrderedGate()
+
+_metrics_lock = threading.Lock()
+_metrics = {
+    "requests": 0,
+    "rate_limited": 0,       # 429 responses
+    "retries": 0,
+    "failures": 0,
+    "throttled_seconds": 0.0,  # time spent waiting for the bucket / Retry-After
+    "backoff_seconds": 0.0,    # time spent sleeping before retrying errors
+}
+
+
+def _record(**deltas):
+    with _metrics_lock:
+        for key, value in deltas.items():
+            _metrics[key] += value
+
+
+def get_notion_metrics():
+    """Snapshot of Notion request/throttling counters"""
+    with _metrics_lock:
+        snapshot = dict(_metrics)
+    snapshot["throttled_seconds"] = round(snapshot["throttled_seconds"], 2)
+    snapshot["backoff_seconds"] = round(snapshot["backoff_seconds"], 2)
+    return snapshot
+
+
+def _is_read(endpoint, method):
+    """Reads are safe to retry: GETs, database queries and search"""
+    return method == "GET" or (method == "POST" and (endpoint.endswith("/query") or endpoint == "search"))
+
+
+def _backoff_delay(attempt, retry_after=None):
+    """Retry-After if the server sent one, otherwise jittered exponential backoff"""
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return NOTION_BACKOFF_BASE * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+
 def _notion_request(endpoint, method="GET", data=None):
-    """Make a request to Notion API"""
+    """
+    Make a request to Notion API.
+    All calls share a token bucket; writes are sent one at a time in arrival order.
+    429s are retried after Retry-After; reads are also retried on 5xx/network errors.
+    """
     if not NOTION_API_KEY:
         return {"error": "NOTION_API_KEY not set"}
     
+    if _is_read(endpoint, method):
+        return _send_with_retries(endpoint, method, data, is_read=True)
+    with _write_gate:
+        return _send_with_retries(endpoint, method, data, is_read=False)
+
+
+def _sleep_backoff(attempt):
+    delay = _backoff_delay(attempt)
+    _record(retries=1, backoff_seconds=delay)
+    time.sleep(delay)
+
+
+def _send_with_retries(endpoint, method, data, is_read):
     url = f"https://api.notion.com/v1/{endpoint}"
     headers = {
         "Authorization": f"Bearer {NOTION_API_KEY}",
@@ -22,33 +159,102 @@ def _notion_request(endpoint, method="GET", data=None):
         "Content-Type": "application/json"
     }
     
-    try:
-        if data:
-            req = urllib.request.Request(url, data=json.dumps(data).encode('utf-8'), headers=headers, method=method)
-        else:
-            req = urllib.request.Request(url, headers=headers, method=method)
+    for attempt in range(NOTION_MAX_RETRIES + 1):
+        _record(throttled_seconds=_bucket.acquire(), requests=1)
+        last_attempt = attempt == NOTION_MAX_RETRIES
+        try:
+            response = _session.request(
+                method,
+                url,
+                headers=headers,
+                data=json.dumps(data).encode('utf-8') if data else None,
+                timeout=30
+            )
+        except Exception as e:
+            # A write may have reached Notion before the connection failed; don't repeat it
+            if is_read and not last_attempt:
+                _sleep_backoff(attempt)
+                continue
+            print(f"Notion request error: {e}", file=sys.stderr)
+            _record(failures=1)
+            return {"error": str(e)}
         
-        with urllib.request.urlopen(req, timeout=30) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        print(f"Notion API Error: {e.code} - {error_body}", file=sys.stderr)
-        return {"error": f"API Error: {e.code}", "details": error_body}
-    except Exception as e:
-        print(f"Notion request error: {e}", file=sys.stderr)
-        return {"error": str(e)}
+        if response.status_code == 429:
+            # Rejected without being processed, so writes are safe to retry too
+            _record(rate_limited=1)
+            delay = _backoff_delay(attempt, response.headers.get("Retry-After"))
+            _bucket.pause(delay)
+            if not last_attempt:
+                _record(retries=1)
+                continue
+        elif response.status_code >= 500 and is_read and not last_attempt:
+            _sleep_backoff(attempt)
+            continue
+        
+        if response.status_code >= 400:
+            error_body = response.text
+            print(f"Notion API Error: {response.status_code} - {error_body}", file=sys.stderr)
+            _record(failures=1)
+            return {"error": f"API Error: {response.status_code}", "details": error_body}
+        return response.json()
+
+
+def _is_schema_mismatch(result):
+    """True if Notion rejected a request because a property name/type no longer matches"""
+    if result.get("error") != "API Error: 400":
+        return False
+    details = result.get("details", "")
+    return "validation_error" in details and "propert" in details
+
+
+def _invalidate_schema(database_id):
+    """Drop a cached schema (e.g. after a schema-mismatch error)"""
+    with _schema_lock:
+        _schema_cache.pop(database_id, None)
+
+
+def _get_database_schema(database_id):
+    """Fetch the database properties, cached for NOTION_SCHEMA_TTL seconds"""
+    with _schema_lock:
+        cached = _schema_cache.get(database_id)
+        if cached and time.time() - cached[0] < NOTION_SCHEMA_TTL:
+            return cached[1]
+    
+    result = _notion_request(f"databases/{database_id}", method="GET")
+    if "error" in result:
+        return None
+    
+    properties = result.get("properties", {})
+    with _schema_lock:
+        _schema_cache[database_id] = (time.time(), properties)
+    return properties
+
+
+def _iter_database_query(database_id, body=None, page_size=NOTION_MAX_PAGE_SIZE):
+    """
+    Yield raw databases/{id}/query responses, following next_cursor while has_more is true.
+    An error response is yielded as-is and ends the iteration.
+    """
+    body = dict(body or {})
+    body["page_size"] = max(1, min(page_size, NOTION_MAX_PAGE_SIZE))
+    while True:
+        result = _notion_request(f"databases/{database_id}/query", method="POST", data=body)
+        yield result
+        if "error" in result or not result.get("has_more") or not result.get("next_cursor"):
+            return
+        body["start_cursor"] = result["next_cursor"]
 
 
 def _get_database_properties(database_id):
     """
-    Fetch database schema to resolve property names.
-    Returns a dict mapping semantic roles ('title', 'date', 'status') to actual property names.
+    Resolve property names from the (cached) database schema.
+    Returns a dict mapping semantic roles ('title', 'date', 'status') to actual property names,
+    plus 'status_type' ('status' or 'select').
     """
-    result = _notion_request(f"databases/{database_id}", method="GET")
-    if "error" in result:
+    properties = _get_database_schema(database_id)
+    if not properties:
         return {}
         
-    properties = result.get("properties", {})
     mapping = {}
     
     # Analyze properties to find best matches
@@ -77,81 +283,120 @@ def _get_database_properties(database_id):
             # Prefer "Status", "State", "ステータス", "状態"
             if "status" not in mapping:
                 mapping["status"] = name
+                mapping["status_type"] = type_name
             else:
                 current = mapping["status"]
                 priority_terms = ["ステータス", "status", "state", "状態"]
                 if any(t in name.lower() for t in priority_terms) and not any(t in current.lower() for t in priority_terms):
                     mapping["status"] = name
+                    mapping["status_type"] = type_name
                     
     return mapping
 
 
-def list_notion_tasks(database_id, filter_today=False):
-    """
-    List tasks from a Notion database
-    """
-    if not database_id:
-        return {"error": "database_id is required"}
-    
-    # Resolve property names dynamically
-    prop_map = _get_database_properties(database_id)
+def _page_to_task(page, prop_map):
+    """Convert a Notion page to the task dict returned by list_notion_tasks ({} if untitled)"""
     # Fallbacks if detection failed (though unexpected for Title)
     title_prop = prop_map.get("title", "名前")
     date_prop = prop_map.get("date", "日付")
     status_prop = prop_map.get("status", "ステータス")
-
-    # Build filter for today's tasks if requested
-    body = {}
-    if filter_today and date_prop:
-        from datetime import datetime, timezone, timedelta
-        jst = timezone(timedelta(hours=9))
-        today = datetime.now(jst).strftime("%Y-%m-%d")
-        body["filter"] = {
-            "property": date_prop, 
-            "date": {
-                "equals": today
-            }
-        }
+    properties = page.get("properties", {})
     
-    # Query the database
-    result = _notion_request(f"databases/{database_id}/query", method="POST", data=body)
-    if "error" in result:
-        return result
+    # Extract Title
+    title = ""
+    if title_prop in properties:
+        p = properties[title_prop]
+        if p.get("title"):
+            title = p["title"][0].get("plain_text", "")
     
-    tasks = []
-    for page in result.get("results", []):
-        properties = page.get("properties", {})
+    # Extract Status
+    status = ""
+    if status_prop in properties:
+        p = properties[status_prop]
+        if p.get("status"): status = p["status"].get("name")
+        elif p.get("select"): status = p["select"].get("name")
         
-        # Extract Title
-        title = ""
-        if title_prop in properties:
-            p = properties[title_prop]
-            if p.get("title"):
-                title = p["title"][0].get("plain_text", "")
+    # Extract Date
+    due_date = ""
+    if date_prop in properties:
+        p = properties[date_prop]
+        if p.get("date"): due_date = p["date"].get("start")
+    
+    if not title:
+        return {}
+    return {
+        "id": page.get("id"),
+        "title": title,
+        "status": status,
+        "due_date": due_date,
+        "url": page.get("url", "")
+    }
+
+
+def list_notion_tasks(database_id, filter_today=False, page_size=NOTION_MAX_PAGE_SIZE, use_mirror=True):
+    """
+    List tasks from a Notion database (all pages, following next_cursor).
+    Served from the local mirror (utils/notion_mirror.py) when available.
+    """
+    if not database_id:
+        return {"error": "database_id is required"}
+    
+    if use_mirror:
+        from utils import notion_mirror
+        try:
+            mirrored = notion_mirror.list_tasks(database_id, filter_today)
+        except Exception as e:
+            print(f"Notion mirror error (falling back to API): {e}", file=sys.stderr)
+            mirrored = None
+        if mirrored is not None:
+            return mirrored
+    
+    for attempt in range(2):
+        # Resolve property names dynamically
+        prop_map = _get_database_properties(database_id)
+        date_prop = prop_map.get("date", "日付")
+
+        # Build filter for today's tasks if requested
+        body = {}
+        if filter_today and date_prop:
+            from datetime import datetime, timezone, timedelta
+            jst = timezone(timedelta(hours=9))
+            today = datetime.now(jst).strftime("%Y-%m-%d")
+            body["filter"] = {
+                "property": date_prop, 
+                "date": {
+                    "equals": today
+                }
+            }
         
-        # Extract Status
-        status = ""
-        if status_prop in properties:
-            p = properties[status_prop]
-            if p.get("status"): status = p["status"].get("name")
-            elif p.get("select"): status = p["select"].get("name")
-            
-        # Extract Date
-        due_date = ""
-        if date_prop in properties:
-            p = properties[date_prop]
-            if p.get("date"): due_date = p["date"].get("start")
+        # Query the database
+        tasks = []
+        error = None
+        for result in _iter_database_query(database_id, body, page_size):
+            if "error" in result:
+                error = result
+                break
+            for page in result.get("results", []):
+                task = _page_to_task(page, prop_map)
+                if task:
+                    tasks.append(task)
         
-        if title:
-            tasks.append({
-                "id": page.get("id"),
-                "title": title,
-                "status": status,
-                "due_date": due_date,
-                "url": page.get("url", "")
-            })
-    
-    return {"tasks": tasks, "count": len(tasks)}
+        # A renamed/retyped property: refresh the schema once and retry
+        if error and attempt == 0 and _is_schema_mismatch(error):
+            _invalidate_schema(database_id)
+            continue
+        if error:
+            return error
+        return {"tasks": tasks, "count": len(tasks)}
+
+
+def _mirror_page(page):
+    """Write a created/updated page through to the local mirror"""
+    try:
+        from utils import notion_mirror
+        notion_mirror.store_page(page)
+    except Exception as e:
+        print(f"Notion mirror update error: {e}", file=sys.stderr)
 
 
 def create_notion_task(database_id, title, due_date=None, status=None):
@@ -161,65 +406,49 @@ def create_notion_task(database_id, title, due_date=None, status=None):
     if not database_id: return {"error": "database_id is required"}
     if not title: return {"error": "title is required"}
     
-    # Resolve property names
-    prop_map = _get_database_properties(database_id)
-    title_key = prop_map.get("title", "名前") # Fallback to Japanese default
-    date_key = prop_map.get("date", "日付")
-    status_key = prop_map.get("status", "ステータス")
-    
-    print(f"Notion Mapping: Title={title_key}, Date={date_key}, Status={status_key}", file=sys.stderr)
+    for attempt in range(2):
+        # Resolve property names (cached schema)
+        prop_map = _get_database_properties(database_id)
+        title_key = prop_map.get("title", "名前") # Fallback to Japanese default
+        date_key = prop_map.get("date", "日付")
+        status_key = prop_map.get("status", "ステータス")
+        # 'status' type properties use 'status' key, 'select' use 'select' key
+        status_type = prop_map.get("status_type", "select")
+        
+        print(f"Notion Mapping: Title={title_key}, Date={date_key}, Status={status_key} ({status_type})", file=sys.stderr)
 
-    # Build the page properties
-    properties = {
-        title_key: {
-            "title": [{"text": {"content": title}}]
+        # Build the page properties
+        properties = {
+            title_key: {
+                "title": [{"text": {"content": title}}]
+            }
         }
-    }
-    
-    # Add due date if provided and mapped
-    if due_date and date_key:
-        properties[date_key] = {"date": {"start": due_date}}
-    
-    # Add status if provided and mapped
-    if status and status_key:
-        # Note: 'status' type properties use 'status' key, 'select' use 'select' key
-        # We need to know the type, but _get_database_properties didn't return type.
-        # For robustness, we can try both or fetch schema again. 
-        # For now, let's just attempt 'select' as it's common for status, or 'status' if we knew.
-        # Improve: _get_database_properties implies we know the type.
-        # Let's simple try inserting as 'select' or 'status' blindly? No, will error.
-        # Refined strategy: Assume 'status' property behaves like select for creation usually.
-        # But if it is a 'status' property, we need {"status": {"name": ...}}.
-        # If it is 'select', {"select": {"name": ...}}.
-        # We really need the type. Let's look at list_notion_tasks.
-        # Since we just need to solve the user's issue, let's assume 'status' property or 'select'.
-        pass 
-        # TODO: Better status handling. For now, try generic 'select' if key has 'status' in name?
-        # Actually, let's just skip status if complex, or try basic format.
-        # Many templates use 'Status' property type.
-        # Let's try to infer from keys or just try one.
-        # To be safe, re-fetch schema here is cheap enough (cached in function scope?)
-        # For this fix, let's just handle Title and Date perfectly first.
-        properties[status_key] = {"select": {"name": status}} # Try select first
-        # If it fails, that's life for now.
-
-    # Wait, 'properties' expects exact keys. If `date_key` was not found (e.g. user has no date col), we skip.
-    if due_date and not date_key:
-        print("Warning: No Date column found in Notion DB", file=sys.stderr)
-
-    body = {
-        "parent": {"database_id": database_id},
-        "properties": properties
-    }
-    
-    result = _notion_request("pages", method="POST", data=body)
+        
+        # Add due date if provided and mapped
+        if due_date and date_key:
+            properties[date_key] = {"date": {"start": due_date}}
+        
+        # Add status if provided and mapped
+        if status and status_key:
+            properties[status_key] = {status_type: {"name": status}}
+
+        body = {
+            "parent": {"database_id": database_id},
+            "properties": properties
+        }
+        
+        result = _notion_request("pages", method="POST", data=body)
+        
+        # The cached schema may be stale (renamed/retyped column): refresh once and retry
+        if attempt == 0 and _is_schema_mismatch(result):
+            _invalidate_schema(database_id)
+            continue
+        break
     
     if "error" in result:
-        # Retry with 'status' instead of 'select' if it failed?
-        # A simple retry logic for Status might be overkill. 
-        # Let's return the error so user sees it.
         return result
     
+    _mirror_page(result)
     return {
         "success": True,
         "id": result.get("id"),
@@ -271,6 +500,7 @@ def update_notion_task(page_id, status=None, title=None):
     
     if "error" in result: return result
     
+    _mirror_page(result)
     return {
         "success": True,
         "id": result.get("id"),
@@ -0,0 +1,161 @@
+"""
+Local Google Calendar cache - events in SQLite, kept fresh with events.list sync tokens
+Used by find_free_slots so availability checks see every event (not just the first page).
+"""
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+from utils.local_db import get_connection, get_state, set_state
+
+DB_NAME = "calendar_cache.db"
+
+# How far back the initial full sync reaches (days)
+CALENDAR_CACHE_PAST_DAYS = int(os.environ.get('CALENDAR_CACHE_PAST_DAYS', 7))
+# Skip the incremental sync if the last one is more recent than this (seconds)
+CALENDAR_CACHE_SYNC_INTERVAL = int(os.environ.get('CALENDAR_CACHE_SYNC_INTERVAL', 30))
+
+JST = timezone(timedelta(hours=9))
+
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            calendar_id TEXT,
+            event_id TEXT,
+            start_ts REAL,
+            end_ts REAL,
+            busy INTEGER,
+            event_json TEXT,
+            PRIMARY KEY (calendar_id, event_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_events_range ON events (calendar_id, start_ts, end_ts);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+_sync_lock = threading.Lock()
+
+
+def _get_db():
+    return get_connection(DB_NAME, SCHEMA)
+
+
+def parse_event_time(value):
+    """Convert an event start/end ({'dateTime'} or all-day {'date'}) to an aware datetime"""
+    if not value:
+        return None
+    if value.get('dateTime'):
+        return datetime.fromisoformat(value['dateTime'].replace('Z', '+00:00'))
+    if value.get('date'):
+        return datetime.strptime(value['date'], '%Y-%m-%d').replace(tzinfo=JST)
+    return None
+
+
+def _upsert_event(conn, calendar_id, event):
+    """Store one event from the API (removes it if cancelled)"""
+    if event.get('status') == 'cancelled':
+        conn.execute("DELETE FROM events WHERE calendar_id = ? AND event_id = ?", (calendar_id, event.get('id')))
+        return
+
+    start = parse_event_time(event.get('start'))
+    end = parse_event_time(event.get('end'))
+    if not start or not end:
+        return
+
+    # "Free" (transparent) events and declined invitations do not block time
+    declined = any(
+        a.get('self') and a.get('responseStatus') == 'declined'
+        for a in event.get('attendees', [])
+    )
+    busy = event.get('transparency') != 'transparent' and not declined
+
+    conn.execute(
+        "INSERT OR REPLACE INTO events (calendar_id, event_id, start_ts, end_ts, busy, event_json) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (calendar_id, event.get('id'), start.timestamp(), end.timestamp(), int(busy),
+         json.dumps(event, ensure_ascii=False))
+    )
+
+
+def store_event(calendar_id, event):
+    """Write through a single event (e.g. right after creating it)"""
+    conn = _get_db()
+    with conn:
+        _upsert_event(conn, calendar_id, event)
+
+
+def _list_all(service, calendar_id, **params):
+    """Follow nextPageToken through events.list; returns (items, nextSyncToken)"""
+    items = []
+    page_token = None
+    while True:
+        res = service.events().list(
+            calendarId=calendar_id,
+            singleEvents=True,
+            maxResults=2500,
+            pageToken=page_token,
+            **params
+        ).execute()
+        items.extend(res.get('items', []))
+        page_token = res.get('nextPageToken')
+        if not page_token:
+            return items, res.get('nextSyncToken')
+
+
+def _sync_calendar(conn, service, calendar_id):
+    """Incremental sync with the stored sync token, full resync if it is missing or expired"""
+    from googleapiclient.errors import HttpError
+
+    token_key = f"sync_token:{calendar_id}"
+    sync_token = get_state(conn, token_key)
+
+    if sync_token:
+        try:
+            items, next_token = _list_all(service, calendar_id, syncToken=sync_token)
+            for event in items:
+                _upsert_event(conn, calendar_id, event)
+            if next_token:
+                set_state(conn, token_key, next_token)
+            return
+        except HttpError as e:
+            # 410 Gone: token invalidated by the server, start over
+            if getattr(e, 'resp', None) is None or e.resp.status != 410:
+                raise
+            print(f"Calendar cache: sync token expired for {calendar_id}", file=sys.stderr)
+
+    time_min = (datetime.now(JST) - timedelta(days=CALENDAR_CACHE_PAST_DAYS)).isoformat()
+    items, next_token = _list_all(service, calendar_id, timeMin=time_min)
+    conn.execute("DELETE FROM events WHERE calendar_id = ?", (calendar_id,))
+    for event in items:
+        _upsert_event(conn, calendar_id, event)
+    set_state(conn, token_key, next_token or "")
+    print(f"Calendar cache: full sync of {calendar_id} ({len(items)} events)", file=sys.stderr)
+
+
+def sync(service, calendar_ids, force=False):
+    """Bring the cached calendars up to date"""
+    with _sync_lock:
+        conn = _get_db()
+        with conn:
+            for calendar_id in calendar_ids:
+                sync_key = f"last_sync:{calendar_id}"
+                last_sync = float(get_state(conn, sync_key, 0) or 0)
+                if not force and time.time() - last_sync < CALENDAR_CACHE_SYNC_INTERVAL:
+                    continue
+                _sync_calendar(conn, service, calendar_id)
+                set_state(conn, sync_key, str(time.time()))
+
+
+def get_busy_intervals(calendar_ids, start, end):
+    """Busy (start, end) datetimes overlapping [start, end) across the given calendars"""
+    placeholders = ",".join("?" for _ in calendar_ids)
+    rows = _get_db().execute(
+        f"SELECT start_ts, end_ts FROM events WHERE calendar_id IN ({placeholders}) "
+        "AND busy = 1 AND start_ts < ? AND end_ts > ?",
+        (*calendar_ids, end.timestamp(), start.timestamp())
+    )
+    return [
+        (datetime.fromtimestamp(row['start_ts'], JST), datetime.fromtimestamp(row['end_ts'], JST))
+        for row in rows
+    ]
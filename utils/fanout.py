@@ -0,0 +1,91 @@
+"""
+Bounded-concurrency fan-out for scheduled per-user work (reminders, profiler)
+Runs one call per user on a small thread pool with a per-user timeout and logs a
+latency / failure summary for the run. Recent summaries are kept for /debug/job-runs.
+"""
+import sys
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_recent_runs = deque(maxlen=20)
+_recent_lock = threading.Lock()
+
+
+def fan_out(label, items, fn, key=None, max_workers=4, timeout=120):
+    """
+    Call fn(item) for every item with at most max_workers in flight.
+    A call still running `timeout` seconds after it started is reported as timed out
+    (Python threads cannot be killed; it finishes in the background and its result is dropped).
+    Returns the run summary dict.
+    """
+    key = key or (lambda item: str(item))
+    started_at = {}
+    results = {}
+    lock = threading.Lock()
+
+    def run(item):
+        k = key(item)
+        with lock:
+            started_at[k] = time.time()
+        try:
+            fn(item)
+            outcome = ("ok", None)
+        except Exception as e:
+            outcome = ("failed", str(e))
+        with lock:
+            results.setdefault(k, (outcome[0], time.time() - started_at[k], outcome[1]))
+
+    run_started = time.time()
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    futures = {key(item): executor.submit(run, item) for item in items}
+
+    while True:
+        with lock:
+            pending = [k for k, f in futures.items() if k not in results]
+            now = time.time()
+            for k in pending:
+                if k in started_at and now - started_at[k] > timeout:
+                    results[k] = ("timeout", now - started_at[k], f"no result after {timeout}s")
+        if not pending:
+            break
+        time.sleep(0.2)
+    executor.shutdown(wait=False)
+
+    summary = _summarize(label, results, time.time() - run_started)
+    with _recent_lock:
+        _recent_runs.append(summary)
+    return summary
+
+
+def _summarize(label, results, elapsed):
+    latencies = sorted(r[1] for r in results.values())
+    counts = {"ok": 0, "failed": 0, "timeout": 0}
+    for status, _, _ in results.values():
+        counts[status] += 1
+
+    summary = {
+        "label": label,
+        "finished_at": time.strftime('%Y-%m-%d %H:%M:%S'),
+        "users": len(results),
+        **counts,
+        "elapsed_seconds": round(elapsed, 2),
+        "latency_p50": round(latencies[len(latencies) // 2], 2) if latencies else None,
+        "latency_max": round(latencies[-1], 2) if latencies else None,
+        "errors": {k[:8]: err for k, (status, _, err) in results.items() if status != "ok"}
+    }
+    print(
+        f"{label}: {counts['ok']}/{len(results)} ok, {counts['failed']} failed, {counts['timeout']} timed out "
+        f"in {summary['elapsed_seconds']}s (p50 {summary['latency_p50']}s, max {summary['latency_max']}s)",
+        file=sys.stderr
+    )
+    for k, err in summary["errors"].items():
+        print(f"  {k}: {err}", file=sys.stderr)
+    return summary
+
+
+def get_recent_runs():
+    """Summaries of the most recent fan-out runs (newest last)"""
+    with _recent_lock:
+        return list(_recent_runs)
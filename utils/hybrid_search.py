@@ -0,0 +1,163 @@
+"""
+Hybrid retrieval for RAG - lexical BM25 over the local message journal + Pinecone vectors
+Vector search misses exact terms (names, dates, file titles); BM25 over character bigrams
+catches them without a Japanese tokenizer. The two rankings are fused with reciprocal rank
+fusion, near-identical snippets are dropped, and the caller packs the result into a token budget.
+"""
+import os
+import re
+import sys
+import math
+import threading
+import unicodedata
+from collections import Counter
+
+from utils.text import normalized
+
+# Results taken from each retriever before fusion
+HYBRID_CANDIDATES = int(os.environ.get('HYBRID_CANDIDATES', 20))
+# Reciprocal rank fusion constant (higher = flatter weighting of lower ranks)
+HYBRID_RRF_K = int(os.environ.get('HYBRID_RRF_K', 60))
+# Bigram Jaccard similarity above which two snippets count as the same
+HYBRID_DEDUP_THRESHOLD = float(os.environ.get('HYBRID_DEDUP_THRESHOLD', 0.8))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Runs of ASCII letters/digits, or runs of other word characters (kana, kanji, ...)
+_WORD = re.compile(r'[a-z0-9]+|[^\sa-z0-9\W_]+')
+
+
+def tokenize(text):
+    """ASCII words as-is, other scripts (Japanese) as overlapping character bigrams"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = []
+    for run in _WORD.findall(text):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class _LexicalIndex:
+    """
+    In-memory BM25 index of one user's journal, extended incrementally from the last ID seen.
+    Rebuilt from scratch when the journal's generation changes (messages were pruned or deleted).
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, generation):
+        self.generation = generation
+        self.last_id = 0
+        self.docs = {}  # journal id -> (role, text, ts, term counts, length)
+        self.df = Counter()
+        self.total_length = 0
+
+    def refresh(self):
+        from utils.journal import read_after, get_generation
+        generation = get_generation()
+        if generation != self.generation:
+            self._reset(generation)
+        while True:
+            rows = read_after(self.user_id, self.last_id, limit=1000)
+            if not rows:
+                return
+            for row in rows:
+                terms = Counter(tokenize(row["text"]))
+                self.docs[row["id"]] = (row["role"], row["text"], row["ts"], terms, sum(terms.values()))
+                self.df.update(terms.keys())
+                self.total_length += sum(terms.values())
+                self.last_id = row["id"]
+
+    def search(self, query, n_results):
+        with self.lock:
+            self.refresh()
+            query_terms = set(tokenize(query))
+            if not self.docs or not query_terms:
+                return []
+            n = len(self.docs)
+            avg_length = self.total_length / n or 1
+            idf = {t: math.log(1 + (n - self.df[t] + 0.5) / (self.df[t] + 0.5)) for t in query_terms if self.df[t]}
+
+            scored = []
+            for doc_id, (role, text, ts, terms, length) in self.docs.items():
+                score = 0.0
+                for term, weight in idf.items():
+                    tf = terms.get(term)
+                    if tf:
+                        score += weight * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+                if score > 0:
+                    scored.append((score, doc_id, role, text, ts))
+        scored.sort(reverse=True)
+        return [
+            {"id": f"journal:{doc_id}", "text": text, "role": role, "ts": ts, "relevance": score}
+            for score, doc_id, role, text, ts in scored[:n_results]
+        ]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def lexical_search(user_id, query, n_results=HYBRID_CANDIDATES):
+    """BM25 over the user's journaled messages"""
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is None:
+            index = _indexes[user_id] = _LexicalIndex(user_id)
+    try:
+        return index.search(query, n_results)
+    except Exception as e:
+        print(f"Lexical search error: {e}", file=sys.stderr)
+        return []
+
+
+def _bigrams(text):
+    text = normalized(text)
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+def _fuse(rankings):
+    """Reciprocal rank fusion; the same text from several retrievers is one item"""
+    fused = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            key = normalized(item["text"])
+            if not key:
+                continue
+            entry = fused.setdefault(key, dict(item, score=0.0))
+            entry["score"] += 1.0 / (HYBRID_RRF_K + rank + 1)
+            if not entry.get("ts") and item.get("ts"):
+                entry["ts"] = item["ts"]
+    return sorted(fused.values(), key=lambda item: item["score"], reverse=True)
+
+
+def _dedupe(items):
+    kept, kept_bigrams = [], []
+    for item in items:
+        grams = _bigrams(item["text"])
+        if any(len(grams & other) / len(grams | other) >= HYBRID_DEDUP_THRESHOLD for other in kept_bigrams):
+            continue
+        kept.append(item)
+        kept_bigrams.append(grams)
+    return kept
+
+
+def hybrid_search(user_id, query, n_results=5, exclude_texts=()):
+    """
+    Fused lexical + vector results, best first, without near-duplicates.
+    exclude_texts (e.g. the turns already in the chat history) are left out.
+    """
+    from utils.vector_store import search_relevant_context
+
+    excluded = {normalized(t) for t in exclude_texts}
+    rankings = [
+        lexical_search(user_id, query, HYBRID_CANDIDATES),
+        search_relevant_context(user_id, query, n_results=HYBRID_CANDIDATES),
+    ]
+    rankings = [[item for item in ranking if normalized(item["text"]) not in excluded] for ranking in rankings]
+    return _dedupe(_fuse(rankings))[:n_results]
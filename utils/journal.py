@@ -0,0 +1,133 @@
+"""
+Message journal - every conversation message in SQLite, indexed by user and time
+history.json only keeps the last few turns for the chat prompt; the journal keeps the full
+stream so batch jobs (the nightly profiler) can read exactly what is new since they last ran.
+"""
+import os
+import time
+
+from utils.local_db import get_connection, get_state, set_state
+
+DB_NAME = "journal.db"
+
+# Messages older than this are pruned (days)
+JOURNAL_RETENTION_DAYS = int(os.environ.get('JOURNAL_RETENTION_DAYS', 90))
+
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            role TEXT,
+            text TEXT,
+            ts REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages (ts);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _get_db():
+    return get_connection(DB_NAME, SCHEMA)
+
+
+def append(user_id, role, text, ts=None):
+    """Record one message; returns its journal ID"""
+    conn = _get_db()
+    with conn:
+        cur = conn.execute(
+            "INSERT INTO messages (user_id, role, text, ts) VALUES (?, ?, ?, ?)",
+            (user_id, role, text, ts or time.time())
+        )
+    return cur.lastrowid
+
+
+def read_after(user_id, after_id=0, since_ts=None, role=None, limit=200):
+    """
+    Messages for user_id with ID > after_id (and ts >= since_ts), oldest first.
+    Returns [{"id", "role", "text", "ts"}].
+    """
+    query = "SELECT id, role, text, ts FROM messages WHERE user_id = ? AND id > ?"
+    params = [user_id, after_id or 0]
+    if since_ts:
+        query += " AND ts >= ?"
+        params.append(since_ts)
+    if role:
+        query += " AND role = ?"
+        params.append(role)
+    query += " ORDER BY id LIMIT ?"
+    params.append(int(limit))
+    return [dict(row) for row in _get_db().execute(query, params)]
+
+
+def get_watermark(name):
+    """Last processed journal ID for a consumer (e.g. 'profiler:<user_id>'), or None"""
+    value = get_state(_get_db(), f"watermark:{name}")
+    return int(value) if value else None
+
+
+def set_watermark(name, message_id):
+    conn = _get_db()
+    with conn:
+        set_state(conn, f"watermark:{name}", str(int(message_id)))
+
+
+def get_generation():
+    """Bumped whenever messages are deleted, so in-memory copies (the BM25 index) know to rebuild"""
+    return int(get_state(_get_db(), 'generation', 0) or 0)
+
+
+def _bump_generation(conn):
+    set_state(conn, 'generation', str(int(get_state(conn, 'generation', 0) or 0) + 1))
+
+
+def prune(retention_days=JOURNAL_RETENTION_DAYS):
+    """Delete messages older than the retention window; returns the number removed"""
+    conn = _get_db()
+    with conn:
+        cur = conn.execute("DELETE FROM messages WHERE ts < ?", (time.time() - retention_days * 86400,))
+        if cur.rowcount:
+            _bump_generation(conn)
+    return cur.rowcount
+
+
+def delete_messages(user_id, messages, before_ts):
+    """
+    Delete a user's messages matching (role, text) pairs sent before before_ts
+    (e.g. ones memory consolidation replaced); returns the number removed.
+    """
+    conn = _get_db()
+    removed = 0
+    with conn:
+        for role, text in messages:
+            removed += conn.execute(
+                "DELETE FROM messages WHERE user_id = ? AND role = ? AND text = ? AND ts < ?",
+                (user_id, role, text, before_ts)
+            ).rowcount
+        if removed:
+            _bump_generation(conn)
+    return removed
+
+
+def backfill(user_id, messages):
+    """
+    Insert history.json-style messages ({"role", "text", "timestamp" ISO}) older than the user's
+    first journaled one, so re-running never duplicates. Returns the number inserted.
+    """
+    from datetime import datetime
+    conn = _get_db()
+    first_ts = conn.execute("SELECT MIN(ts) FROM messages WHERE user_id = ?", (user_id,)).fetchone()[0]
+    cutoff = time.time() - JOURNAL_RETENTION_DAYS * 86400
+    rows = []
+    for msg in messages:
+        try:
+            ts = datetime.fromisoformat(msg["timestamp"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            continue
+        # add_message stamps history a moment before the journal, so allow a second of slack
+        if ts >= cutoff and (first_ts is None or ts < first_ts - 1) and msg.get("text"):
+            rows.append((user_id, msg.get("role", "user"), msg["text"], ts))
+    rows.sort(key=lambda row: row[3])
+    with conn:
+        conn.executemany("INSERT INTO messages (user_id, role, text, ts) VALUES (?, ?, ?, ?)", rows)
+    return len(rows)
@@ -0,0 +1,182 @@
+"""
+Leader election for the background scheduler
+Every gunicorn worker / replica imports app.py, but only the process holding the lease
+runs scheduled jobs. The lease is renewed in a background thread; if it is lost the
+scheduler is paused and another process takes over after the TTL.
+
+Backends (SCHEDULER_LOCK_BACKEND):
+  file    - flock on data/scheduler.lock (workers on one host; released when the process dies)
+  sqlite  - lease row in data/leader.db (processes sharing the data volume)
+  pkg.module:Class - any class with acquire(owner, ttl) -> bool and release(owner)
+
+Only processes sharing one data/ directory are supported. The leader's jobs read state that
+every worker writes to local SQLite there (journal.db, users.db, reminders.db, the mail
+cache), so a leader elected across hosts with separate disks would miss other hosts' data.
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import importlib
+
+from utils.storage import DATA_DIR
+
+# leader: run jobs only while holding the lease / always: every process runs them (old behaviour) / off: never
+SCHEDULER_MODE = os.environ.get('SCHEDULER_MODE', 'leader')
+SCHEDULER_LOCK_BACKEND = os.environ.get('SCHEDULER_LOCK_BACKEND', 'file')
+# Lease lifetime; renewed every TTL/3 seconds (seconds)
+SCHEDULER_LEASE_TTL = int(os.environ.get('SCHEDULER_LEASE_TTL', 30))
+LEASE_NAME = "koto-scheduler"
+
+
+class FileLock:
+    """Non-blocking flock; the OS drops it if the holder dies, so the TTL is not needed"""
+    def __init__(self):
+        self.path = DATA_DIR / "scheduler.lock"
+        self._fd = None
+
+    def acquire(self, owner, ttl):
+        import fcntl
+        if self._fd is not None:
+            return True
+        DATA_DIR.mkdir(exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, owner.encode('utf-8'))
+        self._fd = fd
+        return True
+
+    def release(self, owner):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SQLiteLease:
+    """Lease row with an expiry; taken over once the holder stops renewing"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, owner TEXT, expires_at REAL);
+    """
+
+    def _conn(self):
+        from utils.local_db import get_connection
+        return get_connection("leader.db", self.SCHEMA)
+
+    def acquire(self, owner, ttl):
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, expires_at FROM lease WHERE name = ?", (LEASE_NAME,)).fetchone()
+            if row and row["owner"] != owner and row["expires_at"] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO lease (name, owner, expires_at) VALUES (?, ?, ?)",
+                (LEASE_NAME, owner, now + ttl)
+            )
+            return True
+
+    def release(self, owner):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM lease WHERE name = ? AND owner = ?", (LEASE_NAME, owner))
+
+
+BACKENDS = {"file": FileLock, "sqlite": SQLiteLease}
+
+
+def _load_backend(name):
+    if name == "redis":
+        # Removed: scheduler state lives on local disk, so cross-host election is not supported
+        print("SCHEDULER_LOCK_BACKEND=redis is not supported (state is host-local); using the file lock", file=sys.stderr)
+        name = "file"
+    if name in BACKENDS:
+        if name == "file":
+            try:
+                import fcntl  # noqa: F401
+            except ImportError:
+                # No flock on Windows; the SQLite lease gives the same single-host guarantee
+                return SQLiteLease()
+        return BACKENDS[name]()
+    module_name, _, class_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class LeaderElector(threading.Thread):
+    """Keeps trying to hold the lease; calls on_elected / on_revoked on transitions"""
+    def __init__(self, backend, on_elected, on_revoked, ttl=SCHEDULER_LEASE_TTL):
+        super().__init__(daemon=True, name="leader-elector")
+        self.backend = backend
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                held = self.backend.acquire(self.owner, self.ttl)
+            except Exception as e:
+                # Cannot confirm the lease: stop acting as leader rather than risk two
+                print(f"Leader election error: {e}", file=sys.stderr)
+                held = False
+
+            if held and not self.is_leader:
+                self.is_leader = True
+                print(f"Scheduler: {self.owner} is now the leader", file=sys.stderr)
+                self.on_elected()
+            elif not held and self.is_leader:
+                self.is_leader = False
+                print(f"Scheduler: {self.owner} lost leadership", file=sys.stderr)
+                self.on_revoked()
+
+            self._stopping.wait(max(1, self.ttl / 3))
+
+    def stop(self):
+        self._stopping.set()
+        if self.is_leader:
+            self.is_leader = False
+            self.on_revoked()
+            try:
+                self.backend.release(self.owner)
+            except Exception as e:
+                print(f"Leader release error: {e}", file=sys.stderr)
+
+
+_elector = None
+
+
+def run_as_leader(on_elected, on_revoked):
+    """
+    Start scheduled work according to SCHEDULER_MODE.
+    Returns the elector (None in 'always' / 'off' mode).
+    """
+    global _elector
+    if SCHEDULER_MODE == 'off':
+        print("Scheduler: disabled in this process (SCHEDULER_MODE=off)", file=sys.stderr)
+        return None
+    if SCHEDULER_MODE == 'always':
+        on_elected()
+        return None
+
+    _elector = LeaderElector(_load_backend(SCHEDULER_LOCK_BACKEND), on_elected, on_revoked)
+    _elector.start()
+    return _elector
+
+
+def get_leader_status():
+    """Mode, backend and whether this process currently runs the scheduler"""
+    return {
+        "mode": SCHEDULER_MODE,
+        "backend": SCHEDULER_LOCK_BACKEND,
+        "owner": _elector.owner if _elector else f"{socket.gethostname()}:{os.getpid()}",
+        "is_leader": _elector.is_leader if _elector else SCHEDULER_MODE == 'always'
+    }
@@ -0,0 +1,44 @@
+"""
+Local SQLite storage - shared by the on-disk caches under data/
+"""
+import sqlite3
+import threading
+
+from utils.storage import DATA_DIR
+
+# One connection per thread per database file (sqlite3 connections are not thread-safe)
+_local = threading.local()
+
+
+def get_connection(db_name, schema=None):
+    """Get a thread-local connection to data/<db_name> (schema SQL runs once per connection)"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_name)
+    if conn is None:
+        DATA_DIR.mkdir(exist_ok=True)
+        conn = sqlite3.connect(str(DATA_DIR / db_name), timeout=30)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while a background sync is writing
+        conn.execute("PRAGMA journal_mode=WAL")
+        if schema:
+            conn.executescript(schema)
+        connections[db_name] = conn
+    return conn
+
+
+def get_state(conn, key, default=None):
+    """Read a value from the 'state' key-value table"""
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else default
+
+
+def set_state(conn, key, value):
+    """Write a value to the 'state' key-value table"""
+    conn.execute(
+        "INSERT INTO state (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
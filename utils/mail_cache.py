@@ -0,0 +1,320 @@
+"""
+Local Gmail cache - headers, snippets and plain-text bodies in SQLite
+Kept fresh incrementally with users.history.list so repeated "any unread mail?"
+checks are answered without listing the mailbox again.
+
+Holds every message from the last MAIL_CACHE_RETENTION_DAYS days (newest
+MAIL_CACHE_MAX_MESSAGES read ones) plus unread mail of any age (up to MAIL_CACHE_MAX_UNREAD),
+so is:unread can be answered completely even for old unread mail.
+"""
+import os
+import re
+import sys
+import time
+import threading
+
+from utils.local_db import get_connection, get_state, set_state
+
+DB_NAME = "mail_cache.db"
+
+# Only messages received within this many days are cached
+MAIL_CACHE_RETENTION_DAYS = int(os.environ.get('MAIL_CACHE_RETENTION_DAYS', 14))
+# Upper bound on cached read messages (oldest are dropped first)
+MAIL_CACHE_MAX_MESSAGES = int(os.environ.get('MAIL_CACHE_MAX_MESSAGES', 2000))
+# Unread messages are kept regardless of age, up to this many
+MAIL_CACHE_MAX_UNREAD = int(os.environ.get('MAIL_CACHE_MAX_UNREAD', 500))
+# Bodies longer than this are stored truncated
+MAIL_CACHE_MAX_BODY_CHARS = int(os.environ.get('MAIL_CACHE_MAX_BODY_CHARS', 20000))
+# Skip history.list if the last sync is more recent than this (seconds)
+MAIL_CACHE_SYNC_INTERVAL = int(os.environ.get('MAIL_CACHE_SYNC_INTERVAL', 30))
+MAIL_CACHE_ENABLED = os.environ.get('MAIL_CACHE_ENABLED', '1') != '0'
+
+_sync_lock = threading.Lock()
+
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id TEXT PRIMARY KEY,
+            thread_id TEXT,
+            internal_date INTEGER,
+            subject TEXT,
+            from_addr TEXT,
+            date TEXT,
+            snippet TEXT,
+            label_ids TEXT,
+            body TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_internal_date ON messages (internal_date);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _get_db():
+    return get_connection(DB_NAME, SCHEMA)
+
+
+def _upsert_metadata(conn, msg_data):
+    """Store a messages.get(format='metadata') response, keeping any cached body"""
+    from tools.google_ops import _format_gmail_metadata
+    email = _format_gmail_metadata(msg_data)
+    conn.execute(
+        "INSERT INTO messages (id, thread_id, internal_date, subject, from_addr, date, snippet, label_ids) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET subject = excluded.subject, from_addr = excluded.from_addr, "
+        "date = excluded.date, snippet = excluded.snippet, label_ids = excluded.label_ids",
+        (
+            email['id'],
+            msg_data.get('threadId'),
+            int(msg_data.get('internalDate') or 0),
+            email['subject'],
+            email['from'],
+            email['date'],
+            email['snippet'],
+            ",".join(msg_data.get('labelIds', []))
+        )
+    )
+
+
+_UNREAD = "(',' || COALESCE(label_ids, '') || ',' LIKE '%,UNREAD,%')"
+
+
+def _prune(conn):
+    """Apply the retention window to read mail and the size limits to read and unread mail"""
+    cutoff_ms = int((time.time() - MAIL_CACHE_RETENTION_DAYS * 86400) * 1000)
+    conn.execute(f"DELETE FROM messages WHERE internal_date < ? AND NOT {_UNREAD}", (cutoff_ms,))
+    conn.execute(
+        f"DELETE FROM messages WHERE NOT {_UNREAD} AND id NOT IN "
+        f"(SELECT id FROM messages WHERE NOT {_UNREAD} ORDER BY internal_date DESC LIMIT ?)",
+        (MAIL_CACHE_MAX_MESSAGES,)
+    )
+    trimmed = conn.execute(
+        f"DELETE FROM messages WHERE {_UNREAD} AND id NOT IN "
+        f"(SELECT id FROM messages WHERE {_UNREAD} ORDER BY internal_date DESC LIMIT ?)",
+        (MAIL_CACHE_MAX_UNREAD,)
+    ).rowcount
+    if trimmed:
+        set_state(conn, 'unread_complete', '0')
+
+
+def _list_ids(gmail_service, query, limit):
+    """Message IDs for query (newest first, at most limit); returns (ids, whether that was all of them)"""
+    message_ids = []
+    page_token = None
+    while len(message_ids) < limit:
+        res = gmail_service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=min(500, limit - len(message_ids)),
+            pageToken=page_token
+        ).execute()
+        message_ids.extend(m['id'] for m in res.get('messages', []))
+        page_token = res.get('nextPageToken')
+        if not page_token:
+            return message_ids, True
+    return message_ids, False
+
+
+def _full_sync(conn, gmail_service):
+    """Rebuild the cache from messages.list over the retention window"""
+    from tools.google_ops import _batch_get_gmail_metadata
+
+    # Take the historyId first so nothing that arrives during the listing is missed
+    history_id = gmail_service.users().getProfile(userId='me').execute().get('historyId')
+
+    recent_ids, _ = _list_ids(gmail_service, f"newer_than:{MAIL_CACHE_RETENTION_DAYS}d", MAIL_CACHE_MAX_MESSAGES)
+    unread_ids, unread_complete = _list_ids(gmail_service, "is:unread", MAIL_CACHE_MAX_UNREAD)
+    message_ids = list(dict.fromkeys(recent_ids + unread_ids))
+
+    conn.execute("DELETE FROM messages")
+    for msg_data in _batch_get_gmail_metadata(gmail_service, message_ids):
+        _upsert_metadata(conn, msg_data)
+    set_state(conn, 'history_id', history_id)
+    set_state(conn, 'unread_complete', '1' if unread_complete else '0')
+    print(f"Mail cache: full sync ({len(message_ids)} messages)", file=sys.stderr)
+
+
+def _incremental_sync(conn, gmail_service, start_history_id):
+    """
+    Apply mailbox changes since start_history_id.
+    Returns False if the historyId has expired and a full sync is needed.
+    """
+    from googleapiclient.errors import HttpError
+    from tools.google_ops import _batch_get_gmail_metadata
+
+    added_ids = []
+    latest_history_id = start_history_id
+    page_token = None
+    try:
+        while True:
+            res = gmail_service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                pageToken=page_token
+            ).execute()
+            for record in res.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    msg_id = added['message']['id']
+                    if msg_id not in added_ids:
+                        added_ids.append(msg_id)
+                for deleted in record.get('messagesDeleted', []):
+                    conn.execute("DELETE FROM messages WHERE id = ?", (deleted['message']['id'],))
+                # Label changes carry the message's full label set after the change
+                for change in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                    message = change.get('message', {})
+                    updated = conn.execute(
+                        "UPDATE messages SET label_ids = ? WHERE id = ?",
+                        (",".join(message.get('labelIds', [])), message.get('id'))
+                    ).rowcount
+                    # Old mail marked unread again is cached like any other unread mail
+                    if not updated and 'UNREAD' in message.get('labelIds', []) and message.get('id') not in added_ids:
+                        added_ids.append(message['id'])
+            latest_history_id = res.get('historyId', latest_history_id)
+            page_token = res.get('nextPageToken')
+            if not page_token:
+                break
+    except HttpError as e:
+        if getattr(e, 'resp', None) is not None and e.resp.status == 404:
+            return False
+        raise
+
+    if added_ids:
+        for msg_data in _batch_get_gmail_metadata(gmail_service, added_ids):
+            _upsert_metadata(conn, msg_data)
+    set_state(conn, 'history_id', latest_history_id)
+    return True
+
+
+def sync(gmail_service, force=False):
+    """Bring the cache up to date (incremental when possible)"""
+    with _sync_lock:
+        conn = _get_db()
+        last_sync = float(get_state(conn, 'last_sync', 0) or 0)
+        if not force and time.time() - last_sync < MAIL_CACHE_SYNC_INTERVAL:
+            return
+
+        with conn:
+            history_id = get_state(conn, 'history_id')
+            # Caches from before unread mail was kept beyond the window start over once
+            if get_state(conn, 'unread_complete') is None:
+                history_id = None
+            if not history_id or not _incremental_sync(conn, gmail_service, history_id):
+                _full_sync(conn, gmail_service)
+            _prune(conn)
+            set_state(conn, 'last_sync', str(time.time()))
+
+
+def _coverage_start_ms(conn):
+    """
+    Epoch ms from which the cache holds every message: the retention cutoff, or the oldest
+    cached read message once MAIL_CACHE_MAX_MESSAGES has pushed older ones out.
+    """
+    cutoff_ms = int((time.time() - MAIL_CACHE_RETENTION_DAYS * 86400) * 1000)
+    count, oldest = conn.execute(
+        f"SELECT COUNT(*), MIN(internal_date) FROM messages WHERE NOT {_UNREAD}"
+    ).fetchone()
+    if count >= MAIL_CACHE_MAX_MESSAGES and oldest:
+        cutoff_ms = max(cutoff_ms, oldest)
+    if get_state(conn, 'unread_complete') != '1':
+        oldest_unread = conn.execute(f"SELECT MIN(internal_date) FROM messages WHERE {_UNREAD}").fetchone()[0]
+        if oldest_unread:
+            cutoff_ms = max(cutoff_ms, oldest_unread)
+    return cutoff_ms
+
+
+def _split_newer_than(query):
+    """Pull a newer_than:<N>d token out of query; returns (rest of query, since epoch ms or None)"""
+    since_ms = None
+    rest = []
+    for token in (query or '').split():
+        match = re.fullmatch(r'newer_than:(\d+)d', token.lower())
+        if match:
+            since_ms = int((time.time() - int(match.group(1)) * 86400) * 1000)
+        else:
+            rest.append(token)
+    return ' '.join(rest), since_ms
+
+
+def search(gmail_service, query, max_results=5):
+    """
+    Answer a list_gmail query from the cache.
+    Only queries the cached fields answer exactly are served (is:, in:, system label:, from:,
+    newer_than:<N>d); free text and subject: go to the API, which also searches bodies by word.
+    A result is only returned when it is known to be complete: max_results hits were found
+    (they are the newest matches), the query needs UNREAD and all unread mail is cached, or it
+    is bounded by newer_than:<N>d to the window the cache fully covers.
+    Returns a list of email dicts, or None if the Gmail API has to answer the query.
+    """
+    if not MAIL_CACHE_ENABLED:
+        return None
+
+    from tools.google_ops import _gmail_query_matcher
+    query, since_ms = _split_newer_than(query)
+    matcher = _gmail_query_matcher(query, exact=True)
+    if matcher is None:
+        return None  # Decided before sync(), so such queries cost only the API call
+
+    sync(gmail_service)
+
+    conn = _get_db()
+    emails = []
+    rows = conn.execute(
+        "SELECT id, subject, from_addr, date, snippet, label_ids FROM messages "
+        "WHERE internal_date >= ? ORDER BY internal_date DESC",
+        (since_ms or 0,)
+    )
+    for row in rows:
+        candidate = {
+            'subject': row['subject'],
+            'from': row['from_addr'],
+            'snippet': row['snippet'],
+            'label_ids': (row['label_ids'] or '').split(',')
+        }
+        if matcher(candidate):
+            emails.append({
+                'id': row['id'],
+                'subject': row['subject'],
+                'from': row['from_addr'],
+                'date': row['date'],
+                'snippet': row['snippet']
+            })
+            if len(emails) >= max_results:
+                return emails
+
+    # Fewer hits than asked for: complete only if no uncached mail can match
+    if 'UNREAD' in matcher.required_labels and get_state(conn, 'unread_complete') == '1':
+        return emails
+    if since_ms is None or since_ms < _coverage_start_ms(conn):
+        return None
+    return emails
+
+
+def get_message(message_id):
+    """Return the cached message (with body) or None if the body is not cached"""
+    if not MAIL_CACHE_ENABLED:
+        return None
+    row = _get_db().execute(
+        "SELECT id, subject, from_addr, date, body FROM messages WHERE id = ? AND body IS NOT NULL",
+        (message_id,)
+    ).fetchone()
+    if not row:
+        return None
+    return {
+        'id': row['id'],
+        'subject': row['subject'],
+        'from': row['from_addr'],
+        'date': row['date'],
+        'body': row['body']
+    }
+
+
+def store_message(msg_data, body):
+    """Cache a decoded body from a messages.get(format='full') response"""
+    if not MAIL_CACHE_ENABLED:
+        return
+    conn = _get_db()
+    with conn:
+        _upsert_metadata(conn, msg_data)
+        conn.execute(
+            "UPDATE messages SET body = ? WHERE id = ?",
+            (body[:MAIL_CACHE_MAX_BODY_CHARS], msg_data.get('id'))
+        )
@@ -0,0 +1,279 @@
+"""
+Memory consolidation - keeps each user's conversation vectors from growing without bound
+A nightly job looks at messages older than CONSOLIDATE_MIN_AGE_DAYS and
+  - deletes low-information ones (acknowledgements, greetings)
+  - clusters near-duplicates (cosine >= CONSOLIDATE_SIMILARITY) and replaces each cluster
+    with one summary memory (summary:{user_id}:{epoch ms}) at the cluster's mean vector.
+Candidate pairs come from random-hyperplane LSH, so clustering stays near-linear.
+A per-user watermark (consolidation.db) makes each run continue after the last message examined.
+"""
+import os
+import re
+import sys
+import math
+import time
+import random
+import threading
+from datetime import datetime
+
+from utils.local_db import get_connection, get_state, set_state
+from utils.text import normalized
+
+DB_NAME = "consolidation.db"
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+CONSOLIDATE_MIN_AGE_DAYS = int(os.environ.get('CONSOLIDATE_MIN_AGE_DAYS', 7))
+CONSOLIDATE_SIMILARITY = float(os.environ.get('CONSOLIDATE_SIMILARITY', 0.92))
+# Vectors examined per user per run, oldest first after the user's watermark
+CONSOLIDATE_MAX_VECTORS = int(os.environ.get('CONSOLIDATE_MAX_VECTORS', 2000))
+CONSOLIDATE_SUMMARY_MODEL = os.environ.get('CONSOLIDATE_SUMMARY_MODEL', 'gemini-1.5-flash-8b')
+
+FETCH_BATCH = 100
+DELETE_BATCH = 1000
+# LSH: LSH_TABLES signatures of LSH_BITS hyperplanes; vectors sharing any signature are compared
+LSH_TABLES = 4
+LSH_BITS = 8
+
+# Whole messages (punctuation / emoji stripped) that are only acknowledgements or greetings
+_LOW_INFO = re.compile(
+    r'(ありがとう(ございます|ございました)?|有難う|了解(です|しました)?|りょうかい|承知(しました)?|ok|おk|'
+    r'はい|うん|そうだね|そうなんだ|いいね|なるほど(ね)?|おはよう(ございます)?|おやすみ(なさい)?|'
+    r'こんにちは|こんばんは|お疲れ様(です)?|おつかれ(さま)?|よろしく(お願いします)?|thanks|thankyou|笑|w)+'
+)
+
+SUMMARY_PROMPT = """
+以下は同じ話題についての過去の会話の断片です（古い順）。
+後で思い出せるよう、重要な事実・日付・固有名詞を残して1〜3文で要約してください。要約のみを出力してください。
+
+{texts}
+"""
+
+_last_report = None
+_report_lock = threading.Lock()
+
+
+def _is_low_info(text):
+    # Short answers like 「8時」 carry information; only empty or pure acknowledgement text goes
+    text = re.sub(r'[\W_]+', '', normalized(text))
+    return not text or bool(_LOW_INFO.fullmatch(text))
+
+
+def _unit(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _dot(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+def _cluster(records):
+    """Single-link clustering of unit vectors; returns clusters (lists of records) with 2+ members"""
+    if len(records) < 2:
+        return []
+    dim = len(records[0]["unit"])
+    rng = random.Random(42)
+    planes = [[rng.gauss(0, 1) for _ in range(dim)] for _ in range(LSH_TABLES * LSH_BITS)]
+
+    buckets = {}
+    for i, record in enumerate(records):
+        bits = [_dot(plane, record["unit"]) >= 0 for plane in planes]
+        for t in range(LSH_TABLES):
+            key = (t, tuple(bits[t * LSH_BITS:(t + 1) * LSH_BITS]))
+            buckets.setdefault(key, []).append(i)
+
+    # Union similar pairs within buckets
+    parent = list(range(len(records)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    compared = set()
+    for members in buckets.values():
+        for a_pos, a in enumerate(members):
+            for b in members[a_pos + 1:]:
+                if (a, b) in compared or find(a) == find(b):
+                    continue
+                compared.add((a, b))
+                if _dot(records[a]["unit"], records[b]["unit"]) >= CONSOLIDATE_SIMILARITY:
+                    parent[find(b)] = find(a)
+
+    groups = {}
+    for i in range(len(records)):
+        groups.setdefault(find(i), []).append(records[i])
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def _summarize(texts):
+    """One short summary of a cluster; falls back to its longest text"""
+    fallback = max(texts, key=len)
+    try:
+        import google.generativeai as genai
+        from core.agent import gemini_slot
+        prompt = SUMMARY_PROMPT.format(texts="\n".join(f"- {t[:300]}" for t in texts[:20]))
+        with gemini_slot(background=True):
+            response = genai.GenerativeModel(CONSOLIDATE_SUMMARY_MODEL).generate_content(prompt)
+        return response.text.strip() or fallback
+    except Exception as e:
+        print(f"Consolidation summary error: {e}", file=sys.stderr)
+        return fallback
+
+
+def _list_ids(index, prefix):
+    ids = []
+    for page in index.list(prefix=prefix):
+        ids.extend(page)
+    return ids
+
+
+def _id_ts(vector_id):
+    """msg:{user_id}:{epoch ms}:{role} -> epoch seconds"""
+    try:
+        return int(vector_id.rsplit(':', 2)[1]) / 1000
+    except (IndexError, ValueError):
+        return None
+
+
+def consolidate_user(user_id, index=None):
+    """Consolidate one user's old message vectors; returns a per-user report dict"""
+    from utils.vector_store import _get_index
+    index = index or _get_index()
+    if index is None:
+        return {"error": "vector store not available"}
+
+    ids = _list_ids(index, f"msg:{user_id}:")
+    cutoff = time.time() - CONSOLIDATE_MIN_AGE_DAYS * 86400
+    # Start after the last message examined, so each run moves on to newer vectors
+    db = get_connection(DB_NAME, SCHEMA)
+    watermark = float(get_state(db, f"watermark:{user_id}", 0) or 0)
+    old = sorted(
+        (i for i in ids if watermark < (_id_ts(i) or cutoff) < cutoff), key=_id_ts
+    )[:CONSOLIDATE_MAX_VECTORS]
+
+    records = []
+    for start in range(0, len(old), FETCH_BATCH):
+        fetched = index.fetch(ids=old[start:start + FETCH_BATCH]).vectors
+        for vector_id, record in fetched.items():
+            metadata = dict(record.metadata or {})
+            records.append({
+                "id": vector_id, "values": list(record.values), "metadata": metadata,
+                "text": metadata.get("text", ""), "ts": _id_ts(vector_id)
+            })
+
+    low_info = [r for r in records if _is_low_info(r["text"])]
+    rest = [r for r in records if not _is_low_info(r["text"])]
+    for r in rest:
+        r["unit"] = _unit(r["values"])
+    clusters = _cluster(rest)
+
+    summaries, merged_ids = [], []
+    for cluster in clusters:
+        cluster.sort(key=lambda r: r["ts"] or 0)
+        texts = [r["text"] for r in cluster]
+        dim = len(cluster[0]["unit"])
+        mean = _unit([sum(r["unit"][d] for r in cluster) / len(cluster) for d in range(dim)])
+        last_ts = cluster[-1]["ts"] or time.time()
+        summaries.append((
+            f"summary:{user_id}:{int(last_ts * 1000)}",
+            mean,
+            {
+                "user_id": user_id,
+                "role": "memory",
+                "type": "summary",
+                "text": _summarize(texts),
+                "ts": last_ts,
+                "first_ts": cluster[0]["ts"] or last_ts,
+                "timestamp": datetime.fromtimestamp(last_ts).isoformat(),
+                "merged_count": len(cluster)
+            }
+        ))
+        merged_ids.extend(r["id"] for r in cluster)
+
+    # Write summaries before deleting what they replace
+    for start in range(0, len(summaries), FETCH_BATCH):
+        index.upsert(vectors=summaries[start:start + FETCH_BATCH])
+    to_delete = [r["id"] for r in low_info] + merged_ids
+    for start in range(0, len(to_delete), DELETE_BATCH):
+        index.delete(ids=to_delete[start:start + DELETE_BATCH])
+
+    if old:
+        with db:
+            set_state(db, f"watermark:{user_id}", str(_id_ts(old[-1])))
+
+    # Drop the journal copies too, so lexical retrieval does not bring them back
+    if to_delete:
+        from utils.journal import delete_messages
+        deleted = low_info + [r for cluster in clusters for r in cluster]
+        try:
+            delete_messages(user_id, {(r["metadata"].get("role"), r["text"]) for r in deleted}, cutoff)
+        except Exception as e:
+            print(f"Consolidation journal delete error: {e}", file=sys.stderr)
+
+    return {
+        "messages_before": len(ids),
+        "messages_after": len(ids) - len(to_delete),
+        "examined": len(records),
+        "low_info_deleted": len(low_info),
+        "clusters": len(clusters),
+        "merged": len(merged_ids),
+        "summaries_added": len(summaries)
+    }
+
+
+def _index_size(index):
+    try:
+        return index.describe_index_stats().total_vector_count
+    except Exception as e:
+        print(f"Index stats error: {e}", file=sys.stderr)
+        return None
+
+
+def consolidate_all(users, max_workers=2, timeout=600):
+    """Run consolidation for every user (bounded fan-out) and record a before/after report"""
+    global _last_report
+    from utils.vector_store import _get_index
+    from utils.fanout import fan_out
+
+    index = _get_index()
+    if index is None:
+        print("Consolidation: vector store not available", file=sys.stderr)
+        return None
+
+    size_before = _index_size(index)
+    per_user = {}
+
+    def run(user):
+        per_user[user['user_id'][:8]] = consolidate_user(user['user_id'], index)
+
+    run_summary = fan_out("Memory consolidation", users, run, key=lambda user: user['user_id'],
+                          max_workers=max_workers, timeout=timeout)
+
+    report = {
+        "finished_at": time.strftime('%Y-%m-%d %H:%M:%S'),
+        # Index stats are eventually consistent; the per-user counts are exact
+        "index_size_before": size_before,
+        "index_size_after": _index_size(index),
+        "vectors_removed": sum(r.get("messages_before", 0) - r.get("messages_after", 0) for r in per_user.values()),
+        "summaries_added": sum(r.get("summaries_added", 0) for r in per_user.values()),
+        "failed": run_summary["failed"] + run_summary["timeout"],
+        "users": per_user
+    }
+    print(
+        f"Consolidation: removed {report['vectors_removed']} vectors, added {report['summaries_added']} summaries "
+        f"(index {report['index_size_before']} -> {report['index_size_after']})",
+        file=sys.stderr
+    )
+    with _report_lock:
+        _last_report = report
+    return report
+
+
+def get_last_report():
+    """Report of the most recent consolidation run in this process (None if none yet)"""
+    with _report_lock:
+        return _last_report
@@ -0,0 +1,169 @@
+"""
+Local mirror of Notion task databases
+Kept in sync by querying only pages edited since the last watermark (last_edited_time),
+so task lists (including the hourly reminders) are served from SQLite.
+"""
+import os
+import sys
+import time
+import threading
+from datetime import datetime, timezone, timedelta
+
+from utils.local_db import get_connection, get_state, set_state
+
+DB_NAME = "notion_mirror.db"
+
+# Serve from the mirror without syncing if the last sync is newer than this (seconds)
+NOTION_MIRROR_MAX_STALENESS = int(os.environ.get('NOTION_MIRROR_MAX_STALENESS', 300))
+# Full re-query interval; delta sync cannot see deleted pages
+NOTION_MIRROR_FULL_SYNC_INTERVAL = int(os.environ.get('NOTION_MIRROR_FULL_SYNC_INTERVAL', 3600))
+NOTION_MIRROR_ENABLED = os.environ.get('NOTION_MIRROR_ENABLED', '1') != '0'
+
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            database_id TEXT,
+            page_id TEXT,
+            title TEXT,
+            status TEXT,
+            due_date TEXT,
+            url TEXT,
+            last_edited_time TEXT,
+            PRIMARY KEY (database_id, page_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_due ON tasks (database_id, due_date);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+# One sync at a time per database
+_sync_locks = {}
+_sync_locks_guard = threading.Lock()
+
+
+def _get_db():
+    return get_connection(DB_NAME, SCHEMA)
+
+
+def _lock_for(database_id):
+    with _sync_locks_guard:
+        return _sync_locks.setdefault(database_id, threading.Lock())
+
+
+def _normalize_id(database_id):
+    """Notion accepts IDs with or without dashes; store one form"""
+    return database_id.replace('-', '')
+
+
+def _upsert_page(conn, database_id, page, prop_map):
+    """Store (or remove, if archived/untitled) one page from the API"""
+    from tools.notion_ops import _page_to_task
+    task = _page_to_task(page, prop_map)
+    if page.get("archived") or page.get("in_trash") or not task:
+        conn.execute("DELETE FROM tasks WHERE database_id = ? AND page_id = ?", (database_id, page.get("id")))
+        return
+    conn.execute(
+        "INSERT OR REPLACE INTO tasks (database_id, page_id, title, status, due_date, url, last_edited_time) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (database_id, task["id"], task["title"], task["status"], task["due_date"] or "",
+         task["url"], page.get("last_edited_time", ""))
+    )
+
+
+def sync(database_id, force_full=False):
+    """
+    Bring one database's mirror up to date.
+    Delta sync queries only pages with last_edited_time >= watermark.
+    Returns None on success or the Notion error dict.
+    """
+    from tools.notion_ops import _iter_database_query, _get_database_properties
+
+    db_key = _normalize_id(database_id)
+    with _lock_for(db_key):
+        conn = _get_db()
+        watermark = get_state(conn, f"watermark:{db_key}")
+        last_full = float(get_state(conn, f"last_full_sync:{db_key}", 0) or 0)
+        full = force_full or not watermark or time.time() - last_full > NOTION_MIRROR_FULL_SYNC_INTERVAL
+
+        body = {}
+        if not full:
+            # last_edited_time is minute-precision; the overlap is harmless (upserts)
+            body["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": watermark}}
+
+        prop_map = _get_database_properties(database_id)
+        started = datetime.now(timezone.utc) - timedelta(minutes=1)
+        pages = []
+        for result in _iter_database_query(database_id, body):
+            if "error" in result:
+                return result
+            pages.extend(result.get("results", []))
+
+        with conn:
+            if full:
+                conn.execute("DELETE FROM tasks WHERE database_id = ?", (db_key,))
+                set_state(conn, f"last_full_sync:{db_key}", str(time.time()))
+            for page in pages:
+                _upsert_page(conn, db_key, page, prop_map)
+            set_state(conn, f"watermark:{db_key}", started.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+            set_state(conn, f"last_sync:{db_key}", str(time.time()))
+
+        print(f"Notion mirror: {'full' if full else 'delta'} sync of {db_key[:8]} ({len(pages)} pages)", file=sys.stderr)
+        return None
+
+
+def list_tasks(database_id, filter_today=False):
+    """
+    List mirrored tasks, syncing first if the mirror is stale.
+    Returns the list_notion_tasks result dict, or None if the mirror cannot be used.
+    """
+    if not NOTION_MIRROR_ENABLED:
+        return None
+
+    db_key = _normalize_id(database_id)
+    conn = _get_db()
+    last_sync = float(get_state(conn, f"last_sync:{db_key}", 0) or 0)
+    if time.time() - last_sync > NOTION_MIRROR_MAX_STALENESS:
+        error = sync(database_id)
+        if error:
+            return None
+
+    query = "SELECT page_id, title, status, due_date, url FROM tasks WHERE database_id = ?"
+    params = [db_key]
+    if filter_today:
+        jst = timezone(timedelta(hours=9))
+        query += " AND substr(due_date, 1, 10) = ?"
+        params.append(datetime.now(jst).strftime("%Y-%m-%d"))
+    query += " ORDER BY due_date, title"
+
+    tasks = [
+        {"id": row["page_id"], "title": row["title"], "status": row["status"],
+         "due_date": row["due_date"], "url": row["url"]}
+        for row in conn.execute(query, params)
+    ]
+    return {"tasks": tasks, "count": len(tasks)}
+
+
+def store_page(page):
+    """Write through a page returned by create/update so the mirror reflects it immediately"""
+    if not NOTION_MIRROR_ENABLED:
+        return
+    from tools.notion_ops import _get_database_properties
+
+    database_id = page.get("parent", {}).get("database_id")
+    if not database_id:
+        return
+    db_key = _normalize_id(database_id)
+    conn = _get_db()
+    # Only maintain databases that have been mirrored (a partial mirror would look complete)
+    if not get_state(conn, f"watermark:{db_key}"):
+        return
+    with conn:
+        _upsert_page(conn, db_key, page, _get_database_properties(database_id))
+
+
+def sync_configured_databases():
+    """Refresh the mirror for every database in config['notion_databases'] (scheduler job)"""
+    from utils.sheets_config import load_config
+    for db in load_config().get("notion_databases", []):
+        if db.get("id"):
+            error = sync(db["id"])
+            if error:
+                print(f"Notion mirror sync error ({db.get('name', db['id'])}): {error.get('error')}", file=sys.stderr)
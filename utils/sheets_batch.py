@@ -0,0 +1,149 @@
+"""
+Sheets batching layer
+Thin wrappers over values.batchGet / values.batchUpdate / values.append / spreadsheets.batchUpdate,
+spreadsheet creation with initial rows, and a write coalescer that gathers value writes made
+within a short window into one values.batchUpdate per spreadsheet.
+"""
+import os
+import sys
+import threading
+
+from googleapiclient.discovery import build
+from utils.auth import get_google_credentials
+
+# Writes arriving within this window share one request (seconds)
+SHEETS_BATCH_WINDOW = float(os.environ.get('SHEETS_BATCH_WINDOW', 0.2))
+
+
+def _sheets_service():
+    return build('sheets', 'v4', credentials=get_google_credentials())
+
+
+def batch_get(spreadsheet_id, ranges, service=None):
+    """Read several ranges in one call; returns a list of row lists in the order of `ranges`"""
+    service = service or _sheets_service()
+    result = service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=list(ranges)
+    ).execute()
+    return [vr.get('values', []) for vr in result.get('valueRanges', [])]
+
+
+def batch_update_values(spreadsheet_id, data, service=None, value_input_option='RAW'):
+    """Write several ranges in one call; data is a list of (range, rows)"""
+    service = service or _sheets_service()
+    return service.spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={
+            'valueInputOption': value_input_option,
+            'data': [{'range': rng, 'values': rows} for rng, rows in data]
+        }
+    ).execute()
+
+
+def append_values(spreadsheet_id, rng, rows, service=None, value_input_option='RAW'):
+    """
+    Append rows after the last row of the table in `rng` (values.append), so concurrent
+    appenders and rows added by hand are never overwritten.
+    Returns the 1-based sheet row of the first appended row.
+    """
+    service = service or _sheets_service()
+    result = service.spreadsheets().values().append(
+        spreadsheetId=spreadsheet_id,
+        range=rng,
+        valueInputOption=value_input_option,
+        insertDataOption='INSERT_ROWS',
+        body={'values': rows}
+    ).execute()
+    # updatedRange looks like "Sheet1!A12:D13"
+    first_cell = result['updates']['updatedRange'].split('!')[-1].split(':')[0]
+    return int(''.join(ch for ch in first_cell if ch.isdigit()))
+
+
+def batch_update(spreadsheet_id, requests, service=None):
+    """Apply structural requests (add sheet, delete rows, ...) in one spreadsheets.batchUpdate"""
+    service = service or _sheets_service()
+    return service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={'requests': requests}
+    ).execute()
+
+
+def create_spreadsheet(name, folder_id=None, rows=None, drive_service=None, service=None):
+    """
+    Create a spreadsheet (optionally in a folder) with one Drive files.create call, then
+    write the initial rows with valueInputOption=RAW, so values stay exactly as given
+    ("001" keeps its zeros; dates and "=..." stay text) as in every other write here.
+    Returns the new file ID.
+    """
+    drive_service = drive_service or build('drive', 'v3', credentials=get_google_credentials())
+    metadata = {'name': name, 'mimeType': 'application/vnd.google-apps.spreadsheet'}
+    if folder_id:
+        metadata['parents'] = [folder_id]
+
+    file = drive_service.files().create(
+        body=metadata,
+        fields='id',
+        supportsAllDrives=True
+    ).execute()
+    file_id = file.get('id')
+    if rows:
+        batch_update_values(file_id, [('A1', rows)], service=service)
+    return file_id
+
+
+class PendingWrite:
+    """Handle for a queued write; wait() returns True once it has been written"""
+    def __init__(self):
+        self._done = threading.Event()
+        self.error = None
+
+    def _finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=30):
+        return self._done.wait(timeout) and self.error is None
+
+
+class WriteCoalescer:
+    """
+    Collects value writes per spreadsheet and flushes them as one values.batchUpdate
+    SHEETS_BATCH_WINDOW seconds after the first one. A later write to the same range
+    within the window replaces the earlier one.
+    """
+    def __init__(self, window=SHEETS_BATCH_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending = {}  # spreadsheet_id -> {range: (rows, [PendingWrite])}
+
+    def write(self, spreadsheet_id, rng, rows):
+        handle = PendingWrite()
+        with self._lock:
+            queued = self._pending.get(spreadsheet_id)
+            if queued is None:
+                queued = self._pending[spreadsheet_id] = {}
+                timer = threading.Timer(self.window, self._flush, args=[spreadsheet_id])
+                timer.daemon = True
+                timer.start()
+            handles = queued[rng][1] if rng in queued else []
+            queued[rng] = (rows, handles + [handle])
+        return handle
+
+    def _flush(self, spreadsheet_id):
+        with self._lock:
+            queued = self._pending.pop(spreadsheet_id, {})
+        if not queued:
+            return
+        error = None
+        try:
+            batch_update_values(spreadsheet_id, [(rng, rows) for rng, (rows, _) in queued.items()])
+        except Exception as e:
+            print(f"Sheets batch write error ({len(queued)} ranges): {e}", file=sys.stderr)
+            error = e
+        for _, handles in queued.values():
+            for handle in handles:
+                handle._finish(error)
+
+
+writer = WriteCoalescer()
@@ -1,11 +1,23 @@
 """
 Google Sheets-based configuration storage for KOTO
 This replaces local file storage to enable cloud persistence.
+
+Layout: one row per config key (key | JSON value | version | updated_at), plus a
+config-wide revision in G1. A save rewrites only the rows whose value changed and bumps
+the revision, so readers can tell "unchanged" by reading that one cell. Values longer
+than one cell allows continue in columns E onwards. The old layout (whole config as JSON
+in A1) is migrated on first load.
 """
+import os
+import copy
 import json
 import sys
+import time
+import threading
+import datetime
 from googleapiclient.discovery import build
 from utils.auth import get_google_credentials, get_shared_folder_id
+from utils.sheets_batch import batch_get, create_spreadsheet, writer
 
 CONFIG_SHEET_NAME = "KOTO_CONFIG"
 
@@ -25,8 +37,22 @@ DEFAULT_CONFIG = {
     "notion_databases": []  # List of {id, name, description}
 }
 
+CONFIG_HEADER = ['key', 'value', 'version', 'updated_at']
+REVISION_LABEL_CELL = 'F1'
+REVISION_CELL = 'G1'
+# Sheets cells hold at most 50,000 characters; longer values are split
+CELL_CHAR_LIMIT = 45000
+# Skip even the revision check if it was done this recently (seconds)
+CONFIG_CHECK_INTERVAL = float(os.environ.get('CONFIG_CHECK_INTERVAL', 10))
+
 _config_sheet_id = None  # Cache
 
+# Last read state: {"revision": int, "values": {key: value}, "rows": {key: (row, version, width)}, "next_row": int}
+_state = None
+_checked_at = 0
+_state_lock = threading.Lock()
+_save_lock = threading.Lock()
+
 def get_or_create_config_sheet():
     """Get or create the KOTO_CONFIG spreadsheet in the shared folder"""
     global _config_sheet_id
@@ -40,7 +66,6 @@ def get_or_create_config_sheet():
             return None
             
         drive_service = build('drive', 'v3', credentials=creds)
-        sheets_service = build('sheets', 'v4', credentials=creds)
         
         folder_id = get_shared_folder_id()
         
@@ -64,91 +89,211 @@ def get_or_create_config_sheet():
             print(f"Found existing config sheet: {_config_sheet_id}", file=sys.stderr)
             return _config_sheet_id
         
-        # Create new spreadsheet
-        file_metadata = {
-            'name': CONFIG_SHEET_NAME,
-            'mimeType': 'application/vnd.google-apps.spreadsheet'
-        }
-        if folder_id:
-            file_metadata['parents'] = [folder_id]
-            
-        file = drive_service.files().create(
-            body=file_metadata,
-            fields='id',
-            supportsAllDrives=True
-        ).execute()
-        
-        _config_sheet_id = file.get('id')
+        # Create new spreadsheet, initialized with the default config
+        _config_sheet_id = create_spreadsheet(
+            CONFIG_SHEET_NAME,
+            folder_id=folder_id,
+            rows=_layout_rows(DEFAULT_CONFIG),
+            drive_service=drive_service
+        )
         print(f"Created new config sheet: {_config_sheet_id}", file=sys.stderr)
         
-        # Initialize with default config
-        save_config(DEFAULT_CONFIG)
-        
         return _config_sheet_id
         
     except Exception as e:
         print(f"Error in get_or_create_config_sheet: {e}", file=sys.stderr)
         return None
 
-def load_config():
-    """Load configuration from Google Sheets"""
+def _now():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _value_cells(value):
+    """JSON-encode a value and split it into cell-sized chunks"""
+    text = json.dumps(value, ensure_ascii=False)
+    return [text[i:i + CELL_CHAR_LIMIT] for i in range(0, len(text), CELL_CHAR_LIMIT)] or ['']
+
+
+def _row_cells(key, value, version, updated_at):
+    chunks = _value_cells(value)
+    return [key, chunks[0], version, updated_at] + chunks[1:]
+
+
+def _layout_rows(config, revision=1):
+    """All rows for a fresh sheet (header with the revision, then one row per key)"""
+    now = _now()
+    header = CONFIG_HEADER + ['', 'revision', revision]  # F1:G1, as written by update_config
+    return [header] + [_row_cells(key, value, 1, now) for key, value in config.items()]
+
+
+def _parse_sheet(rows):
+    """Sheet values -> state dict"""
+    header = rows[0] if rows else []
+    revision = int(header[6]) if len(header) > 6 and str(header[6]).isdigit() else 0
+    values, row_info = {}, {}
+    for i, row in enumerate(rows[1:], start=2):
+        if not row or not row[0]:
+            continue
+        text = (row[1] if len(row) > 1 else '') + ''.join(row[4:])
+        if text in ('TRUE', 'FALSE'):
+            text = text.lower()  # true/false typed into the sheet by hand become booleans, read back as TRUE/FALSE
+        try:
+            values[row[0]] = json.loads(text) if text else None
+        except json.JSONDecodeError:
+            print(f"Config key '{row[0]}' has invalid JSON, ignored", file=sys.stderr)
+            continue
+        version = int(row[2]) if len(row) > 2 and str(row[2]).isdigit() else 1
+        row_info[row[0]] = (i, version, len(row))
+    return {"revision": revision, "values": values, "rows": row_info, "next_row": len(rows) + 1}
+
+
+def _migrate_legacy(sheet_id, legacy_json):
+    """Rewrite the old single-cell layout as keyed rows"""
+    config = json.loads(legacy_json)
+    rows = _layout_rows(config)
+    width = max(len(r) for r in rows)
+    padded = [r + [''] * (width - len(r)) for r in rows]
+    if not writer.write(sheet_id, f"A1:{_column(width)}{len(rows)}", padded).wait():
+        raise RuntimeError("legacy config migration failed")
+    print(f"Config migrated from A1 JSON to {len(config)} keyed rows", file=sys.stderr)
+    return rows
+
+
+def _column(n):
+    """1 -> A, 27 -> AA"""
+    name = ''
+    while n:
+        n, rem = divmod(n - 1, 26)
+        name = chr(65 + rem) + name
+    return name
+
+
+def _read_state(sheet_id):
+    rows = batch_get(sheet_id, ['A:ZZ'])[0]
+    if rows and rows[0] and rows[0][0].lstrip().startswith('{'):
+        rows = _migrate_legacy(sheet_id, rows[0][0])
+    return _parse_sheet(rows)
+
+
+def _current_state(sheet_id, force=False):
+    """
+    The cached state if the sheet's revision is unchanged (one-cell read),
+    otherwise a full re-read.
+    """
+    global _state, _checked_at
+    with _state_lock:
+        if _state is not None and not force:
+            if time.time() - _checked_at < CONFIG_CHECK_INTERVAL:
+                return _state
+            revision = batch_get(sheet_id, [REVISION_CELL])[0]
+            if revision and revision[0] and str(revision[0][0]) == str(_state["revision"]):
+                _checked_at = time.time()
+                return _state
+        _state = _read_state(sheet_id)
+        _checked_at = time.time()
+        return _state
+
+
+def _merged(state):
+    # Merge with defaults to handle missing keys (copied so callers cannot alter the cache)
+    return copy.deepcopy({**DEFAULT_CONFIG, **state["values"]})
+
+
+def load_config_with_revision():
+    """(config, revision); revision is None when the sheet could not be read"""
     try:
         sheet_id = get_or_create_config_sheet()
         if not sheet_id:
-            return DEFAULT_CONFIG
-            
-        creds = get_google_credentials()
-        if not creds:
-            return DEFAULT_CONFIG
-            
-        sheets_service = build('sheets', 'v4', credentials=creds)
-        
-        # Read from A1 (JSON string stored there)
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=sheet_id,
-            range='A1'
-        ).execute()
-        
-        values = result.get('values', [])
-        if values and values[0]:
-            config_json = values[0][0]
-            config = json.loads(config_json)
-            # Merge with defaults to handle missing keys
-            merged = {**DEFAULT_CONFIG, **config}
-            return merged
-        else:
-            return DEFAULT_CONFIG
-            
+            return copy.deepcopy(DEFAULT_CONFIG), None
+        state = _current_state(sheet_id)
+        return _merged(state), state["revision"]
     except Exception as e:
         print(f"Error loading config from sheets: {e}", file=sys.stderr)
-        return DEFAULT_CONFIG
+        return copy.deepcopy(DEFAULT_CONFIG), None
+
+
+def load_config():
+    """Load configuration from Google Sheets"""
+    return load_config_with_revision()[0]
+
+
+def get_config_revision():
+    """Current config revision (cheap: one cell, or the cache within CONFIG_CHECK_INTERVAL)"""
+    return load_config_with_revision()[1]
+
+
+def update_config(changes, expected_revision=None, replace=False):
+    """
+    Write only the keys in `changes` whose value differs from the stored one.
+    With replace, `changes` is the full config and stored keys missing from it are deleted.
+    With expected_revision, the update is refused if the config changed since then.
+    Returns {"success", "revision", "changed"} or {"error", "conflict", "revision"}.
+    """
+    global _state, _checked_at
+    # _save_lock only serializes saves within this process: two gunicorn workers can both pass
+    # the revision check below before either writes, and the later write wins. Sheets has no
+    # conditional write, so If-Match is best-effort across workers.
+    with _save_lock:
+        try:
+            sheet_id = get_or_create_config_sheet()
+            if not sheet_id:
+                return {"error": "Config sheet unavailable"}
+
+            # Fresh state: the conflict check must not rely on a cached revision
+            state = _current_state(sheet_id, force=True)
+            if expected_revision is not None and expected_revision != state["revision"]:
+                return {"error": "Config was modified by someone else", "conflict": True,
+                        "revision": state["revision"]}
+
+            changed = [k for k, v in changes.items() if k not in state["values"] or state["values"][k] != v]
+            removed = [k for k in state["rows"] if k not in changes] if replace else []
+            if not changed and not removed:
+                return {"success": True, "revision": state["revision"], "changed": []}
+
+            now = _now()
+            new_rows = dict(state["rows"])
+            next_row = state["next_row"]
+            handles = []
+            for key in changed:
+                row, version, width = state["rows"].get(key, (None, 0, 0))
+                if row is None:
+                    row, next_row = next_row, next_row + 1
+                cells = _row_cells(key, changes[key], version + 1, now)
+                # Blank out continuation cells left over from a longer previous value
+                cells += [''] * (width - len(cells))
+                handles.append(writer.write(sheet_id, f"A{row}:{_column(len(cells))}{row}", [cells]))
+                new_rows[key] = (row, version + 1, len(cells))
+            for key in removed:
+                # Blank the row in place; row numbers of other keys stay valid
+                row, _, width = new_rows.pop(key)
+                handles.append(writer.write(sheet_id, f"A{row}:{_column(width)}{row}", [[''] * width]))
+
+            revision = state["revision"] + 1
+            handles.append(writer.write(sheet_id, f"{REVISION_LABEL_CELL}:{REVISION_CELL}", [['revision', revision]]))
+            if not all(h.wait() for h in handles):
+                _state = None  # Partially written; re-read next time
+                return {"error": "Failed to save config"}
+
+            with _state_lock:
+                _state = {
+                    "revision": revision,
+                    "values": {
+                        **{k: v for k, v in state["values"].items() if k not in removed},
+                        **{k: changes[k] for k in changed}
+                    },
+                    "rows": new_rows,
+                    "next_row": next_row
+                }
+                _checked_at = time.time()
+
+            print(f"Config saved to sheet {sheet_id} (revision {revision}, keys: {', '.join(changed + removed)})", file=sys.stderr)
+            return {"success": True, "revision": revision, "changed": changed + removed}
+
+        except Exception as e:
+            print(f"Error saving config to sheets: {e}", file=sys.stderr)
+            return {"error": str(e)}
+
 
 def save_config(config):
     """Save configuration to Google Sheets"""
-    try:
-        sheet_id = get_or_create_config_sheet()
-        if not sheet_id:
-            return False
-            
-        creds = get_google_credentials()
-        if not creds:
-            return False
-            
-        sheets_service = build('sheets', 'v4', credentials=creds)
-        
-        # Store as JSON string in A1
-        config_json = json.dumps(config, ensure_ascii=False, indent=2)
-        
-        sheets_service.spreadsheets().values().update(
-            spreadsheetId=sheet_id,
-            range='A1',
-            valueInputOption='RAW',
-            body={'values': [[config_json]]}
-        ).execute()
-        
-        print(f"Config saved to sheet {sheet_id}", file=sys.stderr)
-        return True
-        
-    except Exception as e:
-        print(f"Error saving config to sheets: {e}", file=sys.stderr)
-        return False
+    return bool(update_config(config, replace=True).get("success"))
@@ -162,6 +162,13 @@ def add_message(user_id, role, text):
         "timestamp": datetime.now().isoformat()
     })
     
+    # Full, time-indexed copy for batch jobs (the history here is trimmed)
+    try:
+        from utils.journal import append
+        append(user_id, role, text)
+    except Exception as e:
+        print(f"Journal append error: {e}", file=sys.stderr)
+
     # Trim to max history
     if len(history[user_id]) > MAX_HISTORY:
         history[user_id] = history[user_id][-MAX_HISTORY:]
@@ -0,0 +1,34 @@
+"""
+Text helpers shared by retrieval, consolidation and the maker
+Token estimates for mixed Japanese / ASCII text, and the normalized form used to
+compare snippets regardless of width, case and whitespace.
+"""
+import re
+import math
+import unicodedata
+
+
+def estimate_tokens(text):
+    """Rough token count: ~4 ASCII chars per token, ~1 token per Japanese character"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+
+def truncate_to_tokens(text, limit):
+    """Longest prefix of text whose estimate_tokens() is <= limit"""
+    if estimate_tokens(text) <= limit:
+        return text
+    ascii_chars, other = 0, 0
+    for i, ch in enumerate(text):
+        if ord(ch) < 128:
+            ascii_chars += 1
+        else:
+            other += 1
+        if math.ceil(ascii_chars / 4) + other > limit:
+            return text[:i]
+    return text
+
+
+def normalized(text):
+    """NFKC, lower-cased, whitespace removed"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', text or '').lower())
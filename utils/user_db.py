@@ -1,17 +1,68 @@
 """
 User Database using Google Sheets
 Stores UserID, Location, and Notification Preferences
+
+Reads and writes go to a local SQLite copy indexed by user ID; changes are written
+through to the Koto_Users sheet in the background (the sheet stays the durable record).
 """
+import os
 import sys
+import time
+import sqlite3
 import datetime
+import threading
 from googleapiclient.discovery import build
 from utils.auth import get_google_credentials, get_shared_folder_id
-from tools.google_ops import create_google_sheet, search_drive
+from utils.local_db import get_connection, get_state, set_state
+from utils.sheets_batch import append_values, batch_get, create_spreadsheet, writer
 
 DB_FILENAME = "Koto_Users"
+LOCAL_DB_NAME = "users.db"
+
+# Re-read the sheet after this long, to pick up rows edited by hand (seconds)
+USER_DB_RELOAD_INTERVAL = int(os.environ.get('USER_DB_RELOAD_INTERVAL', 3600))
+
+SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            location TEXT,
+            last_updated TEXT,
+            status TEXT,
+            sheet_row INTEGER,
+            dirty INTEGER DEFAULT 0,
+            version INTEGER DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_status ON users (status);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+_db_sheet_id = None  # Cache
+_reload_lock = threading.Lock()
+_sync_guard = threading.Lock()
+_sync_requested = threading.Event()
+_sync_running = False
+_version_column_checked = False
+
+
+def _get_local():
+    global _version_column_checked
+    conn = get_connection(LOCAL_DB_NAME, SCHEMA)
+    if not _version_column_checked:
+        # users.db files created before the version column existed
+        if 'version' not in [row['name'] for row in conn.execute("PRAGMA table_info(users)")]:
+            try:
+                conn.execute("ALTER TABLE users ADD COLUMN version INTEGER DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass  # Another worker added it first
+        _version_column_checked = True
+    return conn
+
 
 def _get_or_create_db():
     """Find existing DB sheet or create new one"""
+    global _db_sheet_id
+    if _db_sheet_id:
+        return _db_sheet_id
     try:
         # Search for existing file
         creds = get_google_credentials()
@@ -27,72 +78,181 @@ def _get_or_create_db():
         files = results.get('files', [])
         
         if files:
-            return files[0]['id']
+            _db_sheet_id = files[0]['id']
+            return _db_sheet_id
         
-        # Create new if not found
+        # Create new if not found (with the header row)
         print(f"Creating new User DB: {DB_FILENAME}", file=sys.stderr)
-        result = create_google_sheet(DB_FILENAME)
-        if result.get('success'):
-            # Initialize headers
-            sheet_id = result['id']
-            sheets_service = build('sheets', 'v4', credentials=creds)
-            sheets_service.spreadsheets().values().update(
-                spreadsheetId=sheet_id,
-                range='A1',
-                valueInputOption='RAW',
-                body={'values': [['User_ID', 'Location', 'Last_Updated', 'Status']]}
-            ).execute()
-            return sheet_id
-        return None
+        _db_sheet_id = create_spreadsheet(
+            DB_FILENAME,
+            folder_id=get_shared_folder_id(),
+            rows=[['User_ID', 'Location', 'Last_Updated', 'Status']],
+            drive_service=drive_service
+        )
+        return _db_sheet_id
         
     except Exception as e:
         print(f"DB Init Error: {e}", file=sys.stderr)
         return None
 
-def register_user(user_id, location):
-    """Update or Insert user location"""
+def _reload_from_sheet(force=False):
+    """
+    Refresh the local copy from the sheet (one A:D read).
+    Rows with unsynced local changes are kept as they are.
+    """
+    conn = _get_local()
+    last_load = float(get_state(conn, 'last_load', 0) or 0)
+    if not force and time.time() - last_load < USER_DB_RELOAD_INTERVAL:
+        return True
+
+    with _reload_lock:
+        last_load = float(get_state(conn, 'last_load', 0) or 0)
+        if not force and time.time() - last_load < USER_DB_RELOAD_INTERVAL:
+            return True
+
+        sheet_id = _get_or_create_db()
+        if not sheet_id:
+            return False
+        try:
+            rows = batch_get(sheet_id, ['A:D'])[0]
+        except Exception as e:
+            print(f"User DB Reload Error: {e}", file=sys.stderr)
+            return False
+
+        with conn:
+            seen = []
+            for i, row in enumerate(rows):
+                if i == 0 or not row or not row[0]: continue # Skip header
+                row = row + [''] * (4 - len(row))
+                seen.append(row[0])
+                conn.execute(
+                    "INSERT INTO users (user_id, location, last_updated, status, sheet_row) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET sheet_row = excluded.sheet_row, "
+                    "location = CASE WHEN dirty THEN location ELSE excluded.location END, "
+                    "last_updated = CASE WHEN dirty THEN last_updated ELSE excluded.last_updated END, "
+                    "status = CASE WHEN dirty THEN status ELSE excluded.status END",
+                    (row[0], row[1], row[2], row[3], i + 1)
+                )
+            # Rows deleted from the sheet by hand (and not waiting to be written)
+            placeholders = ",".join("?" for _ in seen) or "''"
+            conn.execute(f"DELETE FROM users WHERE dirty = 0 AND user_id NOT IN ({placeholders})", seen)
+            # Appends that never reached the sheet (process died mid-write) are retried
+            conn.execute(f"UPDATE users SET sheet_row = NULL WHERE sheet_row = 0 AND user_id NOT IN ({placeholders})", seen)
+            set_state(conn, 'last_load', str(time.time()))
+        print(f"User DB: loaded {len(seen)} users from sheet", file=sys.stderr)
+        return True
+
+
+def _claim_new_rows(conn, users):
+    """
+    Mark unplaced users as being appended (sheet_row = 0) so another worker sharing the
+    local DB does not append them too; returns the users this process claimed.
+    """
+    claimed = []
+    with conn:
+        for user in users:
+            cur = conn.execute(
+                "UPDATE users SET sheet_row = 0 WHERE user_id = ? AND sheet_row IS NULL", (user['user_id'],)
+            )
+            if cur.rowcount == 1:
+                claimed.append(user)
+    return claimed
+
+
+def _write_dirty_rows():
+    """
+    Write locally changed users to the sheet.
+    Users whose row was read from the sheet are updated in place (one batched request);
+    new users are added with values.append, so rows added by hand or by another
+    worker are never overwritten.
+    """
     sheet_id = _get_or_create_db()
     if not sheet_id:
-        return {"error": "データベースエラー"}
-    
+        return
+    conn = _get_local()
+
+    dirty = conn.execute(
+        "SELECT user_id, location, last_updated, status, sheet_row, version FROM users WHERE dirty = 1 ORDER BY rowid"
+    ).fetchall()
+    if not dirty:
+        return
+
+    def cells(user):
+        # The full row is written so it always names its user
+        return [user['user_id'], user['location'], user['last_updated'], user['status']]
+
+    placed = [user for user in dirty if user['sheet_row']]
+    new = _claim_new_rows(conn, [user for user in dirty if user['sheet_row'] is None])
+
+    # Row numbers are 1-based
+    writes = [
+        (user, user['sheet_row'], writer.write(sheet_id, f"A{user['sheet_row']}:D{user['sheet_row']}", [cells(user)]))
+        for user in placed
+    ]
+    appended = []
+    if new:
+        try:
+            first_row = append_values(sheet_id, 'A:D', [cells(user) for user in new])
+            appended = [(user, first_row + i) for i, user in enumerate(new)]
+        except Exception as e:
+            print(f"User DB Append Error: {e}", file=sys.stderr)
+            with conn:
+                for user in new:
+                    conn.execute("UPDATE users SET sheet_row = NULL WHERE user_id = ? AND sheet_row = 0", (user['user_id'],))
+
+    written = appended + [(user, sheet_row) for user, sheet_row, handle in writes if handle.wait()]
+    with conn:
+        for user, sheet_row in written:
+            conn.execute("UPDATE users SET sheet_row = ? WHERE user_id = ?", (sheet_row, user['user_id']))
+            # Only clear the flag if nothing changed while we were writing
+            conn.execute(
+                "UPDATE users SET dirty = 0 WHERE user_id = ? AND version = ?",
+                (user['user_id'], user['version'])
+            )
+
+
+def _sync_worker():
+    global _sync_running
+    while True:
+        with _sync_guard:
+            if not _sync_requested.is_set():
+                _sync_running = False
+                return
+            _sync_requested.clear()
+        try:
+            _write_dirty_rows()
+        except Exception as e:
+            # Rows stay dirty and are retried on the next change or listing
+            print(f"User DB Sync Error: {e}", file=sys.stderr)
+
+
+def _schedule_sync():
+    """Write-through in the background; one writer at a time, later changes are picked up by it"""
+    global _sync_running
+    with _sync_guard:
+        _sync_requested.set()
+        if _sync_running:
+            return
+        _sync_running = True
+    threading.Thread(target=_sync_worker, daemon=True).start()
+
+
+def register_user(user_id, location):
+    """Update or Insert user location"""
     try:
-        creds = get_google_credentials()
-        sheets_service = build('sheets', 'v4', credentials=creds)
-        
-        # Read all data
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=sheet_id, range='A:D'
-        ).execute()
-        rows = result.get('values', [])
-        
-        # Find user
+        conn = _get_local()
+        if not get_state(conn, 'last_load'):
+            _reload_from_sheet()
+
         now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        updated = False
-        
-        for i, row in enumerate(rows):
-            if i == 0: continue # Skip header
-            if len(row) > 0 and row[0] == user_id:
-                # Update existing row (Row numbers are 1-based)
-                range_name = f'B{i+1}:D{i+1}'
-                sheets_service.spreadsheets().values().update(
-                    spreadsheetId=sheet_id,
-                    range=range_name,
-                    valueInputOption='RAW',
-                    body={'values': [[location, now, 'ACTIVE']]}
-                ).execute()
-                updated = True
-                break
-        
-        if not updated:
-            # Append new row
-            sheets_service.spreadsheets().values().append(
-                spreadsheetId=sheet_id,
-                range='A:D',
-                valueInputOption='RAW',
-                insertDataOption='INSERT_ROWS',
-                body={'values': [[user_id, location, now, 'ACTIVE']]}
-            ).execute()
-            
+        with conn:
+            conn.execute(
+                "INSERT INTO users (user_id, location, last_updated, status, dirty, version) VALUES (?, ?, ?, 'ACTIVE', 1, 1) "
+                "ON CONFLICT(user_id) DO UPDATE SET location = excluded.location, "
+                "last_updated = excluded.last_updated, status = 'ACTIVE', dirty = 1, version = version + 1",
+                (user_id, location, now)
+            )
+        _schedule_sync()
         return {"success": True, "location": location}
         
     except Exception as e:
@@ -101,29 +261,20 @@ def register_user(user_id, location):
 
 def get_active_users():
     """Get list of users with Status=ACTIVE"""
-    sheet_id = _get_or_create_db()
-    if not sheet_id:
-        return []
-        
     try:
-        creds = get_google_credentials()
-        sheets_service = build('sheets', 'v4', credentials=creds)
-        
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=sheet_id, range='A:D'
-        ).execute()
-        rows = result.get('values', [])
-        
-        users = []
-        for i, row in enumerate(rows):
-            if i == 0: continue
-            # Check if row has enough columns (User, Loc, Time, Status)
-            if len(row) >= 4 and row[3] == 'ACTIVE':
-                users.append({
-                    'user_id': row[0],
-                    'location': row[1]
-                })
-        return users
+        conn = _get_local()
+        loaded = _reload_from_sheet()
+        if not loaded and not get_state(conn, 'last_load'):
+            return []
+        if conn.execute("SELECT 1 FROM users WHERE dirty = 1 LIMIT 1").fetchone():
+            _schedule_sync()  # Left over from a previous run
+
+        # Sheet order first (callers treat the first user as the default), then new registrations
+        rows = conn.execute(
+            "SELECT user_id, location FROM users WHERE status = 'ACTIVE' "
+            "ORDER BY COALESCE(sheet_row, 0) = 0, sheet_row, rowid"
+        )
+        return [{'user_id': row['user_id'], 'location': row['location']} for row in rows]
         
     except Exception as e:
         print(f"Get Users Error: {e}", file=sys.stderr)
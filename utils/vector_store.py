@@ -7,6 +7,7 @@ import os
 import sys
 import json
 import time
+import threading
 import urllib.request
 from datetime import datetime
 from typing import List, Dict, Optional
@@ -20,6 +21,19 @@ DIMENSION = 768  # Gemini text-embedding-004 dimension
 PINECONE_API_KEY = os.environ.get('PINECONE_API_KEY', '')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
 
+# Recency weighting: a match's score is scaled from (1 - weight) for very old messages up to 1
+# for new ones, halving the recency bonus every half-life (days). 0 disables it.
+VECTOR_RECENCY_WEIGHT = float(os.environ.get('VECTOR_RECENCY_WEIGHT', 0.2))
+VECTOR_RECENCY_HALF_LIFE_DAYS = float(os.environ.get('VECTOR_RECENCY_HALF_LIFE_DAYS', 30))
+# Candidates fetched per requested result when re-ranking by recency
+VECTOR_CANDIDATE_FACTOR = int(os.environ.get('VECTOR_CANDIDATE_FACTOR', 3))
+
+# RAG snippets in the prompt: at most this many, each at most RAG_SNIPPET_TOKENS; a snippet is
+# only cut to fit the remaining budget if at least RAG_MIN_SNIPPET_TOKENS of it would remain
+RAG_MAX_SNIPPETS = int(os.environ.get('RAG_MAX_SNIPPETS', 5))
+RAG_SNIPPET_TOKENS = int(os.environ.get('RAG_SNIPPET_TOKENS', 150))
+RAG_MIN_SNIPPET_TOKENS = int(os.environ.get('RAG_MIN_SNIPPET_TOKENS', 30))
+
 
 class GeminiEmbedder:
     """Helper class to get embeddings from Gemini API"""
@@ -107,6 +121,25 @@ def _get_index():
         return None
 
 
+def _to_epoch(value) -> Optional[float]:
+    """Epoch seconds from a number, datetime or ISO string (None if absent / unparseable)"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+def message_id(user_id: str, ts: float, role: str) -> str:
+    """Vector ID for a conversation message: msg:{user_id}:{epoch ms}:{role}"""
+    return f"msg:{user_id}:{int(ts * 1000)}:{role}"
+
+
 def save_conversation(user_id: str, role: str, text: str, metadata: Optional[Dict] = None) -> bool:
     """Save conversation message to Pinecone"""
     index = _get_index()
@@ -118,15 +151,16 @@ def save_conversation(user_id: str, role: str, text: str, metadata: Optional[Dic
         embedder = GeminiEmbedder()
         vector = embedder.embed_text(text)
         
-        # Create unique ID
-        doc_id = f"{user_id}_{datetime.now().isoformat()}_{role}"
+        ts = time.time()
+        doc_id = message_id(user_id, ts, role)
         
-        # Prepare metadata
+        # Prepare metadata ('ts' is numeric so Pinecone can range-filter on it)
         doc_metadata = {
             "user_id": user_id,
             "role": role,
             "text": text, # Store text in metadata for retrieval
-            "timestamp": datetime.now().isoformat(),
+            "ts": ts,
+            "timestamp": datetime.fromtimestamp(ts).isoformat(),
         }
         if metadata:
             doc_metadata.update(metadata)
@@ -140,8 +174,23 @@ def save_conversation(user_id: str, role: str, text: str, metadata: Optional[Dic
         return False
 
 
-def search_relevant_context(user_id: str, query: str, n_results: int = 5) -> List[Dict]:
-    """Search for relevant past conversations"""
+def _recency_factor(ts: Optional[float], now: float) -> float:
+    """Score multiplier for a message's age; a message of unknown age counts as old"""
+    if ts is None:
+        return 1.0 - VECTOR_RECENCY_WEIGHT
+    age_days = max(0.0, now - ts) / 86400
+    decay = 0.5 ** (age_days / VECTOR_RECENCY_HALF_LIFE_DAYS) if VECTOR_RECENCY_HALF_LIFE_DAYS > 0 else 1.0
+    return (1.0 - VECTOR_RECENCY_WEIGHT) + VECTOR_RECENCY_WEIGHT * decay
+
+
+def search_relevant_context(user_id: str, query: str, n_results: int = 5,
+                            since=None, until=None, recency: bool = True) -> List[Dict]:
+    """
+    Search for relevant past conversations.
+    since / until (epoch seconds, datetime or ISO string) restrict matches to that time range
+    in the Pinecone query itself. With recency, extra candidates are fetched and re-ranked by
+    relevance scaled by message age.
+    """
     index = _get_index()
     if index is None:
         return []
@@ -151,61 +200,87 @@ def search_relevant_context(user_id: str, query: str, n_results: int = 5) -> Lis
         embedder = GeminiEmbedder()
         vector = embedder.embed_text(query)
         
+        query_filter = {"user_id": {"$eq": user_id}}
+        ts_range = {}
+        if _to_epoch(since) is not None:
+            ts_range["$gte"] = _to_epoch(since)
+        if _to_epoch(until) is not None:
+            ts_range["$lte"] = _to_epoch(until)
+        if ts_range:
+            query_filter["ts"] = ts_range
+        
+        rerank = recency and VECTOR_RECENCY_WEIGHT > 0
+        
         # Search Pinecone
         results = index.query(
             vector=vector,
-            top_k=n_results,
-            filter={"user_id": user_id},
+            top_k=n_results * VECTOR_CANDIDATE_FACTOR if rerank else n_results,
+            filter=query_filter,
             include_metadata=True
         )
         
         # Format results
+        now = time.time()
         relevant_context = []
         for match in results.matches:
             metadata = match.metadata or {}
+            if metadata.get("type") == "profile":
+                continue
+            # Records saved before 'ts' existed only have the ISO timestamp
+            ts = _to_epoch(metadata.get("ts")) or _to_epoch(metadata.get("timestamp"))
             relevant_context.append({
+                "id": match.id,
                 "text": metadata.get("text", ""),
                 "role": metadata.get("role", "unknown"),
                 "timestamp": metadata.get("timestamp", ""),
-                "relevance": match.score
+                "ts": ts,
+                "relevance": match.score,
+                "score": match.score * _recency_factor(ts, now) if rerank else match.score
             })
         
-        return relevant_context
+        relevant_context.sort(key=lambda item: item["score"], reverse=True)
+        return relevant_context[:n_results]
     except Exception as e:
         print(f"Error searching Pinecone: {e}", file=sys.stderr)
         return []
 
 
 def get_context_summary(user_id: str, query: str, max_tokens: int = 500) -> str:
-    """Get context summary for AI prompt"""
-    relevant = search_relevant_context(user_id, query, n_results=5)
+    """
+    Get context summary for AI prompt.
+    Snippets come from hybrid (BM25 + vector) retrieval, best first, and are packed so the whole
+    summary stays within max_tokens (by the same estimate the rest of the app uses); the last
+    snippet that does not fit is cut rather than dropped if enough budget remains.
+    """
+    from utils.hybrid_search import hybrid_search
+    from utils.text import estimate_tokens, truncate_to_tokens
+    from utils.storage import get_user_history
+
+    # Turns already in the chat history are in the prompt anyway
+    recent = [m.get("text", "") for m in get_user_history(user_id)]
+    relevant = hybrid_search(user_id, query, n_results=RAG_MAX_SNIPPETS, exclude_texts=recent)
     
     if not relevant:
         return ""
     
-    # Build context summary
+    header = "【過去の関連会話】\n"
+    budget = max_tokens - estimate_tokens(header)
     context_parts = []
-    total_chars = 0
-    max_chars = max_tokens * 3
-    
-    # Sort by timestamp (oldest first) to maintain conversation flow
-    # or keep relevance order? Usually relevance is better for RAG, 
-    # but context flow is easier to read if sorted.
-    # Let's keep relevance for now as they are independent snippets.
     
     for item in relevant:
-        if total_chars >= max_chars:
+        role_label = {"user": "ユーザー", "memory": "記憶"}.get(item["role"], "KOTO")
+        prefix = f"[{role_label}] "
+        # Each entry also costs its trailing newline
+        room = min(budget, RAG_SNIPPET_TOKENS + estimate_tokens(prefix)) - 1
+        if room - estimate_tokens(prefix) < RAG_MIN_SNIPPET_TOKENS:
             break
         
-        role_label = "ユーザー" if item["role"] == "user" else "KOTO"
-        text = item["text"][:200]
-        
-        entry = f"[{role_label}] {text}"
+        entry = truncate_to_tokens(prefix + " ".join(item["text"].split()), room)
         context_parts.append(entry)
-        total_chars += len(entry)
+        budget -= estimate_tokens(entry) + 1
     
     if context_parts:
-        return "【過去の関連会話】\n" + "\n".join(context_parts) + "\n"
+        return header + "\n".join(context_parts) + "\n"
     
     return ""
 
@@ -230,56 +305,147 @@ def get_collection_stats() -> Dict:
         return {"status": "error", "error": str(e)}
 
 # --- Profile Persistence (Phase 5) ---
+# Profiles live in a local SQLite key-value table (data/profiles.db) with a version stamp and
+# are cached in memory, so reading one does no network I/O. A copy is kept in Pinecone's
+# "profiles" namespace (outside the conversation vectors) to survive a lost data volume;
+# profiles still stored the old way (a profile:{user_id} vector among the conversations) are
+# migrated on first read.
 
-def get_user_profile(user_id: str) -> Dict:
-    """Retrieve user profile from Pinecone (stored as special vector)"""
-    index = _get_index()
-    if index is None:
-        return {}
-        
-    try:
-        # Fetch by specific ID
-        profile_id = f"profile:{user_id}"
-        fetch_response = index.fetch(ids=[profile_id])
-        
-        if profile_id in fetch_response.vectors:
-            vector_data = fetch_response.vectors[profile_id]
-            # Profile data is stored in metadata['json_data'] as string
-            if vector_data.metadata and 'json_data' in vector_data.metadata:
-                return json.loads(vector_data.metadata['json_data'])
-                
-        return {}
-    except Exception as e:
-        print(f"Error fetching profile: {e}", file=sys.stderr)
-        return {}
+PROFILE_DB_NAME = "profiles.db"
+PROFILE_NAMESPACE = "profiles"
+# How long a cached profile is served before its version stamp is re-checked (seconds);
+# other processes' saves become visible within this time
+PROFILE_CACHE_TTL = int(os.environ.get('PROFILE_CACHE_TTL', 30))
 
-def save_user_profile(user_id: str, profile_data: Dict) -> bool:
-    """Save user profile to Pinecone"""
+PROFILE_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id TEXT PRIMARY KEY,
+            json_data TEXT,
+            version INTEGER,
+            updated_at REAL
+        );
+"""
+
+# user_id -> (version, checked_at, profile)
+_profile_cache = {}
+_profile_lock = threading.Lock()
+
+
+def _profile_db():
+    from utils.local_db import get_connection
+    return get_connection(PROFILE_DB_NAME, PROFILE_SCHEMA)
+
+
+def _profile_backup_vector():
+    # Pinecone rejects all-zero vectors; the value is irrelevant in the profiles namespace
+    return [1.0] + [0.0] * (DIMENSION - 1)
+
+
+def _backup_profile(user_id: str, json_str: str, version: int):
     index = _get_index()
     if index is None:
-        return False
-        
+        return
     try:
-        profile_id = f"profile:{user_id}"
-        
-        # Serialize profile to JSON string
-        json_str = json.dumps(profile_data, ensure_ascii=False)
-        
-        # Use a dummy vector (all zeros) since we only care about metadata for this item
-        # But Pinecone requires a vector.
-        dummy_vector = [0.0] * DIMENSION
-        
-        # Upsert
         index.upsert(vectors=[(
-            profile_id, 
-            dummy_vector, 
+            f"profile:{user_id}",
+            _profile_backup_vector(),
             {
                 "type": "profile",
                 "user_id": user_id,
+                "version": version,
                 "timestamp": datetime.now().isoformat(),
-                "json_data": json_str # Store actual data here
+                "json_data": json_str
             }
-        )])
+        )], namespace=PROFILE_NAMESPACE)
+    except Exception as e:
+        print(f"Error backing up profile: {e}", file=sys.stderr)
+
+
+def _store_profile(user_id: str, json_str: str) -> int:
+    """Write the profile to SQLite, bumping its version; returns the new version"""
+    conn = _profile_db()
+    with conn:
+        conn.execute(
+            "INSERT INTO profiles (user_id, json_data, version, updated_at) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET json_data = excluded.json_data, "
+            "version = profiles.version + 1, updated_at = excluded.updated_at",
+            (user_id, json_str, time.time())
+        )
+        return conn.execute("SELECT version FROM profiles WHERE user_id = ?", (user_id,)).fetchone()["version"]
+
+
+def _fetch_remote_profile(user_id: str) -> Optional[str]:
+    """
+    Profile JSON from the Pinecone backup, or from a legacy record (which is then moved).
+    None if there is none; raises if Pinecone is configured but unreachable.
+    """
+    index = _get_index()
+    if index is None:
+        if PINECONE_API_KEY:
+            raise RuntimeError(f"vector store not available: {_init_error}")
+        return None
+    profile_id = f"profile:{user_id}"
+    for namespace in (PROFILE_NAMESPACE, None):
+        kwargs = {"namespace": namespace} if namespace else {}
+        vectors = index.fetch(ids=[profile_id], **kwargs).vectors
+        record = vectors.get(profile_id)
+        if record and record.metadata and 'json_data' in record.metadata:
+            if namespace is None:
+                # Legacy: out of the similarity index, into the profiles namespace
+                print(f"Migrating legacy profile for {user_id[:8]}", file=sys.stderr)
+                _backup_profile(user_id, record.metadata['json_data'], 1)
+                index.delete(ids=[profile_id])
+            return record.metadata['json_data']
+    return None
+
+
+def get_user_profile(user_id: str) -> Optional[Dict]:
+    """
+    Retrieve user profile (memory cache -> local store -> Pinecone backup / legacy record).
+    {} if the user has none; None if it could not be read (callers must not save over it).
+    """
+    import copy
+    now = time.time()
+    with _profile_lock:
+        cached = _profile_cache.get(user_id)
+        if cached and now - cached[1] < PROFILE_CACHE_TTL:
+            return copy.deepcopy(cached[2])
+
+    try:
+        row = _profile_db().execute(
+            "SELECT json_data, version FROM profiles WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            # Not stored locally yet (new volume, or before the migration): restore once.
+            # A user with no profile anywhere gets an empty one so this is not repeated.
+            json_str = _fetch_remote_profile(user_id) or "{}"
+            row = {"json_data": json_str, "version": _store_profile(user_id, json_str)}
+
+        with _profile_lock:
+            cached = _profile_cache.get(user_id)
+            if cached and cached[0] == row["version"]:
+                profile = cached[2]
+            else:
+                profile = json.loads(row["json_data"])
+            _profile_cache[user_id] = (row["version"], now, profile)
+        return copy.deepcopy(profile)
+    except Exception as e:
+        print(f"Error fetching profile: {e}", file=sys.stderr)
+        # Report unavailable until the next check instead of retrying on every message
+        with _profile_lock:
+            _profile_cache[user_id] = (None, now, None)
+        return None
+
+
+def save_user_profile(user_id: str, profile_data: Dict) -> bool:
+    """Save user profile locally (new version, cache updated) and back it up in the background"""
+    import copy
+    try:
+        json_str = json.dumps(profile_data, ensure_ascii=False)
+        version = _store_profile(user_id, json_str)
+        with _profile_lock:
+            _profile_cache[user_id] = (version, time.time(), copy.deepcopy(profile_data))
+        threading.Thread(target=_backup_profile, args=(user_id, json_str, version), daemon=True).start()
         return True
     except Exception as e:
         print(f"Error saving profile: {e}", file=sys.stderr)